@@ -1,3 +1,16 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import TriggerEvent, TriggerRule
+
+
+@admin.register(TriggerRule)
+class TriggerRuleAdmin(admin.ModelAdmin):
+    list_display = ('name', 'port', 'kind', 'pattern', 'actions', 'enabled')
+    list_filter = ('enabled', 'kind', 'port')
+    search_fields = ('name', 'pattern')
+
+
+@admin.register(TriggerEvent)
+class TriggerEventAdmin(admin.ModelAdmin):
+    list_display = ('timestamp', 'rule', 'port', 'line')
+    list_filter = ('rule', 'port')
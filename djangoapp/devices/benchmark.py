@@ -0,0 +1,252 @@
+"""Benchmarks of the ingest and serving paths, driven by simulated devices (see the serialbench command).
+
+A scenario opens a PtyDevice that writes numbered, timestamped lines at a
+set rate and size, and lets the app read it like a real port while
+long-polling clients fetch through GET /serial/data/ and a sender posts to
+/serial/send/, all through the full Django request stack. Each line carries
+its send time, so pollers measure read-to-client latency directly.
+"""
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+import django
+from django.test import Client
+
+from . import readers
+from .persistence import get_writer
+from .virtual import PtyDevice
+
+RESULTS_VERSION = 1
+BENCH_PORT = 'bench'  # SERIAL_VIRTUAL_PORTS name the simulated device is served under
+
+# name -> parameters; rate 0 writes as fast as the reader takes the lines
+SCENARIOS = {
+    'steady': {'rate': 1000, 'size': 64, 'pollers': 4, 'senders': 1},
+    'saturate': {'rate': 0, 'size': 64, 'pollers': 1, 'senders': 0},
+    'many_pollers': {'rate': 200, 'size': 128, 'pollers': 32, 'senders': 1},
+    'large_lines': {'rate': 200, 'size': 4096, 'pollers': 4, 'senders': 0},
+}
+
+# Metrics compared between runs: (section, key, True if higher is better)
+KEY_METRICS = [
+    ('ingest', 'lines_per_second', True),
+    ('latency_ms', 'p50', False),
+    ('latency_ms', 'p99', False),
+    ('http', 'p50_ms', False),
+    ('http', 'p99_ms', False),
+    ('send', 'p99_ms', False),
+    ('db', 'rows_per_second', True),
+    ('memory', 'rss_growth_mb', False),
+]
+
+
+def percentiles(values):
+    """p50/p90/p99/max of values (nearest rank), rounded to 3 decimals."""
+    if not values:
+        return {'count': 0, 'p50': None, 'p90': None, 'p99': None, 'max': None}
+    values = sorted(values)
+
+    def rank(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+    return {'count': len(values), 'p50': rank(0.5), 'p90': rank(0.9), 'p99': rank(0.99), 'max': round(values[-1], 3)}
+
+
+def rss_mb():
+    """Resident set size of this process in MB (Linux), else the peak so far."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB elsewhere
+
+
+def _generate(device, rate, size, stop, counters):
+    # Lines look like '<n> <send time> xxxx...', padded to size bytes with the newline
+    sent = 0
+    started = time.monotonic()
+    while not stop.is_set():
+        if rate:
+            due = int((time.monotonic() - started) * rate) + 1
+            count = min(due - sent, 1000)
+            if count <= 0:
+                time.sleep(0.001)
+                continue
+        else:
+            count = 256
+        now = time.time()
+        chunk = b''.join(
+            f'{sent + i} {now:.6f} '.ljust(size - 1, 'x').encode('ascii') + b'\n'
+            for i in range(count)
+        )
+        try:
+            device.write(chunk)
+        except OSError:
+            break  # the port was closed
+        sent += count
+    counters['sent'] = sent
+
+
+def _poll(stop, counters, lock):
+    client = Client(SERVER_NAME='localhost')
+    cursor = None
+    request_ms, latency_ms, lines = [], [], 0
+    while not stop.is_set():
+        params = {'limit': 1000, 'wait': 1}
+        if cursor is not None:
+            params['since'] = cursor
+        started = time.perf_counter()
+        response = client.get(f'/serial/data/{BENCH_PORT}/', params)
+        request_ms.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 200:
+            continue
+        data = json.loads(response.content)
+        received = time.time()
+        for line in data['lines']:
+            latency_ms.append((received - float(line.split(' ', 2)[1])) * 1000)
+        lines += len(data['lines'])
+        cursor = data['next']
+    with lock:
+        counters['request_ms'].extend(request_ms)
+        counters['latency_ms'].extend(latency_ms)
+        counters['delivered'] += lines
+
+
+def _send(stop, counters, interval=0.01):
+    client = Client(SERVER_NAME='localhost')
+    body = json.dumps({'port': BENCH_PORT, 'buffer': 'PING'})
+    while not stop.wait(interval):
+        started = time.perf_counter()
+        client.post('/serial/send/', body, content_type='application/json')
+        counters['send_ms'].append((time.perf_counter() - started) * 1000)
+
+
+def run_scenario(rate, size, pollers, senders, duration):
+    """Run one scenario for duration seconds and return its results."""
+    device = PtyDevice()
+    readers.VIRTUAL_PORTS[BENCH_PORT] = device.path
+    writer = get_writer()
+    writer_before = writer.stats()
+    flush_ms_before = writer.total_flush_ms
+    rss_before = rss_mb()
+    stop = threading.Event()
+    lock = threading.Lock()
+    counters = {'sent': 0, 'delivered': 0, 'request_ms': [], 'latency_ms': [], 'send_ms': []}
+    try:
+        reader = readers.ensure_reader(device.path)
+        device.wait_opened(timeout=5)
+        first_seq = reader.last_seq
+        threads = [threading.Thread(target=_poll, args=(stop, counters, lock)) for _ in range(pollers)]
+        threads += [threading.Thread(target=_send, args=(stop, counters)) for _ in range(senders)]
+        generator = threading.Thread(target=_generate, args=(device, rate, size, stop, counters))
+        for thread in threads:
+            thread.start()
+        started = time.monotonic()
+        generator.start()
+        stop.wait(duration)
+        stop.set()
+        generator.join()
+        elapsed = time.monotonic() - started
+        for thread in threads:
+            thread.join()
+        time.sleep(0.2)  # let the reader take what is still in the pty
+        lines_read = reader.last_seq - first_seq
+        # Time until the writer caught up, for the DB rate over the whole backlog
+        drain_started = time.monotonic()
+        while writer.queue.qsize() and time.monotonic() - drain_started < 30:
+            time.sleep(0.05)
+        db_elapsed = elapsed + time.monotonic() - drain_started
+    finally:
+        stop.set()
+        readers.stop_all_readers()
+        device.close()
+    writer_after = writer.stats()
+    flush_ms = writer.total_flush_ms - flush_ms_before
+    rss_after = rss_mb()
+    rows = writer_after['rows_written'] - writer_before['rows_written']
+    flushes = writer_after['flushes'] - writer_before['flushes']
+    http = percentiles(counters['request_ms'])
+    send = percentiles(counters['send_ms'])
+    return {
+        'ingest': {
+            'lines_sent': counters['sent'],
+            'lines_read': lines_read,
+            'lines_lost': max(0, counters['sent'] - lines_read),
+            'lines_per_second': round(lines_read / elapsed, 1),
+            'bytes_per_second': round(lines_read * size / elapsed, 1),
+        },
+        'latency_ms': percentiles(counters['latency_ms']),
+        'http': {
+            'requests': http['count'],
+            'requests_per_second': round(http['count'] / elapsed, 1),
+            'lines_delivered': counters['delivered'],
+            'p50_ms': http['p50'], 'p90_ms': http['p90'], 'p99_ms': http['p99'], 'max_ms': http['max'],
+        },
+        'send': {
+            'requests': send['count'],
+            'p50_ms': send['p50'], 'p90_ms': send['p90'], 'p99_ms': send['p99'], 'max_ms': send['max'],
+        },
+        'db': {
+            'rows_written': rows,
+            'rows_per_second': round(rows / db_elapsed, 1) if db_elapsed else 0.0,
+            'flushes': flushes,
+            'avg_flush_ms': round(flush_ms / flushes, 3) if flushes else 0.0,
+            'rows_pruned': writer_after['rows_pruned'] - writer_before['rows_pruned'],
+            'errors': writer_after['errors'] - writer_before['errors'],
+        },
+        'memory': {
+            'rss_start_mb': round(rss_before, 1),
+            'rss_end_mb': round(rss_after, 1),
+            'rss_growth_mb': round(rss_after - rss_before, 1),
+            'rss_peak_mb': round(peak_rss_mb(), 1),
+        },
+        'elapsed_seconds': round(elapsed, 3),
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(baseline, current, threshold):
+    """Yield (scenario, metric, before, after, change, regressed) for the KEY_METRICS of both runs.
+
+    change is the relative difference; a metric regressed if it moved the
+    wrong way by more than threshold (0.1 = 10%).
+    """
+    for name, result in current['scenarios'].items():
+        before_result = baseline.get('scenarios', {}).get(name)
+        if before_result is None:
+            continue
+        for section, key, higher_is_better in KEY_METRICS:
+            before = before_result.get(section, {}).get(key)
+            after = result.get(section, {}).get(key)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before if before else 0.0
+            worse = -change if higher_is_better else change
+            yield name, f'{section}.{key}', before, after, change, worse > threshold
@@ -0,0 +1,451 @@
+"""Serial broker: one process owns the ports, web workers talk to it over a Unix socket.
+
+Wire format: every message is a frame of
+
+    4 bytes  payload length (big endian)
+    1 byte   message kind (see KIND_*)
+    payload  UTF-8 JSON
+
+A client sends a request frame and gets one REPLY or ERROR frame back, except
+after SUBSCRIBE, where the broker keeps pushing ENTRY frames on that
+connection until either side closes it (SUBSCRIBE_TRIGGERS likewise pushes
+[event, info] for fired triggers). Entries travel as [seq, timestamp, line],
+or [seq, timestamp, frame, 1] for a binary frame, with the frame's bytes
+mapped one to one onto code points 0-255 (latin-1). The same mapping carries
+written chunks and binary command replies (flagged 'binary').
+"""
+import asyncio
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+
+import serial
+from django.conf import settings
+
+from . import metrics
+from .commands import ReplyMatcher
+from .readers import Entry, LocalBackend, ensure_reader
+from .streaming import KEEPALIVE_SECONDS, event_stream
+from .triggers import get_trigger_engine
+
+# Path of the broker's Unix socket. When set, the web views use the broker
+# instead of opening ports in their own process.
+BROKER_SOCKET = getattr(settings, 'SERIAL_BROKER_SOCKET', None)
+
+KIND_FETCH = 1
+KIND_WRITE = 2
+KIND_SUBSCRIBE = 3
+KIND_REPLY = 4
+KIND_ENTRY = 5
+KIND_ERROR = 6
+KIND_END = 7
+KIND_METRICS = 8
+KIND_FETCH_MANY = 9
+KIND_COMMAND = 10
+KIND_SUBSCRIBE_TRIGGERS = 11
+KIND_RECORD = 12
+KIND_STATUS = 13
+
+_HEADER = struct.Struct('!IB')
+MAX_FRAME = 16 * 1024 * 1024
+
+
+class BrokerError(serial.SerialException):
+    """The broker reported a failure, or could not be reached."""
+
+
+def encode_frame(kind, body):
+    payload = json.dumps(body, separators=(',', ':')).encode('utf-8')
+    return _HEADER.pack(len(payload), kind) + payload
+
+
+def _decode_header(header):
+    length, kind = _HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise BrokerError(f'Frame of {length} bytes exceeds the {MAX_FRAME} byte limit')
+    return length, kind
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Broker connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock):
+    length, kind = _decode_header(_recv_exactly(sock, _HEADER.size))
+    return kind, json.loads(_recv_exactly(sock, length))
+
+
+async def read_frame(stream):
+    length, kind = _decode_header(await stream.readexactly(_HEADER.size))
+    return kind, json.loads(await stream.readexactly(length))
+
+
+def _entry_to_wire(entry):
+    if isinstance(entry.line, bytes):
+        return [entry.seq, entry.timestamp, entry.line.decode('latin-1'), 1]
+    return [entry.seq, entry.timestamp, entry.line]
+
+
+def _entry_from_wire(item):
+    if len(item) > 3 and item[3]:
+        return Entry(item[0], item[1], item[2].encode('latin-1'))
+    return Entry(*item)
+
+
+def _replies_to_wire(results):
+    for result in results:
+        lines = result.get('reply')
+        if lines and isinstance(lines[0], bytes):
+            result['reply'] = [line.decode('latin-1') for line in lines]
+            result['binary'] = True
+    return results
+
+
+def _replies_from_wire(results):
+    for result in results:
+        if result.pop('binary', False):
+            result['reply'] = [line.encode('latin-1') for line in result['reply']]
+    return results
+
+
+# --- Broker side ---
+
+class _ConnectionSubscription:
+    # Reader (or trigger engine) subscriber that queues items for one broker connection's thread
+    def __init__(self, source, queue_size=1000):
+        self.source = source
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def publish(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def finish(self):
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except queue.Full:
+                self.queue.get_nowait()  # make room for the end marker
+
+    def close(self):
+        self.source.unsubscribe(self)
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                kind, body = recv_frame(self.request)
+            except (OSError, ValueError):
+                return  # client closed the connection or sent garbage
+            if kind == KIND_SUBSCRIBE:
+                self._stream(body['port'], body.get('since'))
+                return  # a subscribed connection is not reused for requests
+            if kind == KIND_SUBSCRIBE_TRIGGERS:
+                self._stream_triggers()
+                return
+            try:
+                reply = encode_frame(KIND_REPLY, self._dispatch(kind, body))
+            except Exception as e:
+                reply = encode_frame(KIND_ERROR, {'error': str(e)})
+            try:
+                self.request.sendall(reply)
+            except OSError:
+                return
+
+    def _dispatch(self, kind, body):
+        backend = self.server.backend
+        if kind == KIND_FETCH:
+            result = backend.fetch(body['port'], body.get('since'), body['limit'], body.get('wait', 0))
+            result['entries'] = [_entry_to_wire(entry) for entry in result['entries']]
+            return result
+        if kind == KIND_FETCH_MANY:
+            results = backend.fetch_many(body['cursors'], body['limit'], body.get('wait', 0))
+            for result in results.values():
+                result['entries'] = [_entry_to_wire(entry) for entry in result['entries']]
+            return results
+        if kind == KIND_METRICS:
+            return {'text': metrics.registry.render()}
+        if kind == KIND_WRITE:
+            return backend.write(body['port'], [chunk.encode('latin-1') for chunk in body['chunks']])
+        if kind == KIND_RECORD:
+            return backend.record(body['port'], body['action'])
+        if kind == KIND_STATUS:
+            return {'ports': backend.port_status(body.get('port'))}
+        if kind == KIND_COMMAND:
+            requests = [
+                ([chunk.encode('latin-1') for chunk in command['chunks']], ReplyMatcher.from_spec(command['match']))
+                for command in body['commands']
+            ]
+            return _replies_to_wire(backend.command(body['port'], requests, body['timeout']))
+        raise BrokerError(f'Unknown message kind {kind}')
+
+    def _stream(self, full_port, since):
+        try:
+            reader = ensure_reader(full_port)
+        except Exception as e:
+            try:
+                self.request.sendall(encode_frame(KIND_ERROR, {'error': str(e)}))
+            except OSError:
+                pass
+            return
+        subscription = _ConnectionSubscription(reader)
+        backlog = reader.add_subscriber(subscription, since)
+        try:
+            self.request.sendall(encode_frame(KIND_REPLY, {}))
+            for entry in backlog:
+                self.request.sendall(encode_frame(KIND_ENTRY, _entry_to_wire(entry)))
+            last_seq = backlog[-1].seq if backlog else 0
+            while True:
+                try:
+                    entry = subscription.queue.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # Nothing to send; an empty REPLY doubles as a keepalive and
+                    # tells us whether the client is still there
+                    self.request.sendall(encode_frame(KIND_REPLY, {}))
+                    continue
+                if entry is None:
+                    self.request.sendall(encode_frame(KIND_END, {}))
+                    return
+                if entry.seq <= last_seq:
+                    continue
+                last_seq = entry.seq
+                self.request.sendall(encode_frame(KIND_ENTRY, _entry_to_wire(entry)))
+        except OSError:
+            pass  # client went away
+        finally:
+            subscription.close()
+
+
+    def _stream_triggers(self):
+        # Pushes [event, info] ENTRY frames for fired stream-action triggers
+        subscription = _ConnectionSubscription(get_trigger_engine())
+        subscription.source.add_subscriber(subscription)
+        try:
+            self.request.sendall(encode_frame(KIND_REPLY, {}))
+            while True:
+                try:
+                    item = subscription.queue.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    self.request.sendall(encode_frame(KIND_REPLY, {}))
+                    continue
+                self.request.sendall(encode_frame(KIND_ENTRY, list(item)))
+        except OSError:
+            pass  # client went away
+        finally:
+            subscription.close()
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, backend=None):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # left over from a previous run
+        self.backend = backend or LocalBackend()
+        super().__init__(socket_path, _BrokerHandler)
+        os.chmod(socket_path, 0o660)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+# --- Web worker side ---
+
+class BrokerClient:
+    """Backend that forwards fetch/write/stream to the broker process.
+
+    Each thread keeps its own connection open between calls; streams get a
+    dedicated connection each.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as e:
+            sock.close()
+            raise BrokerError(f'Serial broker not reachable at {self.socket_path}: {e}')
+        return sock
+
+    def _call(self, kind, body, timeout, retry=True):
+        # Retry once on a fresh connection in case the cached one went stale.
+        # Writes don't retry: the first attempt may have reached the device.
+        for attempt in ((0, 1) if retry else (1,)):
+            sock = getattr(self._local, 'sock', None)
+            if sock is None:
+                sock = self._local.sock = self._connect()
+            sock.settimeout(timeout)
+            try:
+                sock.sendall(encode_frame(kind, body))
+                reply_kind, reply = recv_frame(sock)
+                break
+            except (ConnectionError, OSError) as e:
+                sock.close()
+                self._local.sock = None
+                if attempt:
+                    raise BrokerError(f'Lost connection to the serial broker: {e}')
+        if reply_kind == KIND_ERROR:
+            raise BrokerError(reply['error'])
+        return reply
+
+    def fetch(self, full_port, since, limit, wait=0):
+        result = self._call(KIND_FETCH, {'port': full_port, 'since': since, 'limit': limit, 'wait': wait}, wait + 10)
+        result['entries'] = [_entry_from_wire(item) for item in result['entries']]
+        return result
+
+    def fetch_many(self, cursors, limit, wait=0):
+        results = self._call(KIND_FETCH_MANY, {'cursors': cursors, 'limit': limit, 'wait': wait}, wait + 10)
+        for result in results.values():
+            result['entries'] = [_entry_from_wire(item) for item in result['entries']]
+        return results
+
+    async def _acall(self, kind, body, timeout):
+        # A fresh connection per call, so a long-poll waits on the event loop
+        # instead of holding one of its executor threads
+        try:
+            stream, writer = await asyncio.open_unix_connection(self.socket_path)
+        except OSError as e:
+            raise BrokerError(f'Serial broker not reachable at {self.socket_path}: {e}')
+        try:
+            writer.write(encode_frame(kind, body))
+            reply_kind, reply = await asyncio.wait_for(read_frame(stream), timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError) as e:
+            raise BrokerError(f'Lost connection to the serial broker: {e!r}')
+        finally:
+            writer.close()
+        if reply_kind == KIND_ERROR:
+            raise BrokerError(reply['error'])
+        return reply
+
+    async def poll(self, full_port, since, limit, wait=0):
+        result = await self._acall(KIND_FETCH, {'port': full_port, 'since': since, 'limit': limit, 'wait': wait}, wait + 10)
+        result['entries'] = [_entry_from_wire(item) for item in result['entries']]
+        return result
+
+    async def poll_many(self, cursors, limit, wait=0):
+        results = await self._acall(KIND_FETCH_MANY, {'cursors': cursors, 'limit': limit, 'wait': wait}, wait + 10)
+        for result in results.values():
+            result['entries'] = [_entry_from_wire(item) for item in result['entries']]
+        return results
+
+    def write(self, full_port, chunks):
+        # latin-1 maps bytes 0-255 to code points one to one, so any bytes survive JSON
+        chunks = [chunk.decode('latin-1') for chunk in chunks]
+        return self._call(KIND_WRITE, {'port': full_port, 'chunks': chunks}, 10, retry=False)
+
+    def command(self, full_port, requests, timeout):
+        commands = [
+            {'chunks': [chunk.decode('latin-1') for chunk in chunks], 'match': matcher.to_spec()}
+            for chunks, matcher in requests
+        ]
+        body = {'port': full_port, 'commands': commands, 'timeout': timeout}
+        return _replies_from_wire(self._call(KIND_COMMAND, body, timeout + 10, retry=False))
+
+    async def acommand(self, full_port, requests, timeout):
+        commands = [
+            {'chunks': [chunk.decode('latin-1') for chunk in chunks], 'match': matcher.to_spec()}
+            for chunks, matcher in requests
+        ]
+        body = {'port': full_port, 'commands': commands, 'timeout': timeout}
+        return _replies_from_wire(await self._acall(KIND_COMMAND, body, timeout + 10))
+
+    def record(self, full_port, action):
+        # The capture file is written by the broker, on the broker's host
+        return self._call(KIND_RECORD, {'port': full_port, 'action': action}, 10, retry=False)
+
+    def port_status(self, full_port=None):
+        return self._call(KIND_STATUS, {'port': full_port}, 10)['ports']
+
+    def metrics(self):
+        """Return the broker's metrics in Prometheus text format."""
+        return self._call(KIND_METRICS, {}, 10)['text']
+
+    async def stream(self, full_port, since=None, raw=False):
+        return event_stream(await self.stream_entries(full_port, since), raw)
+
+    async def stream_entries(self, full_port, since=None):
+        try:
+            stream, writer = await asyncio.open_unix_connection(self.socket_path)
+        except OSError as e:
+            raise BrokerError(f'Serial broker not reachable at {self.socket_path}: {e}')
+        writer.write(encode_frame(KIND_SUBSCRIBE, {'port': full_port, 'since': since}))
+        kind, reply = await read_frame(stream)
+        if kind == KIND_ERROR:
+            writer.close()
+            raise BrokerError(reply['error'])
+        return self._entries(stream, writer)
+
+    async def trigger_events(self):
+        try:
+            stream, writer = await asyncio.open_unix_connection(self.socket_path)
+        except OSError as e:
+            raise BrokerError(f'Serial broker not reachable at {self.socket_path}: {e}')
+        writer.write(encode_frame(KIND_SUBSCRIBE_TRIGGERS, {}))
+        await read_frame(stream)
+        return self._items(stream, writer)
+
+    async def _items(self, stream, writer):
+        try:
+            while True:
+                try:
+                    kind, body = await read_frame(stream)
+                except asyncio.IncompleteReadError:
+                    return
+                if kind == KIND_ENTRY:
+                    yield tuple(body)
+                elif kind == KIND_REPLY:
+                    yield None  # keepalive
+                else:
+                    return
+        finally:
+            writer.close()
+
+    async def _entries(self, stream, writer):
+        try:
+            while True:
+                try:
+                    kind, body = await read_frame(stream)
+                except asyncio.IncompleteReadError:
+                    return
+                if kind == KIND_ENTRY:
+                    yield _entry_from_wire(body)
+                elif kind == KIND_REPLY:
+                    yield None  # keepalive
+                else:
+                    return
+        finally:
+            writer.close()
+
+
+_backend = None
+
+
+def get_backend():
+    """Return the backend the views should use: the broker if one is configured, else this process."""
+    global _backend
+    if _backend is None:
+        _backend = BrokerClient(BROKER_SOCKET) if BROKER_SOCKET else LocalBackend()
+    return _backend
@@ -0,0 +1,124 @@
+"""Record raw serial sessions to capture files, and play them back.
+
+A capture file is the magic line, a JSON header line, then one record per
+read from the port:
+
+    8 bytes  arrival time (float64, epoch seconds)
+    4 bytes  length of the data
+    data     the bytes exactly as the driver returned them
+
+all little-endian. Playing a capture back through a virtual device (see the
+serialreplay command) reproduces the session byte for byte, framing and
+timing included.
+"""
+import json
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+
+from .history import port_dir_name
+
+# Where recordings started over HTTP are written
+CAPTURE_DIR = getattr(settings, 'SERIAL_CAPTURE_DIR', settings.BASE_DIR / 'captures')
+
+MAGIC = b'SERIALCAP1\n'
+RECORD_HEADER = struct.Struct('<dI')
+
+
+class CaptureWriter:
+    """Appends reads to a capture file; write() is called from the port's reader thread."""
+
+    def __init__(self, path, full_port):
+        self.path = str(path)
+        self.full_port = full_port
+        self.started = time.time()
+        self.bytes = 0
+        self.chunks = 0
+        self.lock = threading.Lock()
+        self.file = open(self.path, 'wb')
+        header = {'port': full_port, 'started': self.started}
+        self.file.write(MAGIC + json.dumps(header).encode('utf-8') + b'\n')
+
+    def write(self, timestamp, data):
+        with self.lock:
+            if self.file is None:
+                return  # stopped meanwhile
+            self.file.write(RECORD_HEADER.pack(timestamp, len(data)))
+            self.file.write(data)
+            self.bytes += len(data)
+            self.chunks += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def status(self):
+        return {
+            'recording': self.file is not None,
+            'path': self.path,
+            'started': self.started,
+            'bytes': self.bytes,
+            'chunks': self.chunks,
+        }
+
+
+def capture_path(full_port):
+    os.makedirs(CAPTURE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    return os.path.join(CAPTURE_DIR, f'{port_dir_name(full_port)}-{stamp}.cap')
+
+
+def open_capture(path):
+    """Return (header, records) for a capture file; records yields (timestamp, data)."""
+    f = open(path, 'rb')
+    if f.readline() != MAGIC:
+        f.close()
+        raise ValueError(f'{path} is not a serial capture file')
+    header = json.loads(f.readline())
+
+    def records():
+        with f:
+            while True:
+                head = f.read(RECORD_HEADER.size)
+                if len(head) < RECORD_HEADER.size:
+                    return  # end of file, or a record cut short by a crash
+                timestamp, length = RECORD_HEADER.unpack(head)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield timestamp, data
+
+    return header, records()
+
+
+def replay(records, write, speed=1.0, stop_event=None):
+    """Call write(data) for each record, spaced like the original arrival times divided by speed.
+
+    speed 0 replays as fast as write() allows. Returns (chunks, bytes) written.
+    """
+    chunks = size = 0
+    first = None
+    started = time.monotonic()
+    for timestamp, data in records:
+        if stop_event is not None and stop_event.is_set():
+            break
+        if speed:
+            if first is None:
+                first = timestamp
+            delay = started + (timestamp - first) / speed - time.monotonic()
+            if delay > 0:
+                if stop_event is not None:
+                    if stop_event.wait(delay):
+                        break
+                else:
+                    time.sleep(delay)
+        write(data)
+        chunks += 1
+        size += len(data)
+    return chunks, size
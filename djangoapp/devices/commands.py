@@ -0,0 +1,198 @@
+import asyncio
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import serial
+
+from . import metrics
+
+DEFAULT_TIMEOUT = 2  # seconds to wait for a reply
+MAX_TIMEOUT = 30
+
+
+class CommandTimeout(serial.SerialException):
+    """No matching reply arrived in time."""
+
+
+class ReplyMatcher:
+    """Decides which lines read from the port are the reply to a command.
+
+    The reply starts at the first line that starts with prefix / matches regex
+    (any line if neither is given). Without a terminator that line is the
+    whole reply; with one, lines are collected up to and including the line
+    equal to the terminator (e.g. 'OK'). Binary frames are matched on their
+    latin-1 text.
+    """
+
+    def __init__(self, prefix=None, regex=None, terminator=None):
+        self.prefix = prefix
+        self.regex = re.compile(regex) if regex is not None else None
+        self.terminator = terminator
+
+    @classmethod
+    def from_spec(cls, spec):
+        return cls(spec.get('prefix'), spec.get('regex'), spec.get('terminator'))
+
+    def to_spec(self):
+        return {
+            'prefix': self.prefix,
+            'regex': self.regex.pattern if self.regex is not None else None,
+            'terminator': self.terminator,
+        }
+
+    def starts(self, text):
+        if self.prefix is not None and not text.startswith(self.prefix):
+            return False
+        if self.regex is not None and not self.regex.search(text):
+            return False
+        return True
+
+    def ends(self, text):
+        return self.terminator is None or text == self.terminator
+
+
+class _PendingCommand:
+    def __init__(self, matcher, after_seq):
+        self.matcher = matcher
+        self.after_seq = after_seq  # lines up to this seq were read before the command went out
+        self.lines = []
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+
+
+class CommandChannel:
+    """Matches replies to commands on one port, in the order the commands were sent.
+
+    Any number of commands may be in flight (pipelined). They are written
+    through the port's writer in submission order and wait in a FIFO; every
+    line the reader publishes is offered to the oldest one only, so the n-th
+    reply goes to the n-th command. Lines that don't start a reply (logs,
+    unsolicited output) are passed over. A command that times out leaves the
+    FIFO so the ones behind it can still be answered.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()  # keeps the writes in the order of self.pending
+        self.pending = deque()
+        self.closed = False
+        reader.add_subscriber(self)
+
+    @property
+    def passive(self):
+        # Only commands waiting for their reply keep the port from closing as idle
+        return not self.pending
+
+    def send(self, requests):
+        """Write each (chunks, matcher) request and return their futures, in order.
+
+        A future resolves to (reply lines, round-trip latency in ms).
+        """
+        with self.send_lock:
+            with self.lock:
+                if self.closed:
+                    raise serial.SerialException(f'Serial port {self.reader.full_port} closed')
+                commands = [_PendingCommand(matcher, self.reader.last_seq) for _, matcher in requests]
+                self.pending.extend(commands)
+            # Submit outside self.lock: a write that fails at once (writer stopped,
+            # queue full) runs _written() right here, and _drop() takes the lock
+            for command, (chunks, _) in zip(commands, requests):
+                write = self.reader.writer.submit(chunks)
+                write.add_done_callback(lambda write, command=command: self._written(command, write))
+        return commands
+
+    def _written(self, command, write):
+        error = write.exception()
+        if error is not None:
+            self._drop(command, error)
+
+    def _drop(self, command, error):
+        with self.lock:
+            try:
+                self.pending.remove(command)
+            except ValueError:
+                return  # already answered
+        command.future.set_exception(error)
+
+    def wait(self, command, timeout):
+        try:
+            return command.future.result(timeout)
+        except FutureTimeoutError:
+            self._time_out(command, timeout)
+            return command.future.result(0)
+
+    async def wait_async(self, command, timeout):
+        """wait() for a coroutine: the reply is awaited on the event loop, holding no thread."""
+        loop = asyncio.get_running_loop()
+        answered = asyncio.Event()
+        command.future.add_done_callback(lambda future: _wake(loop, answered))
+        try:
+            await asyncio.wait_for(answered.wait(), timeout)
+        except asyncio.TimeoutError:
+            self._time_out(command, timeout)
+        except asyncio.CancelledError:
+            # The request went away; don't keep the commands behind this one waiting
+            self._drop(command, serial.SerialException('Command cancelled'))
+            raise
+        return command.future.result(0)
+
+    def _time_out(self, command, timeout):
+        self._drop(command, CommandTimeout(f'No reply from {self.reader.full_port} within {timeout:.3g}s'))
+        metrics.command_timeouts.inc(1, self.reader.full_port)
+
+    # Reader subscriber interface (called on the reader thread)
+
+    def publish(self, entry):
+        text = entry.line.decode('latin-1') if isinstance(entry.line, bytes) else entry.line
+        with self.lock:
+            if not self.pending:
+                return
+            command = self.pending[0]
+            if entry.seq <= command.after_seq:
+                return
+            if not command.lines and not command.matcher.starts(text):
+                return
+            command.lines.append(entry.line)
+            if not command.matcher.ends(text):
+                return
+            self.pending.popleft()
+        latency = time.perf_counter() - command.queued_at
+        metrics.command_latency.observe(latency, self.reader.full_port)
+        command.future.set_result((command.lines, latency * 1000))
+
+    def finish(self):
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending)
+            self.pending.clear()
+        for command in pending:
+            command.future.set_exception(serial.SerialException(f'Serial port {self.reader.full_port} closed'))
+        with _channels_lock:
+            if _channels.get(self.reader.full_port) is self:
+                del _channels[self.reader.full_port]
+
+
+def _wake(loop, event):
+    # Called on whichever thread resolved the command
+    try:
+        loop.call_soon_threadsafe(event.set)
+    except RuntimeError:
+        pass  # event loop already closed, the request is gone
+
+
+# full port path -> CommandChannel of the port's current reader
+_channels = {}
+_channels_lock = threading.Lock()
+
+
+def get_channel(reader):
+    with _channels_lock:
+        channel = _channels.get(reader.full_port)
+        if channel is None or channel.reader is not reader:
+            channel = _channels[reader.full_port] = CommandChannel(reader)
+    return channel
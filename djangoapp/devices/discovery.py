@@ -0,0 +1,180 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+import serial.tools.list_ports
+from django.conf import settings
+
+from .streaming import Subscription
+
+logger = logging.getLogger(__name__)
+
+# A device is listed if its path contains any of these
+PORT_PATTERNS = getattr(settings, 'SERIAL_PORT_PATTERNS', ['ttyACM', 'ttyUSB', 'COM'])
+# How long a scan is trusted when /dev can't be watched (or as a safety net when it can)
+DISCOVERY_TTL_SECONDS = getattr(settings, 'SERIAL_DISCOVERY_TTL_SECONDS', 30)
+# udev creates the node before it finishes setting it up; wait this long before rescanning
+RESCAN_DELAY_SECONDS = 0.25
+
+# From <sys/inotify.h>
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def port_metadata(port_info):
+    return {
+        'device': port_info.device,
+        'name': port_info.name,
+        'description': port_info.description,
+        'vid': port_info.vid,
+        'pid': port_info.pid,
+        'serial_number': port_info.serial_number,
+        'manufacturer': port_info.manufacturer,
+        'product': port_info.product,
+        'location': port_info.location,
+    }
+
+
+class PortDiscovery:
+    """Cached inventory of the serial ports on this host.
+
+    comports() walks sysfs, so the result is kept until it goes stale: on Linux
+    an inotify watch on /dev triggers a rescan as soon as a matching node is
+    added or removed, elsewhere the cache simply expires after the TTL. Each
+    rescan is diffed against the previous one and 'added'/'removed' events are
+    pushed to subscribers.
+    """
+
+    def __init__(self, patterns=PORT_PATTERNS, ttl=DISCOVERY_TTL_SECONDS):
+        self.patterns = patterns
+        self.ttl = ttl
+        self.ports = {}  # device path -> metadata dict
+        self.expires = 0
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.watching = False
+        self.scans = 0
+
+    def matches(self, device):
+        return any(pattern in device for pattern in self.patterns)
+
+    def list_ports(self):
+        """Return the metadata of every matching port, rescanning only if stale."""
+        if time.monotonic() >= self.expires:
+            self.rescan()
+        return sorted(self.ports.values(), key=lambda info: info['device'])
+
+    def get(self, device):
+        self.list_ports()
+        return self.ports.get(device)
+
+    def rescan(self):
+        with self.lock:
+            found = {
+                port_info.device: port_metadata(port_info)
+                for port_info in serial.tools.list_ports.comports()
+                if self.matches(port_info.device)
+            }
+            added = [found[device] for device in found.keys() - self.ports.keys()]
+            removed = [self.ports[device] for device in self.ports.keys() - found.keys()]
+            self.ports = found
+            self.expires = time.monotonic() + self.ttl
+            self.scans += 1
+            subscribers = list(self.subscribers)
+        for event, infos in (('added', added), ('removed', removed)):
+            for info in infos:
+                logger.info("Serial port %s: %s", event, info['device'])
+                for subscription in subscribers:
+                    subscription.publish((event, info))
+
+    def invalidate(self):
+        self.expires = 0
+
+    def subscribe(self, loop):
+        subscription = Subscription(self, loop)
+        with self.lock:
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def start_watching(self, path='/dev'):
+        """Watch path with inotify and rescan when a matching node appears or goes away.
+
+        Returns False (and leaves the TTL as the only refresh) where inotify is unavailable.
+        """
+        if self.watching or not sys.platform.startswith('linux'):
+            return self.watching
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+            if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), f'inotify_add_watch {path} failed')
+        except (OSError, AttributeError, TypeError) as e:
+            logger.warning("Can't watch %s for serial ports, falling back to a %ss cache: %s", path, self.ttl, e)
+            return False
+        self.watching = True
+        threading.Thread(target=self._watch, args=(fd,), name='serial-discovery', daemon=True).start()
+        return True
+
+    def _watch(self, fd):
+        while True:
+            select.select([fd], [], [])
+            changed = False
+            # Collect everything that arrives in a short window into one rescan
+            deadline = time.monotonic() + RESCAN_DELAY_SECONDS
+            while True:
+                try:
+                    data = os.read(fd, 4096)
+                except BlockingIOError:
+                    data = b''
+                offset = 0
+                while offset < len(data):
+                    _, _, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+                    offset += _EVENT_HEADER.size
+                    name = data[offset:offset + name_len].rstrip(b'\0').decode(errors='ignore')
+                    offset += name_len
+                    if self.matches(name):
+                        changed = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                select.select([fd], [], [], remaining)
+            if changed:
+                try:
+                    self.rescan()
+                except Exception as e:
+                    logger.error("Error rescanning serial ports: %s", e)
+                    self.invalidate()
+
+
+_discovery = None
+_discovery_lock = threading.Lock()
+
+
+def get_discovery():
+    """Return the process-wide discovery service, starting the /dev watch on first use."""
+    global _discovery
+    if _discovery is None:
+        with _discovery_lock:
+            if _discovery is None:
+                discovery = PortDiscovery()
+                discovery.start_watching()
+                _discovery = discovery
+    return _discovery
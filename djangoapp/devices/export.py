@@ -0,0 +1,108 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .framing import frame_to_text
+from .history import HISTORY_BACKEND, get_store
+from .models import SerialOutput
+
+# Rows fetched from the DB per round trip
+EXPORT_CHUNK_SIZE = getattr(settings, 'SERIAL_EXPORT_CHUNK_SIZE', 2000)
+# Output is handed to the server in pieces of about this many bytes
+EXPORT_BUFFER_BYTES = 64 * 1024
+
+_encode_json = json.JSONEncoder(separators=(',', ':')).encode
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def iter_history(full_port, start=None, end=None):
+    """Yield (seq, timestamp, line) for a port between start and end, oldest first, without loading them all."""
+    if HISTORY_BACKEND == 'segments':
+        yield from get_store().iter_range(full_port, start, end)
+        return
+    rows = SerialOutput.objects.filter(port__port=full_port)
+    if start is not None:
+        rows = rows.filter(timestamp__gte=datetime.fromtimestamp(start, tz=timezone.utc))
+    if end is not None:
+        rows = rows.filter(timestamp__lte=datetime.fromtimestamp(end, tz=timezone.utc))
+    rows = rows.order_by('timestamp', 'id').values_list('id', 'timestamp', 'output', 'data')
+    # iterator() streams from the cursor instead of caching the whole queryset
+    for row_id, timestamp, output, data in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield row_id, timestamp.timestamp(), bytes(data) if data is not None else output
+
+
+def _ndjson_records(rows):
+    for seq, timestamp, line in rows:
+        record = {'seq': seq, 'timestamp': timestamp, 'line': frame_to_text(line)}
+        if isinstance(line, bytes):
+            record['encoding'] = 'base64'
+        yield _encode_json(record) + '\n'
+
+
+def _csv_records(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['seq', 'timestamp', 'line', 'encoding'])
+    for seq, timestamp, line in rows:
+        writer.writerow([seq, repr(timestamp), frame_to_text(line), 'base64' if isinstance(line, bytes) else ''])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_chunks(rows, fmt='ndjson', compress=False):
+    """Turn rows into the bytes of an NDJSON or CSV export, optionally gzipped.
+
+    Records are gathered into pieces of about EXPORT_BUFFER_BYTES so the
+    server isn't handed one tiny write per row; memory stays bounded by that
+    and by the DB fetch size no matter how long the export is.
+    """
+    records = _csv_records(rows) if fmt == 'csv' else _ndjson_records(rows)
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits 31: gzip container
+    pending = []
+    size = 0
+    for record in records:
+        pending.append(record)
+        size += len(record)
+        if size >= EXPORT_BUFFER_BYTES:
+            data = ''.join(pending).encode('utf-8')
+            pending = []
+            size = 0
+            if gzip is not None:
+                data = gzip.compress(data)
+            if data:
+                yield data
+    data = ''.join(pending).encode('utf-8')
+    if gzip is not None:
+        data = gzip.compress(data) + gzip.flush()
+    if data:
+        yield data
+
+
+async def aiter_chunks(chunks):
+    """Serve a blocking chunk iterator from an async response.
+
+    Under ASGI, Django 4.2 reads a synchronous streaming body into memory in
+    one go before sending it, so the export is pulled one chunk at a time
+    through sync_to_async instead. thread_sensitive keeps every step on the
+    same thread, which the DB cursor behind iterator() requires.
+    """
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    try:
+        while True:
+            chunk = await next_chunk(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close, thread_sensitive=True)()
@@ -0,0 +1,212 @@
+import base64
+import binascii
+import struct
+import zlib
+
+MAX_LINE_BYTES = 64 * 1024  # a line longer than this is cut and emitted as is
+
+
+class LineFramer:
+    """Splits a byte stream into lines, carrying partial lines across reads.
+
+    feed() takes whatever chunk the port returned and gives back the complete
+    lines in it (without the delimiter); an unfinished tail waits in a
+    bytearray until the rest of it arrives in a later chunk.
+
+    binary tells the reader what to do with the frames: text framers' frames
+    are decoded to str, binary framers' frames are kept as bytes.
+    """
+    binary = False
+
+    def __init__(self, delimiter=b'\n', max_line=MAX_LINE_BYTES):
+        self.delimiter = delimiter
+        self.max_line = max_line
+        self.pending = bytearray()
+        self.oversized = 0  # lines cut because they exceeded max_line
+        self.errors = 0  # frames dropped as malformed (binary framers)
+
+    def feed(self, data):
+        self.pending += data
+        end = self.pending.rfind(self.delimiter)
+        if end < 0:
+            if len(self.pending) > self.max_line:
+                self.oversized += 1
+                line = bytes(self.pending)
+                self.pending.clear()
+                return [line]
+            return []
+        lines = self.pending[:end].split(self.delimiter)
+        del self.pending[:end + len(self.delimiter)]
+        return lines
+
+
+def cobs_decode(data):
+    """Undo Consistent Overhead Byte Stuffing on one frame (without its 0x00 delimiter)."""
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        code = data[i]
+        end = i + code
+        if code == 0 or end > n:
+            raise ValueError('Invalid COBS frame')
+        out += data[i + 1:end]
+        i = end
+        if code < 0xFF and i < n:
+            out.append(0)
+    return bytes(out)
+
+
+def cobs_encode(data):
+    """COBS-encode one frame; the caller appends the 0x00 delimiter."""
+    out = bytearray()
+    for block in data.split(b'\0'):
+        # A block longer than 254 bytes is cut into 0xFF-coded pieces with no zero after them
+        while len(block) >= 0xFE:
+            out.append(0xFF)
+            out += block[:0xFE]
+            block = block[0xFE:]
+        out.append(len(block) + 1)
+        out += block
+    return bytes(out)
+
+
+class COBSFramer(LineFramer):
+    """COBS-encoded frames, each terminated by a 0x00 byte."""
+    binary = True
+
+    def __init__(self, max_line=MAX_LINE_BYTES):
+        super().__init__(delimiter=b'\0', max_line=max_line)
+
+    def feed(self, data):
+        frames = []
+        for frame in self._split(data):
+            try:
+                frames.append(cobs_decode(frame))
+            except ValueError:
+                self.errors += 1
+        return frames
+
+    def _split(self, data):
+        if len(self.pending) + len(data) > self.max_line and self.delimiter not in data:
+            # A frame that long is garbage (or we joined mid-frame); drop it
+            self.oversized += 1
+            self.pending.clear()
+            return []
+        return [frame for frame in LineFramer.feed(self, data) if frame]
+
+
+SLIP_END = 0xC0  # escaped as 0xDB 0xDC; 0xDB itself as 0xDB 0xDD
+
+
+def slip_encode(data):
+    return (bytes([SLIP_END])
+            + data.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc')
+            + bytes([SLIP_END]))
+
+
+class SLIPFramer(COBSFramer):
+    """SLIP (RFC 1055) frames, delimited by 0xC0 with 0xDB escapes."""
+
+    def __init__(self, max_line=MAX_LINE_BYTES):
+        LineFramer.__init__(self, delimiter=bytes([SLIP_END]), max_line=max_line)
+
+    def feed(self, data):
+        # ESC ESC_END and ESC ESC_ESC never overlap, so two replaces unescape the frame
+        return [
+            frame.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb')
+            for frame in self._split(data)
+        ]
+
+
+# CRCs for the length-prefixed framer: name -> (size in bytes, function)
+CRCS = {
+    'crc16': (2, lambda data: binascii.crc_hqx(data, 0xFFFF)),  # CRC-16/CCITT-FALSE
+    'crc32': (4, zlib.crc32),
+    None: (0, None),
+}
+_LENGTH_FORMATS = {1: '>B', 2: '>H', 4: '>I'}
+
+
+class LengthPrefixFramer(LineFramer):
+    """Frames sent as a big-endian length, the payload and a big-endian CRC of the payload.
+
+    A frame whose CRC does not match (or whose length is over max_line) is
+    taken to be a false start: one byte is skipped and the search for the
+    next frame header resumes there.
+    """
+    binary = True
+
+    def __init__(self, length_bytes=2, crc='crc16', max_line=MAX_LINE_BYTES):
+        super().__init__(delimiter=b'', max_line=max_line)
+        self.length = struct.Struct(_LENGTH_FORMATS[length_bytes])
+        self.crc_size, self.crc = CRCS[crc]
+
+    def feed(self, data):
+        pending = self.pending
+        pending += data
+        frames = []
+        offset = 0
+        header = self.length.size
+        while len(pending) - offset >= header:
+            (length,) = self.length.unpack_from(pending, offset)
+            if length > self.max_line:
+                self.oversized += 1
+                offset += 1
+                continue
+            end = offset + header + length + self.crc_size
+            if end > len(pending):
+                break  # rest of the frame hasn't arrived yet
+            payload = bytes(pending[offset + header:offset + header + length])
+            if self.crc is not None:
+                expected = int.from_bytes(pending[end - self.crc_size:end], 'big')
+                if self.crc(payload) != expected:
+                    self.errors += 1
+                    offset += 1
+                    continue
+            frames.append(payload)
+            offset = end
+        del pending[:offset]
+        return frames
+
+    def encode(self, payload):
+        crc = self.crc(payload).to_bytes(self.crc_size, 'big') if self.crc is not None else b''
+        return self.length.pack(len(payload)) + payload + crc
+
+
+def make_framer(config=None):
+    """Return a framer per a SERIAL_FRAMING entry, e.g. {'mode': 'cobs'}; None means newline text."""
+    config = config or {}
+    mode = config.get('mode', 'line')
+    max_line = config.get('max_frame', MAX_LINE_BYTES)
+    if mode == 'line':
+        return LineFramer(config.get('delimiter', '\n').encode('utf-8'), max_line)
+    if mode == 'cobs':
+        return COBSFramer(max_line)
+    if mode == 'slip':
+        return SLIPFramer(max_line)
+    if mode == 'length':
+        return LengthPrefixFramer(config.get('length_bytes', 2), config.get('crc', 'crc16'), max_line)
+    raise ValueError(f'Unknown framing mode {mode!r}')
+
+
+FRAME_ENCODINGS = ('base64', 'hex')
+
+
+def frame_to_text(line, encoding='base64'):
+    """Return line for JSON: text lines as they are, binary frames as base64 or hex."""
+    if isinstance(line, str):
+        return line
+    if encoding == 'hex':
+        return line.hex()
+    return base64.b64encode(line).decode('ascii')
+
+
+def frame_from_text(text, encoding):
+    """Inverse of frame_to_text for a binary frame; raises ValueError on bad input."""
+    if encoding == 'hex':
+        return bytes.fromhex(text)
+    try:
+        return base64.b64decode(text, validate=True)
+    except binascii.Error as e:
+        raise ValueError(f'Invalid base64: {e}')
@@ -0,0 +1,253 @@
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from bisect import bisect_left
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Where read lines are kept: 'db' (SerialOutput rows, pruned by retention.py)
+# or 'segments' (append-only files below, for long histories)
+HISTORY_BACKEND = getattr(settings, 'SERIAL_HISTORY_BACKEND', 'db')
+# Directory holding one sub-directory of segment files per port
+HISTORY_DIR = Path(getattr(settings, 'SERIAL_HISTORY_DIR', settings.BASE_DIR / 'history'))
+# A segment is sealed and a new one started once it reaches this size
+SEGMENT_BYTES = getattr(settings, 'SERIAL_HISTORY_SEGMENT_BYTES', 16 * 1024 * 1024)
+# Compress sealed segments with zlib (reads then inflate the segment instead of mapping it)
+COMPRESS_SEALED = getattr(settings, 'SERIAL_HISTORY_COMPRESS', True)
+# Oldest segments beyond this many per port are deleted; None keeps everything
+MAX_SEGMENTS = getattr(settings, 'SERIAL_HISTORY_MAX_SEGMENTS', None)
+# One sparse index entry is written every this many records
+INDEX_EVERY = 256
+
+# Record: seq (u64), timestamp (f64), payload length (u32), then the payload:
+# UTF-8 text, or the raw frame when the top bit of the length is set
+RECORD_HEADER = struct.Struct('<QdI')
+BINARY_FLAG = 0x80000000
+# Sparse index entry: seq (u64), timestamp (f64), byte offset of the record (u64)
+INDEX_ENTRY = struct.Struct('<QdQ')
+
+SEGMENT_SUFFIX = '.seg'
+SEALED_SUFFIX = '.seg.z'
+INDEX_SUFFIX = '.idx'
+
+
+def port_dir_name(full_port):
+    return re.sub(r'[^A-Za-z0-9.-]', '_', full_port.strip('/'))
+
+
+class _ActiveSegment:
+    def __init__(self, path):
+        self.path = path
+        self.data = open(path, 'ab')
+        self.index = open(path.with_suffix(INDEX_SUFFIX), 'ab')
+        self.size = self.data.tell()
+        self.records = 0
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class SegmentStore:
+    """Append-only per-port history kept in segment files.
+
+    Each port has a directory of segments named after the time of their first
+    record (seqs restart with the process, timestamps don't). The
+    writer appends records to the active segment and, every INDEX_EVERY
+    records, an entry to the segment's sparse .idx file. Full segments are
+    sealed (and optionally zlib-compressed) and a new one is started.
+
+    Reads only look at files, so any process on the host (web workers as well
+    as the broker that writes) can query: the sparse indexes pick the
+    segments and the starting offset for a time range, and the active
+    segment is read through mmap.
+    """
+
+    def __init__(self, root=HISTORY_DIR, segment_bytes=SEGMENT_BYTES, compress=COMPRESS_SEALED,
+                 max_segments=MAX_SEGMENTS):
+        self.root = Path(root)
+        self.segment_bytes = segment_bytes
+        self.compress = compress
+        self.max_segments = max_segments
+        self.active = {}  # full port path -> _ActiveSegment
+        self.lock = threading.Lock()
+
+    # --- Writing (single writer thread) ---
+
+    def append(self, full_port, entries):
+        """Append (seq, timestamp, line) entries for one port, in seq order."""
+        with self.lock:
+            segment = self.active.get(full_port)
+            for entry in entries:
+                if segment is None:
+                    segment = self._start_segment(full_port, entry.timestamp)
+                if isinstance(entry.line, bytes):
+                    payload = entry.line
+                    length = len(payload) | BINARY_FLAG
+                else:
+                    payload = entry.line.encode('utf-8')
+                    length = len(payload)
+                if segment.records % INDEX_EVERY == 0:
+                    segment.index.write(INDEX_ENTRY.pack(entry.seq, entry.timestamp, segment.size))
+                segment.data.write(RECORD_HEADER.pack(entry.seq, entry.timestamp, length))
+                segment.data.write(payload)
+                segment.size += RECORD_HEADER.size + len(payload)
+                segment.records += 1
+                if segment.size >= self.segment_bytes:
+                    self._seal(full_port, segment)
+                    segment = None
+            if segment is not None:
+                # Make the batch visible to readers in other threads/processes
+                segment.data.flush()
+                segment.index.flush()
+
+    def _start_segment(self, full_port, first_timestamp):
+        directory = self.root / port_dir_name(full_port)
+        directory.mkdir(parents=True, exist_ok=True)
+        segment = _ActiveSegment(directory / f'{int(first_timestamp * 1e6):020d}{SEGMENT_SUFFIX}')
+        self.active[full_port] = segment
+        return segment
+
+    def _seal(self, full_port, segment):
+        logger.info("Sealing history segment %s (%d bytes)", segment.path, segment.size)
+        segment.close()
+        del self.active[full_port]
+        if self.compress:
+            sealed = segment.path.with_name(segment.path.stem + SEALED_SUFFIX)
+            tmp = sealed.with_name(sealed.name + '.tmp')
+            tmp.write_bytes(zlib.compress(segment.path.read_bytes(), 6))
+            os.replace(tmp, sealed)
+            segment.path.unlink()
+        if self.max_segments is not None:
+            for old in self._segments(full_port)[:-self.max_segments]:
+                old['path'].unlink(missing_ok=True)
+                old['path'].with_name(old['name'] + INDEX_SUFFIX).unlink(missing_ok=True)
+
+    def close(self):
+        with self.lock:
+            for segment in self.active.values():
+                segment.close()
+            self.active.clear()
+
+    # --- Reading (any thread or process) ---
+
+    def _segments(self, full_port):
+        directory = self.root / port_dir_name(full_port)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        segments = []
+        for filename in names:
+            for suffix in (SEALED_SUFFIX, SEGMENT_SUFFIX):
+                if filename.endswith(suffix):
+                    name = filename[:-len(suffix)]
+                    segments.append({
+                        'name': name,
+                        'path': directory / filename,
+                        'compressed': suffix == SEALED_SUFFIX,
+                    })
+                    break
+        segments.sort(key=lambda segment: segment['name'])
+        return segments
+
+    @staticmethod
+    def _read_index(path):
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return []
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        return [INDEX_ENTRY.unpack_from(data, offset) for offset in range(0, usable, INDEX_ENTRY.size)]
+
+    def query(self, full_port, start=None, end=None, limit=1000, after=None):
+        """Return up to limit (seq, timestamp, line) entries with start <= timestamp <= end.
+
+        Entries at exactly start with a seq up to after are skipped, which lets
+        a caller resume from the last entry it got. Also returns whether the
+        result was cut short by limit.
+        """
+        results = list(islice(self.iter_range(full_port, start, end, after), limit + 1))
+        return results[:limit], len(results) > limit
+
+    def iter_range(self, full_port, start=None, end=None, after=None):
+        """Yield the entries with start <= timestamp <= end, oldest first, one segment at a time."""
+        from .readers import Entry
+
+        segments = self._segments(full_port)
+        indexes = [self._read_index(segment['path'].with_name(segment['name'] + INDEX_SUFFIX)) for segment in segments]
+        for i, (segment, index) in enumerate(zip(segments, indexes)):
+            if not index:
+                continue
+            # A segment ends where the next one begins
+            next_first_ts = next((later[0][1] for later in indexes[i + 1:] if later), None)
+            if start is not None and next_first_ts is not None and next_first_ts < start:
+                continue
+            if end is not None and index[0][1] > end:
+                return
+            # Start at the last indexed record before start
+            offset = 0
+            if start is not None:
+                position = bisect_left([entry[1] for entry in index], start) - 1
+                if position > 0:
+                    offset = index[position][2]
+            for seq, timestamp, line in self._scan(segment, offset):
+                if start is not None and (timestamp < start or (
+                        timestamp == start and after is not None and seq <= after)):
+                    continue
+                if end is not None and timestamp > end:
+                    return
+                yield Entry(seq, timestamp, line)
+
+    def _scan(self, segment, offset):
+        if segment['compressed']:
+            yield from self._parse(memoryview(zlib.decompress(segment['path'].read_bytes())), offset)
+            return
+        try:
+            with open(segment['path'], 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    return
+                with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    try:
+                        yield from self._parse(view, offset)
+                    finally:
+                        view.release()
+        except FileNotFoundError:
+            return  # sealed (renamed) while we were looking
+
+    @staticmethod
+    def _parse(data, offset):
+        end = len(data)
+        while offset + RECORD_HEADER.size <= end:
+            seq, timestamp, length = RECORD_HEADER.unpack_from(data, offset)
+            binary = length & BINARY_FLAG
+            length &= ~BINARY_FLAG
+            start = offset + RECORD_HEADER.size
+            if start + length > end:
+                return  # record still being written
+            payload = bytes(data[start:start + length])
+            yield seq, timestamp, payload if binary else payload.decode('utf-8', errors='replace')
+            offset = start + length
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SegmentStore()
+    return _store
@@ -0,0 +1,270 @@
+"""Port lifecycle: idle eviction, reconnect with backoff, and a cap on open ports.
+
+Readers report opens, failures and closes here; ensure_reader() asks before
+opening a port. A background sweep closes ports nobody used for
+SERIAL_IDLE_TIMEOUT seconds and retries ports that went away, backing off
+exponentially between attempts. A USB port is remembered by its serial
+number, so when the adapter comes back under another /dev path it is
+reopened there under its original name.
+"""
+import logging
+import threading
+import time
+
+import serial
+from django.conf import settings
+
+from . import metrics
+from .discovery import get_discovery
+
+logger = logging.getLogger(__name__)
+
+# Close a port after this many seconds without a request, stream or
+# recording using it; None keeps ports open until the process exits
+IDLE_TIMEOUT = getattr(settings, 'SERIAL_IDLE_TIMEOUT', None)
+# At most this many ports open at once; opening another one closes the least
+# recently used idle port first. None for no limit.
+MAX_OPEN_PORTS = getattr(settings, 'SERIAL_MAX_OPEN_PORTS', None)
+# Delay before the first reconnect attempt, doubled after each failure up to the max
+RECONNECT_MIN_SECONDS = getattr(settings, 'SERIAL_RECONNECT_MIN_SECONDS', 0.5)
+RECONNECT_MAX_SECONDS = getattr(settings, 'SERIAL_RECONNECT_MAX_SECONDS', 30)
+SWEEP_SECONDS = 1
+FORGET_SECONDS = 3600  # closed ports unused this long drop out of the status
+
+
+class PortState:
+    """What the manager knows about one port, whether it is open or not."""
+
+    def __init__(self, full_port):
+        self.full_port = full_port
+        self.device = full_port  # what is actually opened; changes if a USB adapter is renumbered
+        self.serial_number = None  # USB serial number, while the port is to be reconnected
+        self.state = 'closed'  # opening, open, reconnecting, failed, closed
+        self.reason = None  # why it was closed: idle, evicted, stopped
+        self.last_used = time.monotonic()
+        self.opened_at = None
+        self.opens = 0
+        self.failures = 0  # consecutive failed (re)connects
+        self.next_attempt = None
+        self.last_error = None
+
+    def status(self, now):
+        return {
+            'port': self.full_port,
+            'device': self.device,
+            'serial_number': self.serial_number,
+            'state': self.state,
+            'reason': self.reason,
+            'idle_seconds': round(now - self.last_used, 3),
+            'open_seconds': round(now - self.opened_at, 3) if self.state == 'open' and self.opened_at else None,
+            'opens': self.opens,
+            'failures': self.failures,
+            'next_attempt_seconds': round(max(0, self.next_attempt - now), 3) if self.state == 'reconnecting' else None,
+            'last_error': self.last_error,
+        }
+
+
+class PortLifecycle(threading.Thread):
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, max_open=MAX_OPEN_PORTS):
+        super().__init__(name='serial-lifecycle', daemon=True)
+        self.idle_timeout = idle_timeout
+        self.max_open = max_open
+        self.states = {}  # full port path -> PortState
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def _state(self, full_port):
+        state = self.states.get(full_port)
+        if state is None:
+            state = self.states[full_port] = PortState(full_port)
+        return state
+
+    # Called by the readers
+
+    def touch(self, full_port):
+        with self.lock:
+            self._state(full_port).last_used = time.monotonic()
+
+    def device_for(self, full_port):
+        with self.lock:
+            return self._state(full_port).device
+
+    def check_open(self, full_port):
+        """Raise instead of opening a port that is waiting for its next reconnect attempt.
+
+        A request for a port that just went away then fails at once rather
+        than paying for a doomed open; the sweep does the retrying.
+        """
+        with self.lock:
+            state = self._state(full_port)
+            if state.state == 'reconnecting':
+                wait = state.next_attempt - time.monotonic()
+                if wait > 0:
+                    raise serial.SerialException(
+                        f'{full_port} is disconnected ({state.last_error}); reconnecting in {wait:.1f}s'
+                    )
+
+    def starting(self, full_port):
+        with self.lock:
+            self._state(full_port).state = 'opening'
+
+    def choose_eviction(self, open_readers):
+        """Return the reader to close so another port can open, or None if there is room.
+
+        open_readers maps full port path -> PortReader. Only readers nobody
+        is using right now are candidates; the least recently used goes.
+        """
+        if self.max_open is None or len(open_readers) < self.max_open:
+            return None
+        with self.lock:
+            candidates = [
+                (self._state(full_port).last_used, full_port)
+                for full_port, reader in open_readers.items() if not reader.in_use()
+            ]
+        if not candidates:
+            raise serial.SerialException(f'All {self.max_open} serial port handles are in use')
+        return open_readers[min(candidates)[1]]
+
+    def opened(self, full_port, device):
+        info = get_discovery().get(device) if device.startswith('/dev/') else None
+        with self.lock:
+            state = self._state(full_port)
+            state.state = 'open'
+            state.reason = None
+            state.device = device
+            state.serial_number = info['serial_number'] if info else None
+            state.opened_at = time.monotonic()
+            state.opens += 1
+            state.failures = 0
+            state.last_error = None
+
+    def lost(self, full_port, error):
+        """The port failed while open (unplugged, driver error): schedule a reconnect."""
+        with self.lock:
+            self._backoff(self._state(full_port), error)
+
+    def open_failed(self, full_port, error):
+        """An open failed: back off further if it was a reconnect, else just report the error."""
+        with self.lock:
+            state = self._state(full_port)
+            if state.failures:
+                self._backoff(state, error)
+            else:
+                state.state = 'failed'
+                state.last_error = str(error)
+
+    def _backoff(self, state, error):
+        state.failures += 1
+        state.last_error = str(error)
+        delay = min(RECONNECT_MAX_SECONDS, RECONNECT_MIN_SECONDS * 2 ** (state.failures - 1))
+        state.next_attempt = time.monotonic() + delay
+        state.state = 'reconnecting'
+        logger.info("%s: %s; reconnecting in %.1fs", state.full_port, error, delay)
+
+    def closed(self, full_port, reason):
+        """The port was closed on purpose: forget it until it is asked for again."""
+        with self.lock:
+            state = self._state(full_port)
+            state.state = 'closed'
+            state.reason = reason
+            state.device = full_port
+            state.serial_number = None
+            state.failures = 0
+        if reason in ('idle', 'evicted'):
+            metrics.port_closes.inc(1, full_port, reason)
+
+    # Background sweep
+
+    def run(self):
+        while not self._stop_event.wait(SWEEP_SECONDS):
+            try:
+                self._sweep()
+            except Exception as e:
+                logger.exception("Error in the port lifecycle sweep: %s", e)
+
+    def _sweep(self):
+        from .readers import readers, start_reader
+
+        now = time.monotonic()
+        if self.idle_timeout is not None:
+            for full_port, reader in list(readers.items()):
+                with self.lock:
+                    last_used = self._state(full_port).last_used
+                if now - last_used > self.idle_timeout and not reader.in_use():
+                    logger.info("Closing %s, idle for %.0fs", full_port, now - last_used)
+                    reader.stop('idle')
+        with self.lock:
+            for full_port, state in list(self.states.items()):
+                if state.state in ('closed', 'failed') and now - state.last_used > FORGET_SECONDS:
+                    del self.states[full_port]
+            due = [
+                state for state in self.states.values()
+                if state.state == 'reconnecting' and state.next_attempt <= now
+            ]
+        for state in due:
+            if self.idle_timeout is not None and now - state.last_used > self.idle_timeout:
+                # Nobody has asked for it in a while; stop trying
+                self.closed(state.full_port, 'idle')
+                continue
+            device = self._locate(state)
+            if device is None:
+                with self.lock:
+                    self._backoff(state, f'USB device {state.serial_number} not present')
+                continue
+            with self.lock:
+                state.device = device
+            logger.info("Reconnecting %s on %s (attempt %d)", state.full_port, device, state.failures + 1)
+            start_reader(state.full_port)
+
+    def _locate(self, state):
+        # Where a USB adapter is now, by its serial number; ports without one are retried where they were
+        if not state.serial_number:
+            return state.device
+        for info in get_discovery().list_ports():
+            if info['serial_number'] == state.serial_number:
+                return info['device']
+        return None
+
+    def status(self, full_port=None):
+        now = time.monotonic()
+        with self.lock:
+            if full_port is not None:
+                state = self.states.get(full_port)
+                return state.status(now) if state is not None else None
+            return [state.status(now) for state in self.states.values()]
+
+    def stop(self):
+        self._stop_event.set()
+        self.join(timeout=SWEEP_SECONDS * 2)
+
+
+def _collect_lifecycle_gauges():
+    if _manager is None:
+        return []
+    with _manager.lock:
+        reconnecting = sum(1 for state in _manager.states.values() if state.state == 'reconnecting')
+    return [('serial_ports_reconnecting', 'Ports waiting to be reconnected', (), [((), reconnecting)])]
+
+
+metrics.registry.add_collector(_collect_lifecycle_gauges)
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_port_manager():
+    """Return the process-wide port lifecycle manager, starting its sweep on first use."""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                manager = PortLifecycle()
+                manager.start()
+                _manager = manager
+    return _manager
+
+
+def stop_port_manager():
+    """Stop the sweep for good, so no port is closed or reconnected while shutting down."""
+    if _manager is not None and _manager.is_alive():
+        _manager.stop()
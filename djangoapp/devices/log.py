@@ -0,0 +1,36 @@
+import logging
+import threading
+import time
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `rate` records per `per` seconds for each message.
+
+    Records are grouped by logger and unformatted message, so a flood of
+    "Error reading from %s" stays bounded while unrelated messages still get
+    through. The next record after a quiet period reports how many were dropped.
+    """
+
+    def __init__(self, rate=10, per=1.0):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.lock = threading.Lock()
+        self.windows = {}  # (logger, msg) -> [window start, records passed, records suppressed]
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.per:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f'{record.msg} ({suppressed} similar messages suppressed)'
+                return True
+            if window[1] < self.rate:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
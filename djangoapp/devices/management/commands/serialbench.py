@@ -0,0 +1,96 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from devices import benchmark, broker
+from devices.persistence import stop_writer
+from devices.readers import LocalBackend
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the serial ingest and serving paths against simulated devices: lines/s, "
+        "read-to-client latency, request latency under concurrent pollers, DB rows/s and memory. "
+        "Runs against a throwaway test database and writes the results as JSON for comparing commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scenario', action='append', choices=sorted(benchmark.SCENARIOS),
+            help='Scenario to run (repeatable; default: all)',
+        )
+        parser.add_argument('--duration', type=float, default=5, help='Seconds per scenario (default 5)')
+        parser.add_argument('--rate', type=int, help='Run a custom scenario: lines per second (0 for as fast as possible)')
+        parser.add_argument('--size', type=int, default=64, help='Custom scenario: bytes per line')
+        parser.add_argument('--pollers', type=int, default=4, help='Custom scenario: concurrent long-polling clients')
+        parser.add_argument('--senders', type=int, default=1, help='Custom scenario: clients posting to /serial/send/')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--compare', metavar='BASELINE', help='Compare with the results in this JSON file')
+        parser.add_argument('--threshold', type=float, default=0.1, help='Relative change counted as a regression (default 0.1)')
+        parser.add_argument('--fail-on-regression', action='store_true', help='Exit with an error if a metric regressed')
+
+    def handle(self, *args, **options):
+        if options['rate'] is not None:
+            scenarios = {'custom': {
+                'rate': options['rate'], 'size': options['size'],
+                'pollers': options['pollers'], 'senders': options['senders'],
+            }}
+        else:
+            names = options['scenario'] or list(benchmark.SCENARIOS)
+            scenarios = {name: benchmark.SCENARIOS[name] for name in names}
+        for params in scenarios.values():
+            if params['size'] < 32:
+                raise CommandError('--size must be at least 32 bytes')
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read {options['compare']}: {e}")
+
+        # The simulated device lives in this process, so serve it from here
+        # even if SERIAL_BROKER_SOCKET is set, and keep the rows out of the real DB
+        broker._backend = LocalBackend()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        results = {
+            'version': benchmark.RESULTS_VERSION,
+            'started': time.time(),
+            'environment': benchmark.environment(),
+            'duration_seconds': options['duration'],
+            'scenarios': {},
+        }
+        try:
+            for name, params in scenarios.items():
+                self.stdout.write(f"Running {name}: {params}")
+                result = benchmark.run_scenario(duration=options['duration'], **params)
+                results['scenarios'][name] = {'params': params, **result}
+                self.stdout.write(
+                    f"  {result['ingest']['lines_per_second']} lines/s, "
+                    f"latency p50 {result['latency_ms']['p50']} ms p99 {result['latency_ms']['p99']} ms, "
+                    f"HTTP p99 {result['http']['p99_ms']} ms, {result['db']['rows_per_second']} rows/s, "
+                    f"RSS {result['memory']['rss_end_mb']} MB"
+                )
+        finally:
+            stop_writer()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        text = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text + '\n')
+            self.stdout.write(f"Results written to {options['output']}")
+        else:
+            self.stdout.write(text)
+
+        if baseline is not None:
+            regressions = 0
+            self.stdout.write(f"Compared with {options['compare']} (commit {baseline.get('environment', {}).get('commit')}):")
+            for name, metric, before, after, change, regressed in benchmark.compare(baseline, results, options['threshold']):
+                regressions += regressed
+                flag = '  REGRESSION' if regressed else ''
+                self.stdout.write(f"  {name:14} {metric:26} {before:>12} -> {after:<12} {change:+.1%}{flag}")
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'{regressions} metrics regressed by more than {options["threshold"]:.0%}')
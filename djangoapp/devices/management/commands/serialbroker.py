@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from devices.broker import BrokerServer
+from devices.lifecycle import stop_port_manager
+from devices.persistence import stop_writer
+from devices.readers import stop_all_readers
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the serial broker: own every serial port in this one process and serve "
+        "reads, writes and streams to the web workers over a Unix socket. "
+        "Point SERIAL_BROKER_SOCKET at the same path in the web workers' settings."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--socket',
+            default=getattr(settings, 'SERIAL_BROKER_SOCKET', None) or '/tmp/serial-broker.sock',
+            help='Unix socket path to listen on (default: SERIAL_BROKER_SOCKET)',
+        )
+
+    def handle(self, *args, **options):
+        server = BrokerServer(options['socket'])
+        self.stdout.write(f"Serial broker listening on {options['socket']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            stop_port_manager()
+            stop_all_readers()
+            stop_writer()
+            self.stdout.write("Serial broker stopped")
@@ -0,0 +1,58 @@
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+
+from devices.capture import open_capture, replay
+from devices.virtual import PtyDevice, SocketDevice
+
+
+class Command(BaseCommand):
+    help = (
+        "Play a capture recorded with POST /serial/record/ back through a virtual serial "
+        "device, byte for byte and with the recorded timing. Point the app at the device "
+        "like at any port, e.g. via SERIAL_VIRTUAL_PORTS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('capture', help='Capture file to play')
+        parser.add_argument(
+            '--speed', type=float, default=1.0,
+            help='Playback speed: 1 as recorded, 10 ten times faster, 0 as fast as the reader takes it',
+        )
+        parser.add_argument('--socket', metavar='HOST:PORT', help='Serve on TCP (open socket://HOST:PORT) instead of a pty')
+        parser.add_argument('--link', help='Symlink to create to the pty, e.g. /tmp/ttyREPLAY')
+        parser.add_argument('--loop', action='store_true', help='Start over when the capture ends')
+
+    def handle(self, *args, **options):
+        if options['speed'] < 0:
+            raise CommandError('--speed must be 0 or more')
+        try:
+            header, _ = open_capture(options['capture'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        if options['socket']:
+            host, _, port = options['socket'].rpartition(':')
+            device = SocketDevice(host or '127.0.0.1', int(port))
+        else:
+            device = PtyDevice(options['link'])
+        self.stdout.write(f"Replaying {options['capture']} (recorded from {header['port']}) on {device.name}")
+        stop_event = threading.Event()
+        try:
+            while True:
+                if not device.opened():
+                    self.stdout.write("Waiting for the port to be opened...")
+                    device.wait_opened(stop_event=stop_event)
+                _, records = open_capture(options['capture'])
+                try:
+                    chunks, size = replay(records, device.write, options['speed'], stop_event)
+                except OSError as e:
+                    # The app closed the port
+                    self.stdout.write(f"Device closed: {e}")
+                    continue
+                self.stdout.write(f"Replayed {size} bytes in {chunks} reads")
+                if not options['loop']:
+                    break
+        except KeyboardInterrupt:
+            stop_event.set()
+        finally:
+            device.close()
@@ -0,0 +1,144 @@
+import math
+import threading
+from bisect import bisect_left
+
+# Default latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}  # label values tuple -> value
+        registry.register(self)
+
+    def _labels(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}')
+        return tuple(str(value) for value in labelvalues)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, *labelvalues):
+        key = self._labels(labelvalues)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, *labelvalues):
+        key = self._labels(labelvalues)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == math.inf else repr(float(bound))
+                    samples.append((f'{self.name}_bucket', labels + (('le', le),), cumulative))
+                samples.append((f'{self.name}_sum', labels, total))
+                samples.append((f'{self.name}_count', labels, count))
+        return samples
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labels):
+    pairs = []
+    for i, value in enumerate(labels):
+        # Histogram buckets append ('le', bound) after the metric's own labels
+        name, value = value if isinstance(value, tuple) else (labelnames[i], value)
+        pairs.append(f'{name}="{_escape(value)}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Registry:
+    """Holds every metric plus collectors that report gauges at scrape time."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector):
+        """collector() returns a list of (name, help, labelnames, [(labels, value), ...]) gauges."""
+        self.collectors.append(collector)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(metric.labelnames, labels)} {_format_value(value)}')
+        for collector in self.collectors:
+            for name, help_text, labelnames, samples in collector():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} gauge')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(labelnames, labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+registry = Registry()
+
+# --- Serial metrics ---
+
+bytes_read = Counter('serial_bytes_read_total', 'Bytes read from the port', ['port'])
+lines_read = Counter('serial_lines_read_total', 'Lines read from the port', ['port'])
+frames_malformed = Counter('serial_frames_malformed_total', 'Binary frames dropped for a bad CRC, bad encoding or excessive length', ['port'])
+lines_dropped = Counter('serial_lines_dropped_total', 'Lines pushed out of the ring buffer when it was full', ['port'])
+port_opens = Counter('serial_port_opens_total', 'Successful port opens', ['port'])
+port_reconnects = Counter('serial_port_reconnects_total', 'Opens of a port that had been open before', ['port'])
+port_open_failures = Counter('serial_port_open_failures_total', 'Failed port opens', ['port'])
+port_closes = Counter('serial_port_closes_total', 'Ports closed by the lifecycle manager, by reason (idle, evicted)', ['port', 'reason'])
+bytes_written = Counter('serial_bytes_written_total', 'Bytes written to the port', ['port'])
+write_latency = Histogram('serial_write_latency_seconds', 'Time a write request spent queued and writing', ['port'])
+command_latency = Histogram('serial_command_latency_seconds', 'Time from queueing a command to its matching reply', ['port'])
+command_timeouts = Counter('serial_command_timeouts_total', 'Commands that got no matching reply in time', ['port'])
+lines_suppressed = Counter('serial_lines_suppressed_total', 'Lines the persistence policy of the port kept out of storage', ['port'])
+db_rows_written = Counter('serial_db_rows_written_total', 'SerialOutput rows written by the write-behind writer')
+db_flush_latency = Histogram('serial_db_flush_seconds', 'Duration of one write-behind flush')
+history_records_written = Counter('serial_history_records_written_total', 'Lines appended to the history segment files')
+db_flush_errors = Counter('serial_db_flush_errors_total', 'Write-behind flushes that failed')
+trigger_matches = Counter('serial_trigger_matches_total', 'Lines that fired a trigger rule, counted once per rule', ['port'])
+trigger_lines_dropped = Counter('serial_trigger_lines_dropped_total', 'Lines not matched against the trigger rules because the engine fell behind', ['port'])
+trigger_webhook_failures = Counter('serial_trigger_webhook_failures_total', 'Trigger webhook calls that failed or were dropped')
+request_latency = Histogram('serial_http_request_seconds', 'Time to produce the response of a request', ['view', 'method'])
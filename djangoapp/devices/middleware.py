@@ -0,0 +1,41 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import metrics
+
+
+class RequestLatencyMiddleware:
+    """Records how long each view took to produce its response.
+
+    Works natively in both sync and async stacks so async views (streams,
+    long-polls) don't get pushed onto a thread just to be timed. For streaming
+    responses this is the time until the stream starts.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self._observe(request, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self._observe(request, time.perf_counter() - started)
+        return response
+
+    def _observe(self, request, elapsed):
+        match = request.resolver_match
+        view = match.url_name if match and match.url_name else 'unmatched'
+        metrics.request_latency.observe(elapsed, view, request.method)
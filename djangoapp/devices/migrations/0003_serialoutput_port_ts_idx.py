@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("devices", "0002_serialoutput_timestamp_default"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="serialoutput",
+            index=models.Index(fields=["port", "timestamp"], name="serialoutput_port_ts_idx"),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("devices", "0003_serialoutput_port_ts_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TelemetryBlock",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("start", models.FloatField()),
+                ("end", models.FloatField()),
+                ("count", models.PositiveIntegerField()),
+                ("columns", models.JSONField()),
+                ("data", models.BinaryField()),
+                ("port", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="telemetry_blocks", to="devices.port")),
+            ],
+            options={
+                "indexes": [models.Index(fields=["port", "start"], name="telemetryblock_port_start_idx")],
+            },
+        ),
+    ]
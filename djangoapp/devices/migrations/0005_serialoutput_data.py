@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("devices", "0004_telemetryblock"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="serialoutput",
+            name="data",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:03
+
+import devices.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("devices", "0005_serialoutput_data"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TriggerRule",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(max_length=100)),
+                ("kind", models.CharField(choices=[("literal", "Literal text"), ("regex", "Regular expression")], default="literal", max_length=10)),
+                ("pattern", models.TextField()),
+                ("actions", models.JSONField(default=devices.models.default_trigger_actions)),
+                ("webhook_url", models.URLField(blank=True)),
+                ("cooldown_seconds", models.FloatField(default=0)),
+                ("enabled", models.BooleanField(default=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("port", models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name="trigger_rules", to="devices.port")),
+            ],
+        ),
+        migrations.CreateModel(
+            name="TriggerEvent",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("seq", models.PositiveBigIntegerField()),
+                ("timestamp", models.DateTimeField()),
+                ("line", models.TextField()),
+                ("port", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="trigger_events", to="devices.port")),
+                ("rule", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="events", to="devices.triggerrule")),
+            ],
+            options={
+                "ordering": ["-timestamp"],
+                "indexes": [models.Index(fields=["port", "timestamp"], name="triggerevent_port_ts_idx")],
+            },
+        ),
+    ]
@@ -1,4 +1,8 @@
+import re
+
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
 
 class Port(models.Model):
     port = models.CharField(max_length=100, unique=True)
@@ -9,10 +13,98 @@ class Port(models.Model):
 class SerialOutput(models.Model):
     port = models.ForeignKey(Port, on_delete=models.CASCADE, related_name='serial_outputs')
     output = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Raw bytes of a frame from a binary framing (see framing.py); output is empty then
+    data = models.BinaryField(null=True, blank=True)
+    # Set by the reader to the time the line arrived, not when it was flushed to the DB
+    timestamp = models.DateTimeField(default=timezone.now)
 
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            # Serves the per-port "newest first" reads and the retention range deletes
+            models.Index(fields=['port', 'timestamp'], name='serialoutput_port_ts_idx'),
+        ]
 
     def __str__(self):
         return f"{self.port.port} @ {self.timestamp}: {self.output[:50]}"
+
+
+class TelemetryBlock(models.Model):
+    """A run of parsed numeric samples from one port, stored as packed arrays.
+
+    data holds count little-endian float64 timestamps (epoch seconds) followed
+    by count float64 values for each name in columns, in that order; a column
+    missing from a line is NaN. See telemetry.py.
+    """
+    port = models.ForeignKey(Port, on_delete=models.CASCADE, related_name='telemetry_blocks')
+    start = models.FloatField()  # timestamp of the first sample
+    end = models.FloatField()  # timestamp of the last sample
+    count = models.PositiveIntegerField()
+    columns = models.JSONField()
+    data = models.BinaryField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['port', 'start'], name='telemetryblock_port_start_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.port.port} {self.start}-{self.end} ({self.count} samples)"
+
+
+def default_trigger_actions():
+    return ['event']
+
+
+class TriggerRule(models.Model):
+    """A pattern that fires actions when a line read from a port matches it (see triggers.py)."""
+    KIND_CHOICES = [('literal', 'Literal text'), ('regex', 'Regular expression')]
+    # Actions: 'event' stores a TriggerEvent, 'webhook' POSTs the match to
+    # webhook_url, 'stream' pushes it to /serial/triggers/stream/
+    ACTIONS = ('event', 'webhook', 'stream')
+
+    name = models.CharField(max_length=100)
+    # Only lines of this port are matched; every port when empty
+    port = models.ForeignKey(Port, on_delete=models.CASCADE, null=True, blank=True, related_name='trigger_rules')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default='literal')
+    pattern = models.TextField()
+    actions = models.JSONField(default=default_trigger_actions)
+    webhook_url = models.URLField(blank=True)
+    # Matches within this many seconds of the rule's last firing on the same port are ignored
+    cooldown_seconds = models.FloatField(default=0)
+    enabled = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def clean(self):
+        if self.kind == 'regex':
+            try:
+                re.compile(self.pattern)
+            except re.error as e:
+                raise ValidationError({'pattern': f'Invalid regular expression: {e}'})
+        unknown = set(self.actions) - set(self.ACTIONS)
+        if unknown:
+            raise ValidationError({'actions': f'Unknown actions: {", ".join(sorted(unknown))}'})
+        if 'webhook' in self.actions and not self.webhook_url:
+            raise ValidationError({'webhook_url': 'Required for the webhook action'})
+
+    def __str__(self):
+        return self.name
+
+
+class TriggerEvent(models.Model):
+    rule = models.ForeignKey(TriggerRule, on_delete=models.CASCADE, related_name='events')
+    port = models.ForeignKey(Port, on_delete=models.CASCADE, related_name='trigger_events')
+    seq = models.PositiveBigIntegerField()
+    # Arrival time of the matching line
+    timestamp = models.DateTimeField()
+    # The matching line; binary frames are base64-encoded
+    line = models.TextField()
+
+    class Meta:
+        ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['port', 'timestamp'], name='triggerevent_port_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.rule.name} on {self.port.port} @ {self.timestamp}"
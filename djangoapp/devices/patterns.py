@@ -0,0 +1,195 @@
+import logging
+import re
+from collections import deque
+
+try:
+    from re import _parser as _sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse as _sre_parse
+
+try:
+    import ahocorasick  # pyahocorasick, optional
+except ImportError:
+    ahocorasick = None
+
+logger = logging.getLogger(__name__)
+
+# Regex rules whose required literal is shorter than this are run on every line
+MIN_LITERAL = 3
+# Up to this many keys a trie regex rejects non-matching lines faster than the
+# automaton; beyond it the regex's branching costs more than it saves
+PREFILTER_MAX_KEYS = 1000
+
+
+class AhoCorasick:
+    """Finds every occurrence of many literal keys in one pass over the text.
+
+    keys is an iterable of (key, value); search() yields the value of each key
+    occurring in the text. The cost is linear in the length of the text
+    whatever the number of keys. Uses pyahocorasick when it is installed.
+    """
+
+    def __init__(self, keys):
+        grouped = {}
+        for key, value in keys:
+            grouped.setdefault(key, []).append(value)
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for key, values in grouped.items():
+                self.automaton.add_word(key, values)
+            if grouped:
+                self.automaton.make_automaton()
+            self.search = self._search_c if grouped else self._search_empty
+            return
+        # Trie of goto transitions, failure links and per-node outputs
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for key, values in grouped.items():
+            node = 0
+            for char in key:
+                child = self.goto[node].get(char)
+                if child is None:
+                    child = self.goto[node][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = child
+            self.out[node].extend(values)
+        pending = deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, child in self.goto[node].items():
+                pending.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[child] = target if target != child else 0
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+        self.search = self._search_python
+
+    def _search_python(self, text):
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                yield from out[node]
+
+    def _search_c(self, text):
+        for _, values in self.automaton.iter(text):
+            yield from values
+
+    def _search_empty(self, text):
+        return iter(())
+
+
+def trie_regex(keys):
+    """Compile one regex that matches wherever any of keys occurs.
+
+    The keys are merged into a trie first, so the alternation branches on one
+    character at a time instead of trying every key at every position; the
+    regex engine then rejects a line with no key in it at C speed.
+    """
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[''] = True
+    if not trie:
+        return None
+
+    def build(node):
+        if '' in node:
+            return ''  # a key ends here; matching any longer one adds nothing
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items())]
+        return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+    return re.compile(build(trie))
+
+
+def required_literal(pattern):
+    """Return the longest literal text every match of the regex pattern contains ('' if unknown)."""
+    try:
+        parsed = _sre_parse.parse(pattern)
+    except Exception:
+        return ''
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    if state.flags & re.IGNORECASE:
+        return ''
+    best = run = ''
+    # Top-level literals are mandatory; anything optional or repeated is nested in another op
+    for op, av in parsed:
+        if op is _sre_parse.LITERAL:
+            run += chr(av)
+            if len(run) > len(best):
+                best = run
+        else:
+            run = ''
+    return best
+
+
+class RuleSet:
+    """Trigger rules compiled into one matcher, for the lines of one port.
+
+    Literal rules and the required literal of each regex rule go into a
+    single Aho-Corasick automaton; with up to PREFILTER_MAX_KEYS of them, a
+    trie regex first throws out lines containing none at C speed. Only the
+    regex rules whose literal was found are then run. Regex rules without a
+    usable literal are checked with one combined alternation first. Matching
+    a line thus costs about the same with ten rules or ten thousand, as long
+    as few of them match.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        keys = []
+        self.scanned = []  # (rule, regex) run on every line
+        for rule in rules:
+            if rule.kind == 'literal':
+                if rule.pattern:
+                    keys.append((rule.pattern, (rule, None)))
+                continue
+            try:
+                regex = re.compile(rule.pattern)
+            except re.error as e:
+                logger.warning("Skipping trigger rule %s: invalid regex %r: %s", rule.name, rule.pattern, e)
+                continue
+            literal = required_literal(rule.pattern)
+            if len(literal) >= MIN_LITERAL:
+                keys.append((literal, (rule, regex)))
+            else:
+                self.scanned.append((rule, regex))
+        self.keyed = bool(keys)
+        self.prefilter = trie_regex(key for key, _ in keys) if len(keys) <= PREFILTER_MAX_KEYS else None
+        self.automaton = AhoCorasick(keys)
+        self.scan_any = None
+        if len(self.scanned) > 1:
+            try:
+                self.scan_any = re.compile('|'.join(f'(?:{regex.pattern})' for _, regex in self.scanned))
+            except re.error:
+                pass  # e.g. backreferences or inline flags that don't combine; run them one by one
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def match(self, text):
+        """Return the rules matching text, each once."""
+        matched = {}
+        if self.keyed and (self.prefilter is None or self.prefilter.search(text)):
+            checked = set()
+            for rule, regex in self.automaton.search(text):
+                if rule.id in checked:
+                    continue  # key found again further on
+                checked.add(rule.id)
+                if regex is None or regex.search(text):
+                    matched[rule.id] = rule
+        if self.scanned and (self.scan_any is None or self.scan_any.search(text)):
+            for rule, regex in self.scanned:
+                if rule.id not in matched and regex.search(text):
+                    matched[rule.id] = rule
+        return list(matched.values())
@@ -0,0 +1,271 @@
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+
+from . import metrics
+from .history import HISTORY_BACKEND, get_store
+from .models import Port, SerialOutput
+from .policy import PersistencePolicies
+from .retention import RetentionSweeper
+from .telemetry import TelemetryIngest
+
+logger = logging.getLogger(__name__)
+
+# Flush when this many lines are queued...
+BATCH_SIZE = getattr(settings, 'SERIAL_DB_BATCH_SIZE', 200)
+# ...or when the oldest queued line has waited this long
+FLUSH_INTERVAL_MS = getattr(settings, 'SERIAL_DB_FLUSH_MS', 250)
+
+# full port path -> Port.id, so the ingest path never does get_or_create per line
+_port_ids = {}
+_port_ids_lock = threading.Lock()
+
+
+def get_port_id(full_port):
+    port_id = _port_ids.get(full_port)
+    if port_id is None:
+        with _port_ids_lock:
+            port_id = _port_ids.get(full_port)
+            if port_id is None:
+                port_obj, created = Port.objects.get_or_create(port=full_port)
+                if created:
+                    logger.info("Created Port DB entry for %s", full_port)
+                port_id = _port_ids[full_port] = port_obj.id
+    return port_id
+
+
+def forget_stale_port_ids(full_ports):
+    """Drop the cached ids of these ports whose Port row was deleted; returns the ports dropped.
+
+    The next get_port_id() call recreates the row.
+    """
+    with _port_ids_lock:
+        cached = {full_port: _port_ids[full_port] for full_port in full_ports if full_port in _port_ids}
+    existing = set(Port.objects.filter(id__in=cached.values()).values_list('id', flat=True))
+    stale = [full_port for full_port, port_id in cached.items() if port_id not in existing]
+    with _port_ids_lock:
+        for full_port in stale:
+            if _port_ids.get(full_port) == cached[full_port]:
+                del _port_ids[full_port]
+    return stale
+
+
+class WriteBehindWriter(threading.Thread):
+    """Persists read lines off the read path.
+
+    Readers hand entries to submit() and carry on; this thread collects them and
+    writes each batch with one bulk_create inside a single transaction, or
+    appends it to the segment store when SERIAL_HISTORY_BACKEND is 'segments'.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval_ms=FLUSH_INTERVAL_MS, backend=HISTORY_BACKEND):
+        super().__init__(name='serial-db-writer', daemon=True)
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue = queue.Queue()
+        self.retention = RetentionSweeper()
+        self.telemetry = TelemetryIngest()
+        self.policies = PersistencePolicies()
+        self._stop_event = threading.Event()
+        self.stats_lock = threading.Lock()
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def submit(self, full_port, entry):
+        self.submit_many(full_port, [entry])
+
+    def submit_many(self, full_port, entries):
+        # Lines the port's persistence policy (see policy.py) rejects are not stored.
+        # A telemetry port still queues them, unstored, so its aggregates see every
+        # sample rather than only the ones a deadband or rate limit let through.
+        kept = self.policies.filter(full_port, entries)
+        if full_port in self.telemetry.parsers and len(kept) < len(entries):
+            kept_ids = {id(entry) for entry in kept}
+            for entry in entries:
+                self.queue.put((full_port, entry, id(entry) in kept_ids))
+        else:
+            for entry in kept:
+                self.queue.put((full_port, entry, True))
+
+    def run(self):
+        batch = []
+        deadline = None
+        while True:
+            # Wake up for the next flush, retention sweep or telemetry block, whichever is first
+            timeout = min(self.retention.seconds_until_due(), self.telemetry.seconds_until_due())
+            if deadline is not None:
+                timeout = min(timeout, max(0, deadline - time.monotonic()))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            stopping = self._stop_event.is_set() and self.queue.empty()
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline or stopping):
+                stored = [(full_port, entry) for full_port, entry, store in batch if store]
+                if stored and self.backend == 'segments':
+                    self._append_segments(stored)
+                elif stored:
+                    self._flush(stored)
+                self._parse_telemetry(batch)
+                batch = []
+                deadline = None
+            self.telemetry.flush_if_due(force=stopping)
+            if stopping:
+                break
+            if self.backend != 'segments':
+                self.retention.sweep_if_due()
+        if self.backend == 'segments':
+            get_store().close()
+        close_old_connections()
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        try:
+            try:
+                rows = self._insert(batch)
+            except IntegrityError:
+                # A Port row was deleted behind the id cache: forget its id and
+                # retry once, so the lines of the other ports aren't lost with it
+                stale = forget_stale_port_ids({full_port for full_port, _ in batch})
+                if not stale:
+                    raise
+                logger.warning("Port rows of %s were deleted, recreating them", ', '.join(stale))
+                rows = self._insert(batch)
+        except Exception as db_error:
+            # Drop the batch rather than let one bad write back up the queue forever
+            logger.error("Database Error saving %d serial lines: %s", len(batch), db_error)
+            with self.stats_lock:
+                self.errors += 1
+            metrics.db_flush_errors.inc()
+            return
+        finally:
+            close_old_connections()
+        elapsed = time.perf_counter() - started
+        elapsed_ms = elapsed * 1000
+        metrics.db_flush_latency.observe(elapsed)
+        metrics.db_rows_written.inc(len(rows))
+        with self.stats_lock:
+            self.flushes += 1
+            self.rows_written += len(rows)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+        for full_port in {full_port for full_port, _ in batch}:
+            self.retention.note(full_port, get_port_id(full_port))
+
+    def _insert(self, batch):
+        rows = [
+            SerialOutput(
+                port_id=get_port_id(full_port),
+                output=entry.line if isinstance(entry.line, str) else '',
+                data=entry.line if isinstance(entry.line, bytes) else None,
+                timestamp=datetime.fromtimestamp(entry.timestamp, tz=timezone.utc),
+            )
+            for full_port, entry in batch
+        ]
+        with transaction.atomic():
+            SerialOutput.objects.bulk_create(rows)
+        return rows
+
+    def _parse_telemetry(self, batch):
+        if not self.telemetry.parsers:
+            return
+        by_port = {}
+        for full_port, entry, _ in batch:
+            by_port.setdefault(full_port, []).append(entry)
+        for full_port, entries in by_port.items():
+            try:
+                self.telemetry.ingest(full_port, entries)
+            except Exception as e:
+                logger.error("Error parsing telemetry of %s: %s", full_port, e)
+
+    def _append_segments(self, batch):
+        started = time.perf_counter()
+        by_port = {}
+        for full_port, entry in batch:
+            by_port.setdefault(full_port, []).append(entry)
+        try:
+            store = get_store()
+            for full_port, entries in by_port.items():
+                store.append(full_port, entries)
+        except Exception as e:
+            logger.error("Error appending %d serial lines to the history segments: %s", len(batch), e)
+            with self.stats_lock:
+                self.errors += 1
+            metrics.db_flush_errors.inc()
+            return
+        elapsed = time.perf_counter() - started
+        elapsed_ms = elapsed * 1000
+        metrics.db_flush_latency.observe(elapsed)
+        metrics.history_records_written.inc(len(batch))
+        with self.stats_lock:
+            self.flushes += 1
+            self.rows_written += len(batch)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+
+    def stop(self, timeout=5):
+        """Flush whatever is still queued and stop the thread."""
+        self._stop_event.set()
+        self.queue.put(None)  # wake the thread up if it is waiting on an empty queue
+        self.join(timeout)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'flushes': self.flushes,
+                'rows_written': self.rows_written,
+                'errors': self.errors,
+                'last_flush_ms': self.last_flush_ms,
+                'max_flush_ms': self.max_flush_ms,
+                'avg_flush_ms': self.total_flush_ms / self.flushes if self.flushes else 0.0,
+                'retention_sweeps': self.retention.sweeps,
+                'rows_pruned': self.retention.rows_deleted,
+                'lines_suppressed': self.policies.suppressed,
+                'telemetry_samples': self.telemetry.samples,
+                'telemetry_blocks': self.telemetry.blocks_written,
+            }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Return the process-wide writer, starting it on first use."""
+    global _writer
+    if _writer is None or not _writer.is_alive():
+        with _writer_lock:
+            if _writer is None or not _writer.is_alive():
+                _writer = WriteBehindWriter()
+                _writer.start()
+    return _writer
+
+
+def stop_writer():
+    if _writer is not None and _writer.is_alive():
+        _writer.stop()
+
+
+def _collect_writer_gauges():
+    depth = _writer.queue.qsize() if _writer is not None else 0
+    return [('serial_db_queue_depth', 'Lines waiting for the write-behind writer', (), [((), depth)])]
+
+
+metrics.registry.add_collector(_collect_writer_gauges)
@@ -0,0 +1,145 @@
+import re
+import threading
+
+from django.conf import settings
+
+from . import metrics
+
+# Which lines are persisted, for every port unless overridden below:
+#   {'mode': 'all'}                          every line
+#   {'mode': 'change'}                       only lines that differ from the last one stored
+#   {'mode': 'deadband', 'deadband': 0.5}    only when a number in the line moves by more than 0.5
+#   {'mode': 'rate', 'max_per_second': 10}   at most 10 lines per second
+# 'change' and 'deadband' also take 'heartbeat_seconds': store an unchanged
+# line anyway once this long has passed since the last stored one.
+DEFAULT_POLICY = getattr(settings, 'SERIAL_PERSIST_POLICY', {'mode': 'all'})
+# Per-port overrides, keyed by full port path
+PORT_POLICIES = getattr(settings, 'SERIAL_PERSIST_POLICY_PER_PORT', {})
+
+_NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+def policy_for(full_port):
+    policy = dict(DEFAULT_POLICY)
+    policy.update(PORT_POLICIES.get(full_port, {}))
+    return policy
+
+
+class StoreAll:
+    def allow(self, entry):
+        return True
+
+
+class StoreOnChange:
+    """Stores a line only if it differs from the last stored line (or the heartbeat is due)."""
+
+    def __init__(self, heartbeat_seconds=None):
+        self.heartbeat = heartbeat_seconds
+        self.last = None
+        self.last_stored_at = None
+
+    def allow(self, entry):
+        heartbeat_due = (
+            self.heartbeat is not None and self.last_stored_at is not None
+            and entry.timestamp - self.last_stored_at >= self.heartbeat
+        )
+        if self.last_stored_at is not None and not heartbeat_due and not self.changed(entry.line):
+            return False
+        self.remember(entry.line)
+        self.last_stored_at = entry.timestamp
+        return True
+
+    def changed(self, line):
+        return line != self.last
+
+    def remember(self, line):
+        self.last = line
+
+
+class StoreOnDeadband(StoreOnChange):
+    """Stores a line when one of its numbers moved by more than deadband since the last stored line.
+
+    Lines are compared by their text with the numbers taken out: if that
+    differs (another message, a different number of fields), the line is
+    stored. Binary frames fall back to store-on-change.
+    """
+
+    def __init__(self, deadband, heartbeat_seconds=None):
+        super().__init__(heartbeat_seconds)
+        self.deadband = deadband
+        self.last_shape = None
+        self.last_values = None
+
+    def changed(self, line):
+        if not isinstance(line, str):
+            return line != self.last
+        values = _NUMBER.findall(line)
+        if _NUMBER.sub('#', line) != self.last_shape or not values:
+            return line != self.last
+        return any(abs(float(value) - old) > self.deadband for value, old in zip(values, self.last_values))
+
+    def remember(self, line):
+        self.last = line
+        if isinstance(line, str):
+            self.last_shape = _NUMBER.sub('#', line)
+            self.last_values = [float(value) for value in _NUMBER.findall(line)]
+
+
+class StoreAtRate:
+    """Stores at most max_per_second lines in each one-second window of arrival time."""
+
+    def __init__(self, max_per_second):
+        self.max_per_second = max_per_second
+        self.window_start = None
+        self.count = 0
+
+    def allow(self, entry):
+        if self.window_start is None or entry.timestamp - self.window_start >= 1:
+            self.window_start = entry.timestamp
+            self.count = 0
+        if self.count >= self.max_per_second:
+            return False
+        self.count += 1
+        return True
+
+
+def make_policy(config):
+    mode = config.get('mode', 'all')
+    if mode == 'all':
+        return StoreAll()
+    if mode == 'change':
+        return StoreOnChange(config.get('heartbeat_seconds'))
+    if mode == 'deadband':
+        return StoreOnDeadband(config['deadband'], config.get('heartbeat_seconds'))
+    if mode == 'rate':
+        return StoreAtRate(config['max_per_second'])
+    raise ValueError(f'Unknown persistence policy {mode!r}')
+
+
+class PersistencePolicies:
+    """Decides per port which read lines get persisted.
+
+    filter() runs on the reader thread of the port, before lines are queued
+    for the DB writer, so suppressed lines cost no queueing, no INSERT and no
+    retention work. They still reach the ring buffer, live streams and the
+    telemetry parser (see WriteBehindWriter.submit_many()).
+    """
+
+    def __init__(self):
+        self.policies = {}  # full port path -> policy object, built on first use
+        self.lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, full_port, entries):
+        policy = self.policies.get(full_port)
+        if policy is None:
+            policy = self.policies[full_port] = make_policy(policy_for(full_port))
+        if isinstance(policy, StoreAll):
+            return entries
+        kept = [entry for entry in entries if policy.allow(entry)]
+        suppressed = len(entries) - len(kept)
+        if suppressed:
+            with self.lock:
+                self.suppressed += suppressed
+            metrics.lines_suppressed.inc(suppressed, full_port)
+        return kept
@@ -0,0 +1,638 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from itertools import islice
+
+import serial
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics
+from .capture import CaptureWriter, capture_path
+from .commands import CommandTimeout, get_channel
+from .framing import make_framer
+from .lifecycle import get_port_manager
+from .persistence import get_writer
+from .streaming import Subscription, entry_stream, event_stream, subscription_items
+from .triggers import get_trigger_engine
+from .writers import PortWriter
+
+logger = logging.getLogger(__name__)
+
+# Shared connection pool: full port path -> serial.Serial
+ser_connections = {}
+# Background readers: full port path -> PortReader
+readers = {}
+# Last seq handed out per port, so a restarted reader carries on numbering
+# where the previous one stopped and client cursors stay valid.
+_last_seqs = {}
+_readers_lock = threading.Lock()
+
+BAUD_RATE = 115200
+# Extra port names that don't live under /dev, mapped to a pyserial URL, e.g.
+# {'loop0': 'loop://', 'bench': 'socket://localhost:7000'}
+VIRTUAL_PORTS = getattr(settings, 'SERIAL_VIRTUAL_PORTS', {})
+RING_BUFFER_SIZE = 1000  # lines kept in memory per port
+READ_CHUNK_SIZE = 64 * 1024  # most bytes taken from the driver per read
+# How each port's byte stream is cut into frames, keyed by full port path, e.g.
+# {'/dev/ttyACM0': {'mode': 'cobs'}}; ports not listed are newline-delimited text
+FRAMING = getattr(settings, 'SERIAL_FRAMING', {})
+OPEN_TIMEOUT = 2  # seconds a request waits to learn whether the port opened
+WRITE_TIMEOUT = 5  # seconds a request waits for its write to go out
+
+# One line read from a port. seq increases by one per line and never resets
+# while the reader is alive, so clients can tell what they have already seen.
+# line is a str for text ports and the raw frame (bytes) for binary framings.
+Entry = namedtuple('Entry', ['seq', 'timestamp', 'line'])
+
+
+class PortReader(threading.Thread):
+    """Opens one serial port and drains it continuously into a bounded ring buffer.
+
+    The port is opened on the reader's own thread; ready resolves once it is
+    open (or fails with the open error), so no request thread blocks on it.
+    """
+
+    def __init__(self, full_port, buffer_size=RING_BUFFER_SIZE, evicted=None):
+        super().__init__(name=f'serial-reader:{full_port}', daemon=True)
+        self.full_port = full_port
+        self.evicted = evicted  # reader closed to make room for this one, waited for before opening
+        self.stop_reason = 'stopped'
+        self.ser = None
+        self.ready = Future()
+        self.opened_at = None
+        self.writer = PortWriter(self)
+        self.buffer = deque(maxlen=buffer_size)
+        self.lock = threading.Condition()  # notified whenever a line is appended
+        self.last_seq = _last_seqs.get(full_port, 0)
+        self.dropped = 0  # lines pushed out of the full buffer
+        self.error = None
+        self.closed = False
+        self.subscribers = set()
+        self.recorder = None  # CaptureWriter while the raw bytes are being recorded
+        self._stop_event = threading.Event()
+
+    def run(self):
+        manager = get_port_manager()
+        if self.evicted is not None:
+            self.evicted.join(timeout=1)  # so the open handles never exceed the limit
+            self.evicted = None
+        # Usually full_port itself; a reconnected USB adapter may have come back under another path
+        device = manager.device_for(self.full_port)
+        try:
+            logger.info("Attempting to open %s...", device)
+            # serial_for_url takes plain device paths as well as loop://, socket:// etc.
+            self.ser = serial.serial_for_url(device, BAUD_RATE, timeout=0.1)
+        except Exception as e:
+            logger.warning("Failed to open port %s: %s", device, e)
+            metrics.port_open_failures.inc(1, self.full_port)
+            self.error = f'Failed to open port {self.full_port}: {str(e)}'
+            manager.open_failed(self.full_port, e)
+            self.ready.set_exception(e)
+            self._close()
+            return
+        logger.info("Successfully opened %s", device)
+        manager.opened(self.full_port, device)
+        self.opened_at = time.monotonic()
+        with _readers_lock:
+            ser_connections[self.full_port] = self.ser
+            reopened = self.full_port in _last_seqs
+        metrics.port_opens.inc(1, self.full_port)
+        if reopened:
+            metrics.port_reconnects.inc(1, self.full_port)
+        self.ready.set_result(self)
+
+        framer = make_framer(FRAMING.get(self.full_port))
+        malformed = 0
+        try:
+            while not self._stop_event.is_set():
+                # Take everything the driver has buffered in one call; when idle,
+                # block for up to the port timeout waiting for the first byte.
+                data = self.ser.read(min(max(self.ser.in_waiting, 1), READ_CHUNK_SIZE))
+                if not data:
+                    continue  # read timed out, check for stop and go again
+                metrics.bytes_read.inc(len(data), self.full_port)
+                if self.recorder is not None:
+                    self._record(data)
+                if framer.binary:
+                    # Binary frames are kept exactly as received
+                    lines = [bytes(frame) for frame in framer.feed(data)]
+                    if framer.errors + framer.oversized != malformed:
+                        metrics.frames_malformed.inc(framer.errors + framer.oversized - malformed, self.full_port)
+                        malformed = framer.errors + framer.oversized
+                else:
+                    # Only complete lines are decoded; a partial one stays in the framer
+                    lines = []
+                    for raw in framer.feed(data):
+                        line = raw.decode('utf-8', errors='ignore').strip()
+                        if line:
+                            lines.append(line)
+                if lines:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        for line in lines:
+                            logger.debug("Read from %s: %s", self.full_port, line)
+                    self._append(lines)
+            manager.closed(self.full_port, self.stop_reason)
+        except serial.SerialException as e:
+            logger.warning("SerialException reading from %s: %s. Closing port.", self.full_port, e)
+            self.error = f'Serial error on {self.full_port}: {str(e)}'
+            manager.lost(self.full_port, e)
+        except Exception as e:
+            logger.exception("Error reading from port %s: %s", self.full_port, e)
+            self.error = f'Error reading from {self.full_port}: {str(e)}'
+            manager.lost(self.full_port, e)
+        finally:
+            self._close()
+
+    def _record(self, data):
+        recorder = self.recorder
+        try:
+            recorder.write(time.time(), data)
+        except Exception as e:
+            # A full disk stops the recording, not the port
+            logger.error("Stopped recording %s to %s: %s", self.full_port, recorder.path, e)
+            self.stop_recording()
+
+    def start_recording(self, path=None):
+        """Start capturing the raw bytes read from the port (see capture.py); returns the capture status."""
+        with self.lock:
+            if self.recorder is None:
+                self.recorder = CaptureWriter(path or capture_path(self.full_port), self.full_port)
+                logger.info("Recording %s to %s", self.full_port, self.recorder.path)
+            return self.recorder.status()
+
+    def stop_recording(self):
+        with self.lock:
+            recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return {'recording': False}
+        recorder.close()
+        get_port_manager().touch(self.full_port)  # idle from now on, not from when the recording started
+        logger.info("Stopped recording %s: %d bytes in %s", self.full_port, recorder.bytes, recorder.path)
+        return recorder.status()
+
+    def _append(self, lines):
+        now = time.time()
+        with self.lock:
+            entries = []
+            for line in lines:
+                self.last_seq += 1
+                entries.append(Entry(self.last_seq, now, line))
+            overflow = min(max(0, len(self.buffer) + len(entries) - self.buffer.maxlen), len(self.buffer))
+            self.dropped += overflow
+            self.buffer.extend(entries)
+            subscribers = list(self.subscribers)
+            self.lock.notify_all()
+        metrics.lines_read.inc(len(entries), self.full_port)
+        if overflow:
+            metrics.lines_dropped.inc(overflow, self.full_port)
+        for subscription in subscribers:
+            for entry in entries:
+                subscription.publish(entry)
+        # Persisting is write-behind: the writer thread batches lines into the DB
+        # (or the history segments, see history.py)
+        get_writer().submit_many(self.full_port, entries)
+        # Trigger rules are matched on their own thread too (see triggers.py)
+        get_trigger_engine().submit(self.full_port, entries)
+
+    def read_since(self, since, limit):
+        """Return (entries, missed) for up to limit buffered entries newer than since.
+
+        since=None means "the latest lines": the last limit entries are returned.
+        missed counts lines after since that have already left the buffer.
+        since must not be ahead of last_seq (see cursor_reset()).
+        """
+        with self.lock:
+            if not self.buffer:
+                return [], 0
+            first_seq = self.buffer[0].seq
+            if since is None:
+                start = max(0, len(self.buffer) - limit)
+                missed = 0
+            else:
+                start = max(0, since - first_seq + 1)
+                missed = max(0, first_seq - since - 1)
+            return list(islice(self.buffer, start, start + limit)), missed
+
+    def cursor_reset(self, since):
+        """True if since is ahead of this reader, i.e. a cursor handed out before the numbering restarted.
+
+        Seqs carry on across reopens, but not across a restart of the process
+        (or the broker); such a cursor would otherwise wait for ever.
+        """
+        return since is not None and since > self.last_seq
+
+    def up_to_date(self, since):
+        # Whether a long-poll with this cursor has to wait for the next line
+        return since is not None and since == self.last_seq and not self.closed
+
+    def wait_for(self, since, timeout):
+        """Block until a line newer than since arrives or timeout seconds pass."""
+        with self.lock:
+            return self.lock.wait_for(lambda: self.last_seq > since or self.closed, timeout)
+
+    def subscribe(self, loop, since=None):
+        """Register a streaming client.
+
+        Returns (subscription, backlog) where backlog holds the buffered entries
+        newer than since, so a reconnecting client does not miss lines.
+        """
+        subscription = Subscription(self, loop)
+        return subscription, self.add_subscriber(subscription, since)
+
+    def add_subscriber(self, subscription, since=None):
+        """Register anything with publish(entry)/finish(); returns the backlog newer than since."""
+        with self.lock:
+            self.subscribers.add(subscription)
+            if since is None:
+                return []
+            if self.cursor_reset(since):
+                since = 0  # a cursor from before a restart: the whole buffer is new
+            return [entry for entry in self.buffer if entry.seq > since]
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+        get_port_manager().touch(self.full_port)
+
+    def in_use(self):
+        """True while a client streams from the port or it is being recorded, so it is never closed as idle.
+
+        Subscribers marked passive (an idle command channel) don't count.
+        """
+        with self.lock:
+            return self.recorder is not None or any(
+                not getattr(subscription, 'passive', False) for subscription in self.subscribers
+            )
+
+    @property
+    def stopping(self):
+        return self._stop_event.is_set()
+
+    def wait_ready(self, timeout=OPEN_TIMEOUT):
+        """Wait up to timeout for the port to open; re-raises the open error.
+
+        Returns False if the port is still opening when the timeout expires.
+        """
+        try:
+            self.ready.result(timeout)
+        except FutureTimeoutError:
+            return False
+        return True
+
+    def stop(self, reason='stopped'):
+        """Close the port; reason (stopped, idle, evicted) is reported to the lifecycle manager."""
+        self.stop_reason = reason
+        self._stop_event.set()
+
+    def _close(self):
+        self.writer.stop()
+        self.stop_recording()
+        try:
+            if self.ser and self.ser.is_open:
+                self.ser.close()
+        except Exception:  # Ignore errors during close
+            pass
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()  # release long-polls waiting on this reader
+            subscribers = list(self.subscribers)
+            self.subscribers.clear()
+        for subscription in subscribers:
+            subscription.finish()  # ends the stream, EventSource will reconnect
+        with _readers_lock:
+            _last_seqs[self.full_port] = self.last_seq
+            if self.ser is not None and ser_connections.get(self.full_port) is self.ser:
+                del ser_connections[self.full_port]
+            if readers.get(self.full_port) is self:
+                del readers[self.full_port]
+
+
+def resolve_port(port):
+    """Map a port name as used in URLs ('ttyACM0', or a virtual port name) to what pyserial opens."""
+    if port in VIRTUAL_PORTS:
+        return VIRTUAL_PORTS[port]
+    if port.startswith('/') or '://' in port:
+        return port  # already a full path or URL
+    return f'/dev/{port}'
+
+
+def ensure_reader(full_port, timeout=OPEN_TIMEOUT):
+    """Return the reader for full_port, starting one (which opens the port) if needed.
+
+    Waits up to timeout for the port to open and raises the open error
+    (serial.SerialException) if it fails; a reader still opening after that
+    is returned as is and simply has nothing buffered yet. A port waiting to
+    be reconnected fails right away, and with SERIAL_MAX_OPEN_PORTS ports
+    open the least recently used idle one is closed first (see lifecycle.py).
+    """
+    manager = get_port_manager()
+    manager.touch(full_port)
+    with _readers_lock:
+        reader = readers.get(full_port)
+        if reader is None or reader.closed:
+            manager.check_open(full_port)
+            open_readers = {port: other for port, other in readers.items() if not other.stopping}
+            evicted = manager.choose_eviction(open_readers)
+            if evicted is not None:
+                logger.info("Closing %s to make room for %s", evicted.full_port, full_port)
+                evicted.stop('evicted')
+            reader = _start_reader(full_port, evicted)
+    reader.wait_ready(timeout)
+    return reader
+
+
+def start_reader(full_port):
+    """Start a reader for full_port unless one is running; doesn't wait for the port to open."""
+    with _readers_lock:
+        reader = readers.get(full_port)
+        if reader is None or reader.closed:
+            reader = _start_reader(full_port)
+    return reader
+
+
+def _start_reader(full_port, evicted=None):
+    # Caller holds _readers_lock
+    get_port_manager().starting(full_port)
+    reader = PortReader(full_port, evicted=evicted)
+    readers[full_port] = reader
+    reader.start()
+    reader.writer.start()
+    return reader
+
+
+def stop_all_readers():
+    for reader in list(readers.values()):
+        reader.stop()
+    for reader in list(readers.values()):
+        reader.join(timeout=1)
+
+
+class _Waker:
+    # Reader subscriber that only records that something happened
+    def __init__(self):
+        self.event = threading.Event()
+
+    def publish(self, entry):
+        self.event.set()
+
+    def finish(self):
+        self.event.set()
+
+
+class _LoopWaker:
+    # _Waker for a coroutine: sets an asyncio.Event on its loop, once
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+        self.fired = False
+
+    def publish(self, entry):
+        if self.fired:
+            return  # one wake-up is enough, don't flood the loop on a busy port
+        self.fired = True
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            pass  # event loop already closed, the request is gone
+
+    def finish(self):
+        self.publish(None)
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _fetch_result(reader, since, limit):
+    last_seq = reader.last_seq
+    # A stale cursor is served the buffer from its start, flagged as a reset
+    reset = reader.cursor_reset(since)
+    entries, missed = reader.read_since(0 if reset else since, limit)
+    return {
+        'entries': entries,
+        'missed': missed,
+        'dropped': reader.dropped,
+        'last_seq': last_seq,
+        'reset': reset,
+        'error': reader.error,
+    }
+
+
+def _open_readers(cursors):
+    # full port path -> its reader, or the exception its open raised
+    ports = {}
+    for full_port in cursors:
+        try:
+            ports[full_port] = ensure_reader(full_port)
+        except Exception as e:
+            ports[full_port] = e
+    return ports
+
+
+def _live(ports):
+    return {full_port: reader for full_port, reader in ports.items() if isinstance(reader, PortReader)}
+
+
+def _fetch_results(ports, cursors, limit):
+    results = {}
+    for full_port, reader in ports.items():
+        if not isinstance(reader, PortReader):
+            results[full_port] = {
+                'entries': [], 'missed': 0, 'dropped': 0, 'last_seq': cursors[full_port] or 0, 'reset': False,
+                'error': f'Failed to open port {full_port}: {str(reader)}',
+            }
+            continue
+        results[full_port] = _fetch_result(reader, cursors[full_port], limit)
+    return results
+
+
+async def _wait_any(live, cursors, timeout):
+    # Wait on the event loop until one of the readers has a line newer than its cursor
+    waker = _LoopWaker(asyncio.get_running_loop())
+    for reader in live.values():
+        reader.add_subscriber(waker)
+    try:
+        # Re-check now that we'll be woken: a line may have come in meanwhile
+        if all(reader.up_to_date(cursors[full_port]) for full_port, reader in live.items()):
+            await waker.wait(timeout)
+    finally:
+        for reader in live.values():
+            reader.unsubscribe(waker)
+
+
+class LocalBackend:
+    """Serves ports from readers running in this process.
+
+    The views only talk to a backend, so they work the same whether the ports
+    live here or in the serial broker process (see broker.BrokerClient).
+    """
+
+    def fetch(self, full_port, since, limit, wait=0):
+        """Return the lines of full_port after since; with wait, block until there is one.
+
+        This parks the calling thread for the wait (the broker has a thread per
+        connection); the async views use poll() instead.
+        """
+        reader = ensure_reader(full_port)
+        if wait > 0 and reader.up_to_date(since):
+            reader.wait_for(since, wait)
+        return _fetch_result(reader, since, limit)
+
+    def fetch_many(self, cursors, limit, wait=0):
+        """fetch() for several ports at once: cursors maps full port path -> since.
+
+        With wait, blocks until any of the ports has a line newer than its
+        cursor. Returns full port path -> fetch() result; a port that failed
+        to open gets an empty result with its error.
+        """
+        ports = _open_readers(cursors)
+        live = _live(ports)
+        if wait > 0 and live and all(reader.up_to_date(cursors[full_port]) for full_port, reader in live.items()):
+            waker = _Waker()
+            for reader in live.values():
+                reader.add_subscriber(waker)
+            try:
+                # Re-check now that we'll be woken: a line may have come in meanwhile
+                if all(reader.up_to_date(cursors[full_port]) for full_port, reader in live.items()):
+                    waker.event.wait(wait)
+            finally:
+                for reader in live.values():
+                    reader.unsubscribe(waker)
+        return _fetch_results(ports, cursors, limit)
+
+    async def poll(self, full_port, since, limit, wait=0):
+        """fetch() for the async views: the long-poll waits on the event loop, holding no thread."""
+        reader = await sync_to_async(ensure_reader, thread_sensitive=False)(full_port)
+        if wait > 0 and reader.up_to_date(since):
+            await _wait_any({full_port: reader}, {full_port: since}, wait)
+        return _fetch_result(reader, since, limit)
+
+    async def poll_many(self, cursors, limit, wait=0):
+        """fetch_many() for the async views, waiting on the event loop like poll()."""
+        ports = await sync_to_async(_open_readers, thread_sensitive=False)(cursors)
+        live = _live(ports)
+        if wait > 0 and live and all(reader.up_to_date(cursors[full_port]) for full_port, reader in live.items()):
+            await _wait_any(live, cursors, wait)
+        return _fetch_results(ports, cursors, limit)
+
+    def write(self, full_port, chunks):
+        """Queue chunks to be written back to back and wait until they are sent.
+
+        Returns the request's write latency and the queue depth it found.
+        """
+        writer = ensure_reader(full_port).writer
+        queue_depth = writer.queue.qsize()
+        try:
+            latency_ms = writer.submit(chunks).result(WRITE_TIMEOUT)
+        except FutureTimeoutError:
+            raise serial.SerialException(f'Timed out writing to {full_port}')
+        return {'latency_ms': latency_ms, 'queue_depth': queue_depth}
+
+    def command(self, full_port, requests, timeout):
+        """Send commands and wait for their replies; requests is a list of (chunks, ReplyMatcher).
+
+        All commands are written at once (pipelined) and answered in order;
+        timeout bounds the whole request. Returns one result per command:
+        {'reply': [lines], 'latency_ms': ...} or {'error': ..., 'timeout': bool}.
+        """
+        deadline = time.monotonic() + timeout
+        channel = get_channel(ensure_reader(full_port))
+        results = []
+        for command in channel.send(requests):
+            try:
+                lines, latency_ms = channel.wait(command, max(0, deadline - time.monotonic()))
+                results.append({'reply': lines, 'latency_ms': latency_ms})
+            except CommandTimeout as e:
+                results.append({'error': str(e), 'timeout': True})
+            except Exception as e:
+                results.append({'error': str(e), 'timeout': False})
+        return results
+
+    async def acommand(self, full_port, requests, timeout):
+        """command() for the async views: the replies are awaited on the event loop, holding no thread."""
+        deadline = time.monotonic() + timeout
+        reader = await sync_to_async(ensure_reader, thread_sensitive=False)(full_port)
+        channel = get_channel(reader)
+        results = []
+        for command in channel.send(requests):
+            try:
+                lines, latency_ms = await channel.wait_async(command, max(0, deadline - time.monotonic()))
+                results.append({'reply': lines, 'latency_ms': latency_ms})
+            except CommandTimeout as e:
+                results.append({'error': str(e), 'timeout': True})
+            except Exception as e:
+                results.append({'error': str(e), 'timeout': False})
+        return results
+
+    async def stream(self, full_port, since=None, raw=False):
+        """Return an async iterator of Server-Sent Events (or raw records, see format_raw) for full_port."""
+        return event_stream(await self.stream_entries(full_port, since), raw)
+
+    def record(self, full_port, action):
+        """Start, stop or report a capture of full_port's raw bytes ('start', 'stop' or 'status')."""
+        reader = ensure_reader(full_port)
+        if action == 'start':
+            return reader.start_recording()
+        if action == 'stop':
+            return reader.stop_recording()
+        recorder = reader.recorder
+        return recorder.status() if recorder is not None else {'recording': False}
+
+    def port_status(self, full_port=None):
+        """Return the lifecycle status of every port known to this process (or just full_port).
+
+        Open ports also report their reader: lines buffered, subscribers and
+        whether anything is using the port right now.
+        """
+        manager = get_port_manager()
+        statuses = manager.status() if full_port is None else [manager.status(full_port)]
+        result = []
+        for status in statuses:
+            if status is None:
+                continue
+            reader = readers.get(status['port'])
+            if reader is not None and not reader.closed:
+                status.update({
+                    'buffered': len(reader.buffer),
+                    'subscribers': len(reader.subscribers),
+                    'in_use': reader.in_use(),
+                    'last_seq': reader.last_seq,
+                    'error': reader.error,
+                })
+            result.append(status)
+        return result
+
+    async def trigger_events(self):
+        """Return an async iterator of ('trigger', info) for fired stream-action triggers (None for keepalives)."""
+        engine = await sync_to_async(get_trigger_engine, thread_sensitive=False)()
+        return subscription_items(engine.subscribe(asyncio.get_running_loop()))
+
+    async def stream_entries(self, full_port, since=None):
+        """Return an async iterator of the entries of full_port after since (None for keepalives)."""
+        reader = await sync_to_async(ensure_reader, thread_sensitive=False)(full_port)
+        subscription, backlog = reader.subscribe(asyncio.get_running_loop(), since)
+        return entry_stream(subscription, backlog)
+
+
+def _collect_port_gauges():
+    buffered, subscribers, write_queue = [], [], []
+    for full_port, reader in list(readers.items()):
+        buffered.append(((full_port,), len(reader.buffer)))
+        subscribers.append(((full_port,), len(reader.subscribers)))
+        write_queue.append(((full_port,), reader.writer.queue.qsize()))
+    return [
+        ('serial_ports_open', 'Ports with a running reader', (), [((), len(readers))]),
+        ('serial_buffered_lines', 'Lines held in the ring buffer', ('port',), buffered),
+        ('serial_stream_subscribers', 'Streaming clients attached to the port', ('port',), subscribers),
+        ('serial_write_queue_depth', 'Write requests waiting for the port', ('port',), write_queue),
+    ]
+
+
+metrics.registry.add_collector(_collect_port_gauges)
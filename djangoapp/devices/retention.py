@@ -0,0 +1,97 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Port, SerialOutput
+
+logger = logging.getLogger(__name__)
+
+# Default policy for every port: keep at most max_rows rows and/or nothing
+# older than max_age_seconds. None disables that limit.
+DEFAULT_POLICY = getattr(settings, 'SERIAL_RETENTION', {'max_rows': 5, 'max_age_seconds': None})
+# Per-port overrides, keyed by full port path: {'/dev/ttyACM0': {'max_rows': 10000}}
+PORT_POLICIES = getattr(settings, 'SERIAL_RETENTION_PER_PORT', {})
+SWEEP_INTERVAL = getattr(settings, 'SERIAL_RETENTION_SWEEP_SECONDS', 5)
+
+
+def policy_for(full_port):
+    policy = dict(DEFAULT_POLICY)
+    policy.update(PORT_POLICIES.get(full_port, {}))
+    return policy
+
+
+def prune_port(port_id, max_rows=None, max_age_seconds=None):
+    """Delete the rows of one port that fall outside its retention window.
+
+    Both checks are range scans on the (port, timestamp) index: finding the
+    cut-off row costs max_rows index steps and the delete only touches the rows
+    being removed, so the cost does not grow with the size of the table.
+    Returns the number of rows deleted.
+    """
+    deleted = 0
+    outputs = SerialOutput.objects.filter(port_id=port_id)
+    if max_rows is not None:
+        # The newest row that has to go; it and everything older is deleted
+        cutoff = outputs.order_by('-timestamp', '-id').values_list('timestamp', 'id')[max_rows:max_rows + 1]
+        cutoff = list(cutoff)
+        if cutoff:
+            cutoff_ts, cutoff_id = cutoff[0]
+            deleted += outputs.filter(
+                Q(timestamp__lt=cutoff_ts) | Q(timestamp=cutoff_ts, id__lte=cutoff_id)
+            ).delete()[0]
+    if max_age_seconds is not None:
+        oldest_kept = timezone.now() - timedelta(seconds=max_age_seconds)
+        deleted += outputs.filter(timestamp__lt=oldest_kept).delete()[0]
+    return deleted
+
+
+class RetentionSweeper:
+    """Runs retention periodically instead of after every insert.
+
+    The DB writer reports which ports it wrote to via note() and calls
+    sweep_if_due() from its loop, so pruning shares the writer thread and never
+    competes with it for the SQLite write lock.
+    """
+
+    def __init__(self, interval=SWEEP_INTERVAL):
+        self.interval = interval
+        self.next_sweep = time.monotonic() + interval
+        self.dirty = {}  # port_id -> full port path written since the last sweep
+        self.rows_deleted = 0
+        self.sweeps = 0
+        limits = [DEFAULT_POLICY] + list(PORT_POLICIES.values())
+        self.age_limited = any(limit.get('max_age_seconds') is not None for limit in limits)
+
+    def note(self, full_port, port_id):
+        self.dirty[port_id] = full_port
+
+    def seconds_until_due(self):
+        return max(0, self.next_sweep - time.monotonic())
+
+    def sweep_if_due(self):
+        if time.monotonic() < self.next_sweep:
+            return
+        self.next_sweep = time.monotonic() + self.interval
+        ports = self.dirty
+        self.dirty = {}
+        if self.age_limited:
+            # Age limits also apply to ports that stopped sending, so check them all
+            try:
+                ports = dict(Port.objects.values_list('id', 'port'))
+            except Exception as db_error:
+                logger.error("Error listing ports for retention sweep: %s", db_error)
+        for port_id, full_port in ports.items():
+            policy = policy_for(full_port)
+            try:
+                deleted = prune_port(port_id, policy.get('max_rows'), policy.get('max_age_seconds'))
+            except Exception as prune_error:
+                logger.error("Error pruning old DB entries for %s: %s", full_port, prune_error)
+                continue
+            if deleted:
+                logger.debug("Pruned %d old DB entries for %s", deleted, full_port)
+                self.rows_deleted += deleted
+        self.sweeps += 1
@@ -0,0 +1,213 @@
+import asyncio
+import json
+import struct
+
+from .framing import frame_to_text
+
+SUBSCRIBER_QUEUE_SIZE = 1000  # entries buffered per slow client before we start dropping
+KEEPALIVE_SECONDS = 15
+
+_END = object()  # queued by finish() when the reader goes away
+
+
+class Subscription:
+    """Receives items from a background thread on an asyncio event loop.
+
+    The source (a PortReader, or the port discovery service) calls publish()
+    from its own thread for every new item; the item is handed to the
+    subscriber's loop so one source can feed any number of streaming clients
+    without them ever touching the device.
+    """
+
+    def __init__(self, source, loop, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.source = source
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def publish(self, entry):
+        # Called from the source's thread
+        try:
+            self.loop.call_soon_threadsafe(self._put, entry)
+        except RuntimeError:
+            # Event loop already closed, the client is gone
+            self.close()
+
+    def finish(self):
+        # Called from the reader thread when the port closes
+        try:
+            self.loop.call_soon_threadsafe(self._finish)
+        except RuntimeError:
+            pass
+
+    def _put(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _finish(self):
+        # Make room for the marker so a full queue can't swallow it
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(_END)
+
+    async def get(self, timeout):
+        """Return the next entry, or None if nothing arrived within timeout seconds."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.source.unsubscribe(self)
+
+
+def format_event(entry):
+    payload = {'seq': entry.seq, 'timestamp': entry.timestamp, 'line': frame_to_text(entry.line)}
+    if isinstance(entry.line, bytes):
+        payload['encoding'] = 'base64'
+    return f"id: {entry.seq}\ndata: {json.dumps(payload)}\n\n"
+
+
+_RAW_HEADER = struct.Struct('!I')
+RAW_KEEPALIVE = _RAW_HEADER.pack(0)
+
+
+def format_raw(entry):
+    """Raw stream record: 4-byte big-endian length, then the frame (text lines as UTF-8)."""
+    line = entry.line if isinstance(entry.line, bytes) else entry.line.encode('utf-8')
+    return _RAW_HEADER.pack(len(line)) + line
+
+
+async def entry_stream(subscription, backlog=()):
+    """Yield the backlog and then every new entry; None whenever KEEPALIVE_SECONDS pass without one."""
+    try:
+        last_seq = 0
+        for entry in backlog:
+            last_seq = entry.seq
+            yield entry
+        while True:
+            entry = await subscription.get(KEEPALIVE_SECONDS)
+            if entry is None:
+                yield None
+                continue
+            if entry is _END:
+                return
+            if entry.seq <= last_seq:
+                continue  # already sent as part of the backlog
+            last_seq = entry.seq
+            yield entry
+    finally:
+        subscription.close()
+
+
+async def event_stream(entries, raw=False):
+    """Yield Server-Sent Events (or raw records) for an iterator of entries such as entry_stream()."""
+    formatter = format_raw if raw else format_event
+    try:
+        async for entry in entries:
+            if entry is None:
+                # SSE comment (an empty record when raw), keeps proxies from
+                # closing an idle connection
+                yield RAW_KEEPALIVE if raw else ": keepalive\n\n"
+            else:
+                yield formatter(entry)
+    finally:
+        await entries.aclose()
+
+
+def format_cursors(cursors):
+    """{'ttyACM0': 12, 'ttyUSB0': 5} -> 'ttyACM0:12,ttyUSB0:5'"""
+    return ','.join(f'{name}:{seq}' for name, seq in cursors.items() if seq is not None)
+
+
+def parse_cursors(text):
+    """Inverse of format_cursors; raises ValueError on malformed input."""
+    cursors = {}
+    for item in filter(None, (text or '').split(',')):
+        name, _, seq = item.rpartition(':')
+        cursors[name] = int(seq)
+    return cursors
+
+
+async def multiplex_stream(streams, cursors, errors=None):
+    """Merge the entry iterators of several ports into one Server-Sent Events stream.
+
+    streams maps port name -> iterator from stream_entries(). Every event
+    carries its port, and its id is the cursor of every port (format_cursors),
+    so a reconnecting EventSource resumes each port where it left off. A port
+    whose stream ends gets an 'end' event; errors (port name -> message) are
+    sent first as 'port_error' events.
+    """
+    cursors = dict(cursors)
+    queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    async def pump(name, entries):
+        try:
+            async for entry in entries:
+                if entry is not None:
+                    await queue.put((name, entry))
+        except Exception as e:
+            await queue.put((name, e))
+        await queue.put((name, _END))
+
+    tasks = [asyncio.create_task(pump(name, entries)) for name, entries in streams.items()]
+    try:
+        for name, error in (errors or {}).items():
+            yield f"event: port_error\ndata: {json.dumps({'port': name, 'error': error})}\n\n"
+        remaining = len(tasks)
+        while remaining:
+            try:
+                name, item = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if item is _END:
+                remaining -= 1
+                yield f"event: end\ndata: {json.dumps({'port': name})}\n\n"
+            elif isinstance(item, Exception):
+                yield f"event: port_error\ndata: {json.dumps({'port': name, 'error': str(item)})}\n\n"
+            else:
+                cursors[name] = item.seq
+                payload = {'port': name, 'seq': item.seq, 'timestamp': item.timestamp, 'line': frame_to_text(item.line)}
+                if isinstance(item.line, bytes):
+                    payload['encoding'] = 'base64'
+                yield f"id: {format_cursors(cursors)}\ndata: {json.dumps(payload)}\n\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for entries in streams.values():
+            await entries.aclose()
+
+
+async def subscription_items(subscription):
+    """Yield the items published to subscription, or None after KEEPALIVE_SECONDS without one."""
+    try:
+        while True:
+            item = await subscription.get(KEEPALIVE_SECONDS)
+            if item is _END:
+                return
+            yield item
+    finally:
+        subscription.close()
+
+
+async def named_event_stream(items):
+    """Yield a Server-Sent Event for each (event name, info) item, and keepalives for None."""
+    try:
+        async for item in items:
+            if item is None:
+                yield ": keepalive\n\n"
+                continue
+            event, info = item
+            yield f"event: {event}\ndata: {json.dumps(info)}\n\n"
+    finally:
+        await items.aclose()
+
+
+def device_event_stream(subscription):
+    """Server-Sent Events for serial ports being plugged in or removed."""
+    return named_event_stream(subscription_items(subscription))
@@ -0,0 +1,276 @@
+import logging
+import math
+import sys
+import time
+from array import array
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import TelemetryBlock
+
+try:
+    import numpy as np
+except ImportError:  # aggregation falls back to plain Python
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Per-port parsers, keyed by full port path:
+#   {'/dev/ttyACM0': {'format': 'csv', 'columns': ['temp', 'humidity']},
+#    '/dev/ttyUSB0': {'format': 'kv'}}
+PARSERS = getattr(settings, 'SERIAL_TELEMETRY_PARSERS', {})
+# A block is written once it holds this many samples...
+BLOCK_SAMPLES = getattr(settings, 'SERIAL_TELEMETRY_BLOCK_SAMPLES', 4096)
+# ...or its first sample has waited this long
+BLOCK_FLUSH_SECONDS = getattr(settings, 'SERIAL_TELEMETRY_FLUSH_SECONDS', 5)
+
+
+def parse_csv(line, columns, delimiter=','):
+    """'1.5,20,x' with columns ['a', 'b', 'c'] -> {'a': 1.5, 'b': 20.0}; non-numbers are skipped."""
+    values = {}
+    for name, field in zip(columns, line.split(delimiter)):
+        try:
+            values[name] = float(field)
+        except ValueError:
+            pass
+    return values
+
+
+def parse_kv(line, separator='='):
+    """'temp=21.5 hum=40 mode=auto' -> {'temp': 21.5, 'hum': 40.0}; also accepts commas between pairs."""
+    values = {}
+    for pair in line.replace(',', ' ').split():
+        name, sep, field = pair.partition(separator)
+        if not sep or not name:
+            continue
+        try:
+            values[name] = float(field)
+        except ValueError:
+            pass
+    return values
+
+
+def make_parser(config):
+    """Return a function turning one line into {column: float}, per a SERIAL_TELEMETRY_PARSERS entry."""
+    fmt = config.get('format', 'kv')
+    if fmt == 'csv':
+        columns = list(config['columns'])
+        delimiter = config.get('delimiter', ',')
+        return lambda line: parse_csv(line, columns, delimiter)
+    if fmt == 'kv':
+        separator = config.get('separator', '=')
+        return lambda line: parse_kv(line, separator)
+    raise ValueError(f'Unknown telemetry format {fmt!r}')
+
+
+class _OpenBlock:
+    # Samples of one port not yet written; every column array is as long as timestamps
+    def __init__(self):
+        self.timestamps = array('d')
+        self.columns = {}  # name -> array('d')
+        self.opened = time.monotonic()
+
+    def add(self, timestamp, values):
+        count = len(self.timestamps)
+        self.timestamps.append(timestamp)
+        for name, value in values.items():
+            column = self.columns.get(name)
+            if column is None:
+                # A column first seen mid-block is NaN for the samples before it
+                column = self.columns[name] = array('d', [math.nan]) * count
+            column.append(value)
+        for name, column in self.columns.items():
+            if len(column) == count:
+                column.append(math.nan)
+
+    def pack(self):
+        names = sorted(self.columns)
+        data = array('d', self.timestamps)
+        for name in names:
+            data.extend(self.columns[name])
+        if sys.byteorder != 'little':
+            data.byteswap()
+        return names, data.tobytes()
+
+
+class TelemetryIngest:
+    """Parses lines of the configured ports into numeric columns and stores them in blocks.
+
+    Fed by the write-behind writer, which also calls flush_if_due() from its
+    loop, so blocks are written from the same thread as the rest of the ingest.
+    """
+
+    def __init__(self, parsers=PARSERS, block_samples=BLOCK_SAMPLES, flush_seconds=BLOCK_FLUSH_SECONDS):
+        self.parsers = {full_port: make_parser(config) for full_port, config in parsers.items()}
+        self.block_samples = block_samples
+        self.flush_seconds = flush_seconds
+        self.blocks = {}  # full port path -> _OpenBlock
+        self.samples = 0
+        self.blocks_written = 0
+
+    def ingest(self, full_port, entries):
+        parser = self.parsers.get(full_port)
+        if parser is None:
+            return
+        for entry in entries:
+            if not isinstance(entry.line, str):
+                continue  # binary frames have no text to parse
+            values = parser(entry.line)
+            if not values:
+                continue
+            block = self.blocks.get(full_port)
+            if block is None:
+                block = self.blocks[full_port] = _OpenBlock()
+            block.add(entry.timestamp, values)
+            self.samples += 1
+            if len(block.timestamps) >= self.block_samples:
+                self._write(full_port)
+
+    def seconds_until_due(self):
+        if not self.blocks:
+            return self.flush_seconds
+        oldest = min(block.opened for block in self.blocks.values())
+        return max(0, oldest + self.flush_seconds - time.monotonic())
+
+    def flush_if_due(self, force=False):
+        now = time.monotonic()
+        for full_port, block in list(self.blocks.items()):
+            if force or now - block.opened >= self.flush_seconds:
+                self._write(full_port)
+
+    def _write(self, full_port):
+        from .persistence import get_port_id
+
+        block = self.blocks.pop(full_port)
+        names, data = block.pack()
+        try:
+            with transaction.atomic():
+                TelemetryBlock.objects.create(
+                    port_id=get_port_id(full_port),
+                    start=block.timestamps[0],
+                    end=block.timestamps[-1],
+                    count=len(block.timestamps),
+                    columns=names,
+                    data=data,
+                )
+        except Exception as e:
+            logger.error("Database Error saving %d telemetry samples of %s: %s", len(block.timestamps), full_port, e)
+            return
+        self.blocks_written += 1
+
+
+# --- Reading ---
+
+def load_blocks(full_port, start=None, end=None):
+    """Return (count, columns, data, start, end) of the blocks of a port that may
+    hold samples between start and end, oldest first."""
+    blocks = TelemetryBlock.objects.filter(port__port=full_port)
+    if start is not None:
+        # Blocks don't overlap, so only the last one starting at or before start can reach into the range
+        first = blocks.filter(start__lte=start).order_by('-start').values_list('start', flat=True)[:1]
+        first = list(first)
+        blocks = blocks.filter(start__gte=first[0] if first else start)
+    if end is not None:
+        blocks = blocks.filter(start__lte=end)
+    return list(blocks.order_by('start').values_list('count', 'columns', 'data', 'start', 'end'))
+
+
+def aggregate(blocks, start, end, buckets, columns=None):
+    """Downsample samples in [start, end] into equal time buckets.
+
+    Returns (bucket_starts, {column: {'min', 'max', 'mean', 'last'}}) with one
+    value per bucket, None where a bucket has no sample of that column.
+    """
+    width = (end - start) / buckets
+    bucket_starts = [start + i * width for i in range(buckets)]
+    if np is not None:
+        return bucket_starts, _aggregate_numpy(blocks, start, end, buckets, columns)
+    return bucket_starts, _aggregate_python(blocks, start, end, buckets, columns)
+
+
+def _aggregate_numpy(blocks, start, end, buckets, columns):
+    timestamps = []
+    parts = {}  # name -> {block number: values}
+    for count, names, data, *_ in blocks:
+        packed = np.frombuffer(data, dtype='<f8')
+        for i, name in enumerate(names):
+            if columns is None or name in columns:
+                parts.setdefault(name, {})[len(timestamps)] = packed[(i + 1) * count:(i + 2) * count]
+        timestamps.append(packed[:count])
+    if not timestamps:
+        return {}
+    ts = np.concatenate(timestamps)
+    # Samples are in time order, so bucket boundaries are positions found by binary search
+    edges = start + (end - start) * np.arange(buckets + 1) / buckets
+    bounds = np.searchsorted(ts, edges, side='left')
+    bounds[-1] = np.searchsorted(ts, end, side='right')
+    offsets = bounds[:-1] - bounds[0]
+    ends = bounds[1:] - bounds[0]
+    result = {}
+    for name, column_parts in parts.items():
+        # Columns missing from a block are NaN there, so every column lines up with ts
+        column = np.concatenate([
+            column_parts.get(i, np.full(len(block_ts), np.nan)) for i, block_ts in enumerate(timestamps)
+        ])[bounds[0]:bounds[-1]]
+        # A trailing NaN keeps every offset a valid index for reduceat, even for
+        # empty buckets at the end; NaN is ignored by fmin/fmax and not counted
+        column = np.append(column, np.nan)
+        valid = ~np.isnan(column)
+        counts = np.where(ends > offsets, np.add.reduceat(valid.astype(np.int64), offsets), 0)
+        sums = np.add.reduceat(np.where(valid, column, 0.0), offsets)
+        mins = np.fmin.reduceat(column, offsets)
+        maxs = np.fmax.reduceat(column, offsets)
+        # Last valid sample before each bucket's end
+        valid_positions = np.flatnonzero(valid)
+        last_index = np.searchsorted(valid_positions, ends, side='left') - 1
+        lasts = column[valid_positions[np.maximum(last_index, 0)]] if len(valid_positions) else np.zeros(buckets)
+        empty = counts == 0
+        result[name] = {
+            'min': _to_list(mins, empty),
+            'max': _to_list(maxs, empty),
+            'mean': _to_list(sums / np.maximum(counts, 1), empty),
+            'last': _to_list(lasts, empty),
+        }
+    return result
+
+
+def _to_list(values, empty):
+    return [None if is_empty else float(value) for value, is_empty in zip(values.tolist(), empty.tolist())]
+
+
+def _aggregate_python(blocks, start, end, buckets, columns):
+    width = (end - start) / buckets
+    state = {}  # name -> [mins, maxs, sums, counts, lasts]
+    for count, names, data, *_ in blocks:
+        packed = array('d')
+        packed.frombytes(data)
+        if sys.byteorder != 'little':
+            packed.byteswap()
+        for i, name in enumerate(names):
+            if columns is not None and name not in columns:
+                continue
+            if name not in state:
+                state[name] = [[None] * buckets, [None] * buckets, [0.0] * buckets, [0] * buckets, [None] * buckets]
+            mins, maxs, sums, counts, lasts = state[name]
+            offset = (i + 1) * count
+            for j in range(count):
+                timestamp = packed[j]
+                value = packed[offset + j]
+                if timestamp < start or timestamp > end or math.isnan(value):
+                    continue
+                bucket = min(int((timestamp - start) / width), buckets - 1)
+                mins[bucket] = value if mins[bucket] is None else min(mins[bucket], value)
+                maxs[bucket] = value if maxs[bucket] is None else max(maxs[bucket], value)
+                sums[bucket] += value
+                counts[bucket] += 1
+                lasts[bucket] = value
+    return {
+        name: {
+            'min': mins,
+            'max': maxs,
+            'mean': [total / n if n else None for total, n in zip(sums, counts)],
+            'last': lasts,
+        }
+        for name, (mins, maxs, sums, counts, lasts) in state.items()
+    }
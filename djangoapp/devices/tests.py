@@ -1,3 +1,686 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import serial
+from django.db import DatabaseError
+from django.test import AsyncClient, SimpleTestCase, TransactionTestCase
+
+from . import export, lifecycle, patterns, policy, readers, retention, telemetry, triggers, writers
+from .capture import CaptureWriter, open_capture, replay
+from .commands import CommandChannel, CommandTimeout, ReplyMatcher
+from .framing import (
+    COBSFramer, LengthPrefixFramer, LineFramer, SLIPFramer, cobs_decode, cobs_encode, frame_from_text,
+    frame_to_text, slip_encode,
+)
+from .export import export_chunks, iter_history
+from .history import SegmentStore
+from .models import Port, SerialOutput
+from .persistence import WriteBehindWriter, stop_writer
+from .patterns import AhoCorasick, RuleSet, required_literal
+from .policy import StoreAtRate, StoreOnChange, StoreOnDeadband
+from .readers import Entry, LocalBackend
+from .retention import RetentionSweeper, prune_port
+from .virtual import SocketDevice
+
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def _feed(framer, chunks):
+    frames = []
+    for chunk in chunks:
+        frames.extend(framer.feed(chunk))
+    return frames
+
+
+PAYLOADS = [b'', b'\0', b'\0\0', b'abc', b'a\0b\0', bytes(range(256)), b'x' * 253, b'x' * 254, b'x' * 255, b'\1' * 600]
+
+
+class FramingTests(SimpleTestCase):
+    def test_cobs_round_trip(self):
+        for payload in PAYLOADS:
+            encoded = cobs_encode(payload)
+            self.assertNotIn(b'\0', encoded)
+            self.assertEqual(cobs_decode(encoded), payload)
+
+    def test_cobs_frames_split_across_chunks(self):
+        payloads = [payload for payload in PAYLOADS if payload]
+        stream = b''.join(cobs_encode(payload) + b'\0' for payload in payloads)
+        for size in (1, 2, 7, 300):
+            self.assertEqual(_feed(COBSFramer(), _chunks(stream, size)), payloads)
+
+    def test_cobs_corrupted_frame_is_dropped(self):
+        framer = COBSFramer()
+        bad = bytes([9]) + b'ab'  # code points past the end of the frame
+        frames = framer.feed(cobs_encode(b'one') + b'\0' + bad + b'\0' + cobs_encode(b'two') + b'\0')
+        self.assertEqual(frames, [b'one', b'two'])
+        self.assertEqual(framer.errors, 1)
+
+    def test_cobs_oversized_frame_is_dropped(self):
+        framer = COBSFramer(max_line=10)
+        self.assertEqual(framer.feed(b'\5' * 20), [])
+        self.assertEqual(framer.oversized, 1)
+        self.assertEqual(framer.feed(cobs_encode(b'ok') + b'\0'), [b'ok'])
+
+    def test_slip_round_trip_split_across_chunks(self):
+        payloads = [b'plain', b'\xc0', b'\xdb', b'a\xdb\xdc\xc0b', bytes(range(256))]
+        stream = b''.join(slip_encode(payload) for payload in payloads)
+        for size in (1, 3, 1000):
+            self.assertEqual(_feed(SLIPFramer(), _chunks(stream, size)), payloads)
+
+    def test_length_prefix_round_trip_split_across_chunks(self):
+        for length_bytes, crc in ((1, None), (2, 'crc16'), (4, 'crc32')):
+            encoder = LengthPrefixFramer(length_bytes, crc)
+            payloads = [b'', b'a', b'\0\1\2', b'y' * 200]
+            stream = b''.join(encoder.encode(payload) for payload in payloads)
+            for size in (1, 5, 1000):
+                framer = LengthPrefixFramer(length_bytes, crc)
+                self.assertEqual(_feed(framer, _chunks(stream, size)), payloads)
+
+    def test_length_prefix_bad_crc_resyncs(self):
+        # A false length from inside the bad frame waits for that many bytes
+        # before its CRC can fail, so keep max_line (max_frame) near the real size
+        framer = LengthPrefixFramer(2, 'crc16', max_line=64)
+        corrupted = bytearray(framer.encode(b'hello'))
+        corrupted[3] ^= 0xFF
+        good = [f'frame {i}'.encode() for i in range(300)]
+        stream = bytes(corrupted) + b''.join(framer.encode(payload) for payload in good)
+        self.assertEqual(_feed(framer, _chunks(stream, 64)), good)
+        self.assertGreater(framer.errors, 0)
+
+    def test_line_framer_keeps_partial_line(self):
+        framer = LineFramer()
+        self.assertEqual(framer.feed(b'one\ntw'), [b'one'])
+        self.assertEqual(framer.feed(b'o\nthree'), [b'two'])
+        self.assertEqual(framer.pending, bytearray(b'three'))
+
+    def test_line_framer_cuts_oversized_line(self):
+        framer = LineFramer(max_line=8)
+        self.assertEqual(framer.feed(b'0123456789'), [b'0123456789'])
+        self.assertEqual(framer.oversized, 1)
+
+    def test_text_encoding_round_trip(self):
+        for encoding in ('base64', 'hex'):
+            for payload in PAYLOADS:
+                self.assertEqual(frame_from_text(frame_to_text(payload, encoding), encoding), payload)
+        self.assertEqual(frame_to_text('text line'), 'text line')
+        with self.assertRaises(ValueError):
+            frame_from_text('not base64!', 'base64')
+
+
+def _rule(id, pattern, kind='literal'):
+    return SimpleNamespace(id=id, name=f'rule{id}', kind=kind, pattern=pattern)
+
+
+class PatternTests(SimpleTestCase):
+    def test_aho_corasick_finds_overlapping_keys(self):
+        automaton = AhoCorasick([('he', 1), ('she', 2), ('hers', 3), ('his', 4)])
+        self.assertEqual(sorted(automaton.search('ushers')), [1, 2, 3])
+        self.assertEqual(list(automaton.search('nothing')), [])
+        self.assertEqual(list(AhoCorasick([]).search('text')), [])
+
+    def test_required_literal(self):
+        self.assertEqual(required_literal(r'ERROR \d+'), 'ERROR ')
+        self.assertEqual(required_literal(r'temp=(\d+)C'), 'temp=')
+        self.assertEqual(required_literal(r'(?i)error'), '')
+        self.assertEqual(required_literal(r'a|b'), '')
+
+    def test_ruleset_matches_literal_and_regex_rules(self):
+        rules = [
+            _rule(1, 'FATAL'),
+            _rule(2, r'temp=(\d{3,})', 'regex'),
+            _rule(3, r'^\d+$', 'regex'),  # no literal: scanned on every line
+            _rule(4, r'x{2}', 'regex'),
+        ]
+        ruleset = RuleSet(rules)
+        self.assertEqual([rule.id for rule in ruleset.match('FATAL temp=100')], [1, 2])
+        self.assertEqual(ruleset.match('temp=99'), [])
+        self.assertEqual([rule.id for rule in ruleset.match('12345')], [3])
+        self.assertEqual([rule.id for rule in ruleset.match('FATAL FATAL xx')], [1, 4])
+
+    def test_ruleset_skips_invalid_regex(self):
+        ruleset = RuleSet([_rule(1, '(unclosed', 'regex'), _rule(2, 'ok')])
+        self.assertEqual([rule.id for rule in ruleset.match('ok (unclosed')], [2])
+
+    def test_ruleset_without_prefilter(self):
+        rules = [_rule(i, f'key{i:05d}') for i in range(patterns.PREFILTER_MAX_KEYS + 10)]
+        ruleset = RuleSet(rules)
+        self.assertIsNone(ruleset.prefilter)
+        self.assertEqual([rule.id for rule in ruleset.match('... key00007 ... key01005')], [7, 1005])
+        self.assertEqual(ruleset.match('key'), [])
+
+    def test_pure_python_automaton(self):
+        with mock.patch.object(patterns, 'ahocorasick', None):
+            ruleset = RuleSet([_rule(1, 'alarm'), _rule(2, r'code=E\d+', 'regex')])
+            self.assertEqual([rule.id for rule in ruleset.match('alarm code=E12')], [1, 2])
+
+    def test_ruleset_matches_lines_split_across_chunks(self):
+        # Rules see whole lines, however the port cut them into reads
+        ruleset = RuleSet([_rule(1, 'OVERHEAT'), _rule(2, r'ERR(\d+)', 'regex')])
+        stream = b'ok\nmotor OVERHEAT now\nERR42 seen\nfine\n'
+        for size in (1, 3, 8):
+            lines = [line.decode() for line in _feed(LineFramer(), _chunks(stream, size))]
+            matched = [[rule.id for rule in ruleset.match(line)] for line in lines]
+            self.assertEqual(matched, [[], [1], [2], []])
+
+    def test_trigger_cooldown_is_per_port(self):
+        engine = triggers.TriggerEngine()  # not started: _match() is called directly
+        rule = _rule(1, 'ALARM')
+        rule.port, rule.cooldown_seconds = None, 10  # a rule on every port
+        engine.rules = [rule]
+        with mock.patch.object(engine, '_fire') as fire:
+            engine._match('/dev/ttyA', [Entry(1, 100.0, 'ALARM'), Entry(2, 105.0, 'ALARM')])
+            engine._match('/dev/ttyB', [Entry(1, 106.0, 'ALARM')])
+            engine._match('/dev/ttyA', [Entry(3, 111.0, 'ALARM')])
+        fired = [(call.args[0], [entry.seq for _, entry in call.args[1]]) for call in fire.call_args_list]
+        self.assertEqual(fired, [('/dev/ttyA', [1]), ('/dev/ttyB', [1]), ('/dev/ttyA', [3])])
+
+
+class PolicyTests(SimpleTestCase):
+    def _allowed(self, policy, lines, step=1.0):
+        return [line for i, line in enumerate(lines) if policy.allow(Entry(i + 1, i * step, line))]
+
+    def test_store_on_change(self):
+        self.assertEqual(self._allowed(StoreOnChange(), ['a', 'a', 'b', 'b', 'a']), ['a', 'b', 'a'])
+
+    def test_store_on_change_heartbeat(self):
+        self.assertEqual(self._allowed(StoreOnChange(heartbeat_seconds=2), ['a'] * 5), ['a', 'a', 'a'])
+
+    def test_store_on_deadband(self):
+        lines = ['t=20.0', 't=20.3', 't=20.6', 't=19.9', 'other', 'other']
+        self.assertEqual(self._allowed(StoreOnDeadband(0.5), lines), ['t=20.0', 't=20.6', 't=19.9', 'other'])
+
+    def test_store_at_rate(self):
+        policy = StoreAtRate(2)
+        allowed = [policy.allow(Entry(i, i * 0.25, 'x')) for i in range(8)]
+        self.assertEqual(allowed, [True, True, False, False, True, True, False, False])
+
+    def test_suppressed_lines_still_reach_telemetry(self):
+        lines = ['t=20.0', 't=20.3', 't=20.6', 't=19.9']
+        with mock.patch.object(policy, 'PORT_POLICIES', {'loop://': {'mode': 'deadband', 'deadband': 0.5}}):
+            writer = WriteBehindWriter()
+            writer.telemetry = telemetry.TelemetryIngest(parsers={'loop://': {'format': 'kv'}})
+            writer.submit_many('loop://', [Entry(i + 1, float(i), line) for i, line in enumerate(lines)])
+        batch = [writer.queue.get_nowait() for _ in lines]
+        self.assertEqual([store for _, _, store in batch], [True, False, True, True])
+        writer._parse_telemetry(batch)
+        self.assertEqual(writer.telemetry.samples, 4)
+        self.assertEqual(list(writer.telemetry.blocks['loop://'].columns['t']), [20.0, 20.3, 20.6, 19.9])
+
+
+class TelemetryTests(SimpleTestCase):
+    def test_parsers(self):
+        self.assertEqual(telemetry.parse_csv('1.5,20,x', ['a', 'b', 'c']), {'a': 1.5, 'b': 20.0})
+        self.assertEqual(telemetry.parse_kv('temp=21.5, hum=40 mode=auto'), {'temp': 21.5, 'hum': 40.0})
+
+    def _block(self, samples):
+        block = telemetry._OpenBlock()
+        for timestamp, values in samples:
+            block.add(timestamp, values)
+        names, data = block.pack()
+        return (len(samples), names, data, samples[0][0], samples[-1][0])
+
+    def test_aggregate(self):
+        blocks = [
+            self._block([(0.0, {'a': 1.0}), (1.0, {'a': 3.0, 'b': 10.0})]),
+            self._block([(2.5, {'a': 5.0}), (3.5, {'b': 20.0})]),
+        ]
+        expected = {
+            'a': {'min': [1.0, 5.0], 'max': [3.0, 5.0], 'mean': [2.0, 5.0], 'last': [3.0, 5.0]},
+            'b': {'min': [10.0, 20.0], 'max': [10.0, 20.0], 'mean': [10.0, 20.0], 'last': [10.0, 20.0]},
+        }
+        starts, result = telemetry.aggregate(blocks, 0.0, 4.0, 2)
+        self.assertEqual(starts, [0.0, 2.0])
+        self.assertEqual(result, expected)
+        self.assertEqual(telemetry._aggregate_python(blocks, 0.0, 4.0, 2, None), expected)
+
+    def test_aggregate_empty_buckets(self):
+        blocks = [self._block([(0.5, {'a': 1.0})])]
+        _, result = telemetry.aggregate(blocks, 0.0, 3.0, 3)
+        self.assertEqual(result['a']['mean'], [1.0, None, None])
+        self.assertTrue(math.isnan(telemetry.parse_csv('nan', ['a'])['a']))
+
+
+class SegmentStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_append_and_query_across_sealed_segments(self):
+        store = SegmentStore(self.root, segment_bytes=200, compress=True)
+        entries = [Entry(seq, 1000.0 + seq, f'line {seq}') for seq in range(1, 51)]
+        entries.append(Entry(51, 1051.0, b'\0\xffbinary'))
+        store.append('/dev/ttyTEST', entries[:25])
+        store.append('/dev/ttyTEST', entries[25:])
+        self.assertGreater(len(store._segments('/dev/ttyTEST')), 1)
+        found, more = store.query('/dev/ttyTEST', limit=1000)
+        self.assertFalse(more)
+        self.assertEqual(found, entries)
+        found, more = store.query('/dev/ttyTEST', start=1010.0, end=1012.0)
+        self.assertEqual([entry.seq for entry in found], [10, 11, 12])
+        found, more = store.query('/dev/ttyTEST', start=1040.0, limit=5)
+        self.assertTrue(more)
+        self.assertEqual([entry.seq for entry in found], [40, 41, 42, 43, 44])
+        store.close()
+
+    def test_resume_after_seq_at_same_timestamp(self):
+        store = SegmentStore(self.root)
+        store.append('/dev/ttyTEST', [Entry(seq, 5.0, str(seq)) for seq in range(1, 6)])
+        found, _ = store.query('/dev/ttyTEST', start=5.0, after=3)
+        self.assertEqual([entry.seq for entry in found], [4, 5])
+        store.close()
+
+
+class LifecycleTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple(lifecycle, RECONNECT_MIN_SECONDS=1, RECONNECT_MAX_SECONDS=8)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manager = lifecycle.PortLifecycle(idle_timeout=None, max_open=2)  # not started: no sweep
+
+    def test_reconnect_backoff_doubles_up_to_the_max(self):
+        port = 'loop://test'
+        self.manager.opened(port, port)
+        delays = []
+        self.manager.lost(port, 'unplugged')
+        for _ in range(5):
+            state = self.manager.states[port]
+            delays.append(round(state.next_attempt - time.monotonic()))
+            self.manager.open_failed(port, 'still gone')
+        self.assertEqual(delays, [1, 2, 4, 8, 8])
+        self.assertEqual(self.manager.status(port)['state'], 'reconnecting')
+        with self.assertRaises(serial.SerialException):
+            self.manager.check_open(port)
+        self.manager.opened(port, port)
+        self.assertEqual(self.manager.status(port)['failures'], 0)
+
+    def test_first_open_failure_is_not_retried(self):
+        self.manager.open_failed('loop://typo', 'no such port')
+        self.assertEqual(self.manager.status('loop://typo')['state'], 'failed')
+        self.manager.check_open('loop://typo')  # asking again simply tries again
+
+    def test_closing_on_purpose_forgets_the_backoff(self):
+        self.manager.lost('loop://test', 'unplugged')
+        self.manager.closed('loop://test', 'stopped')
+        status = self.manager.status('loop://test')
+        self.assertEqual((status['state'], status['reason'], status['failures']), ('closed', 'stopped', 0))
+
+    def test_eviction_picks_least_recently_used_idle_port(self):
+        readers = {port: SimpleNamespace(in_use=lambda: False) for port in ('a', 'b')}
+        self.assertIsNone(self.manager.choose_eviction({'a': readers['a']}))
+        self.manager.touch('b')
+        self.manager.touch('a')
+        self.assertIs(self.manager.choose_eviction(readers), readers['b'])
+        readers['b'].in_use = lambda: True
+        self.assertIs(self.manager.choose_eviction(readers), readers['a'])
+        readers['a'].in_use = lambda: True
+        with self.assertRaises(serial.SerialException):
+            self.manager.choose_eviction(readers)
+
+
+class CommandTests(SimpleTestCase):
+    def _channel(self):
+        reader = SimpleNamespace(full_port='loop://cmd', last_seq=0, add_subscriber=lambda subscriber: [])
+        reader.writer = writers.PortWriter(reader)  # never started: submit() only queues
+        return CommandChannel(reader)
+
+    def _send(self, channel, requests):
+        # On another thread, so a deadlock fails the test instead of hanging the run
+        sent = {}
+        thread = threading.Thread(target=lambda: sent.update(commands=channel.send(requests)), daemon=True)
+        thread.start()
+        thread.join(2)
+        self.assertFalse(thread.is_alive(), 'send() deadlocked')
+        return sent['commands']
+
+    def test_send_through_stopped_writer_fails_the_commands(self):
+        channel = self._channel()
+        channel.reader.writer.stop()
+        commands = self._send(channel, [([b'AT\n'], ReplyMatcher()), ([b'AT\n'], ReplyMatcher())])
+        for command in commands:
+            with self.assertRaisesRegex(serial.SerialException, 'closed'):
+                channel.wait(command, 0)
+        self.assertFalse(channel.pending)
+
+    def test_send_through_full_writer_fails_the_overflow(self):
+        with mock.patch.object(writers, 'WRITE_QUEUE_SIZE', 1):
+            channel = self._channel()
+        first, second = self._send(channel, [([b'A\n'], ReplyMatcher()), ([b'B\n'], ReplyMatcher())])
+        self.assertFalse(first.future.done())
+        with self.assertRaisesRegex(serial.SerialException, 'full'):
+            second.future.result(0)
+        self.assertEqual(list(channel.pending), [first])
+
+    def _reply(self, channel, *lines):
+        for line in lines:
+            channel.reader.last_seq += 1
+            channel.publish(Entry(channel.reader.last_seq, time.time(), line))
+
+    def test_matcher_skips_unsolicited_lines(self):
+        channel = self._channel()
+        channel.reader.last_seq = 1
+        version, status = channel.send([
+            ([b'AT+GMR\n'], ReplyMatcher(regex=r'^v\d')),
+            ([b'AT+STATUS\n'], ReplyMatcher(prefix='+STATUS', terminator='OK')),
+        ])
+        channel.publish(Entry(1, time.time(), 'v0.9'))  # read before the command went out
+        self._reply(channel, 'log: boot', 'v2.1', '+STATUS: up', 'temp=40', 'OK', 'log: idle')
+        self.assertEqual(channel.wait(version, 0)[0], ['v2.1'])
+        self.assertEqual(channel.wait(status, 0)[0], ['+STATUS: up', 'temp=40', 'OK'])
+        self.assertFalse(channel.pending)
+
+    def test_pipelined_replies_go_to_commands_in_order(self):
+        channel = self._channel()
+        commands = channel.send([([f'GET {i}\n'.encode()], ReplyMatcher(prefix='=')) for i in range(3)])
+        self.assertEqual([command.after_seq for command in commands], [0, 0, 0])
+        self._reply(channel, '=a', '=b', '=c', '=extra')
+        self.assertEqual([channel.wait(command, 0)[0] for command in commands], [['=a'], ['=b'], ['=c']])
+        written = [channel.reader.writer.queue.get_nowait()[0] for _ in range(3)]
+        self.assertEqual(written, [[b'GET 0\n'], [b'GET 1\n'], [b'GET 2\n']])
+        self.assertTrue(channel.reader.writer.queue.empty())
+
+    def test_timed_out_command_lets_the_next_one_be_answered(self):
+        channel = self._channel()
+        first, second = channel.send([([b'A\n'], ReplyMatcher(prefix='A:')), ([b'B\n'], ReplyMatcher(prefix='B:'))])
+        with self.assertRaises(CommandTimeout):
+            channel.wait(first, 0.05)
+        self._reply(channel, 'B: done')
+        self.assertEqual(channel.wait(second, 0)[0], ['B: done'])
+
+    def test_closing_the_port_fails_waiting_commands(self):
+        channel = self._channel()
+        command, = channel.send([([b'X\n'], ReplyMatcher())])
+        channel.finish()
+        with self.assertRaisesRegex(serial.SerialException, 'closed'):
+            channel.wait(command, 0)
+        with self.assertRaises(serial.SerialException):
+            channel.send([([b'Y\n'], ReplyMatcher())])
+
+
+class WriteBehindTests(TransactionTestCase):
+    def setUp(self):
+        self.writer = WriteBehindWriter(backend='db')  # not started: batches are flushed directly
+
+    def _stored(self):
+        return sorted(SerialOutput.objects.values_list('port__port', 'output'))
+
+    def test_deleted_port_row_keeps_the_other_ports_lines(self):
+        self.writer._flush([('/dev/ttyA', Entry(1, 1.0, 'a1')), ('/dev/ttyB', Entry(1, 1.0, 'b1'))])
+        Port.objects.filter(port='/dev/ttyA').delete()  # the port id stays cached
+        self.writer._flush([('/dev/ttyA', Entry(2, 2.0, 'a2')), ('/dev/ttyB', Entry(2, 2.0, 'b2'))])
+        self.assertEqual(self._stored(), [('/dev/ttyA', 'a2'), ('/dev/ttyB', 'b1'), ('/dev/ttyB', 'b2')])
+        self.assertEqual((self.writer.flushes, self.writer.errors), (2, 0))
+
+    def test_lines_are_written_in_batches(self):
+        writer = WriteBehindWriter(batch_size=10, flush_interval_ms=60000, backend='db')
+        writer.retention = RetentionSweeper(interval=3600)  # no pruning while counting rows
+        writer.start()
+        writer.submit_many('/dev/ttyA', [Entry(i, 100.0 + i, f'line {i}') for i in range(1, 26)])
+        writer.submit('/dev/ttyB', Entry(1, 200.0, b'\0\xff'))
+        writer.stop()  # flushes what is left
+        self.assertEqual((writer.flushes, writer.rows_written, writer.errors), (3, 26, 0))
+        rows = list(SerialOutput.objects.order_by('id').values_list('port__port', 'output', 'data', 'timestamp'))
+        self.assertEqual([row[1] for row in rows[:25]], [f'line {i}' for i in range(1, 26)])
+        self.assertEqual(rows[0][3].timestamp(), 101.0)  # the time the line was read, not flushed
+        self.assertEqual((rows[25][0], rows[25][1], bytes(rows[25][2])), ('/dev/ttyB', '', b'\0\xff'))
+
+    def test_failed_flush_drops_only_that_batch(self):
+        with mock.patch.object(SerialOutput.objects, 'bulk_create', side_effect=DatabaseError('disk I/O error')):
+            self.writer._flush([('/dev/ttyA', Entry(1, 1.0, 'lost'))])
+        self.writer._flush([('/dev/ttyA', Entry(2, 2.0, 'kept'))])
+        self.assertEqual(self._stored(), [('/dev/ttyA', 'kept')])
+        self.assertEqual((self.writer.flushes, self.writer.rows_written, self.writer.errors), (1, 1, 1))
+
+
+class RetentionTests(TransactionTestCase):
+    def _port(self, name, timestamps):
+        port = Port.objects.create(port=name)
+        SerialOutput.objects.bulk_create([
+            SerialOutput(port=port, output=str(i), timestamp=datetime.fromtimestamp(ts, tz=timezone.utc))
+            for i, ts in enumerate(timestamps)
+        ])
+        return port
+
+    def _kept(self, port):
+        return list(port.serial_outputs.order_by('id').values_list('output', flat=True))
+
+    def test_max_rows_keeps_the_newest(self):
+        # Rows 3 and 4 share a timestamp: the cut between them goes by id
+        port = self._port('/dev/ttyA', [1.0, 2.0, 3.0, 4.0, 4.0, 5.0])
+        self.assertEqual(prune_port(port.id, max_rows=3), 3)
+        self.assertEqual(self._kept(port), ['3', '4', '5'])
+        self.assertEqual(prune_port(port.id, max_rows=3), 0)
+
+    def test_max_age_drops_old_rows(self):
+        now = time.time()
+        port = self._port('/dev/ttyA', [now - 100, now - 50, now - 5, now])
+        self.assertEqual(prune_port(port.id, max_age_seconds=30), 2)
+        self.assertEqual(self._kept(port), ['2', '3'])
+
+    def test_sweep_prunes_written_ports_by_their_policy(self):
+        busy = self._port('/dev/ttyBUSY', [float(i) for i in range(1, 11)])
+        quiet = self._port('/dev/ttyQUIET', [float(i) for i in range(1, 11)])
+        per_port = {'/dev/ttyBUSY': {'max_rows': 4}}
+        with mock.patch.multiple(retention, DEFAULT_POLICY={'max_rows': 2, 'max_age_seconds': None}, PORT_POLICIES=per_port):
+            sweeper = RetentionSweeper(interval=0)
+            sweeper.note('/dev/ttyBUSY', busy.id)
+            sweeper.sweep_if_due()
+            self.assertEqual(self._kept(busy), ['6', '7', '8', '9'])
+            self.assertEqual(len(self._kept(quiet)), 10)  # nothing written to it since the last sweep
+            sweeper.note('/dev/ttyQUIET', quiet.id)
+            sweeper.sweep_if_due()
+        self.assertEqual(self._kept(quiet), ['8', '9'])
+        self.assertEqual((sweeper.sweeps, sweeper.rows_deleted), (2, 14))
+
+
+class ExportTests(TransactionTestCase):
+    LINES = ['boot', 'temp=21.5', 'a, "quoted" line', b'\0\xffraw', 'last']
+
+    def setUp(self):
+        port = Port.objects.create(port='/dev/ttyEXP')
+        SerialOutput.objects.bulk_create([
+            SerialOutput(
+                port=port, output=line if isinstance(line, str) else '', data=line if isinstance(line, bytes) else None,
+                timestamp=datetime.fromtimestamp(1000.0 + i, tz=timezone.utc),
+            )
+            for i, line in enumerate(self.LINES)
+        ])
+
+    def test_ndjson_time_range(self):
+        response = self.client.get('/serial/export/ttyEXP/', {'start': 1001, 'end': 1003})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="ttyEXP.ndjson"')
+        records = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([record['timestamp'] for record in records], [1001.0, 1002.0, 1003.0])
+        self.assertEqual(records[2], {'seq': records[2]['seq'], 'timestamp': 1003.0, 'line': 'AP9yYXc=', 'encoding': 'base64'})
+        self.assertEqual(records[1]['line'], 'a, "quoted" line')
+
+    def test_gzipped_csv(self):
+        response = self.client.get('/serial/export/ttyEXP/', {'format': 'csv', 'gzip': '1'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        rows = list(csv.reader(io.StringIO(gzip.decompress(b''.join(response.streaming_content)).decode())))
+        self.assertEqual(rows[0], ['seq', 'timestamp', 'line', 'encoding'])
+        self.assertEqual([row[2] for row in rows[1:]], ['boot', 'temp=21.5', 'a, "quoted" line', 'AP9yYXc=', 'last'])
+        self.assertEqual(rows[4][3], 'base64')
+
+    def test_output_comes_in_bounded_chunks(self):
+        with mock.patch.multiple(export, EXPORT_BUFFER_BYTES=40, EXPORT_CHUNK_SIZE=2):
+            whole = b''.join(export_chunks(iter_history('/dev/ttyEXP'), 'csv'))
+            chunks = list(export_chunks(iter_history('/dev/ttyEXP'), 'csv'))
+            gzipped = list(export_chunks(iter_history('/dev/ttyEXP'), 'csv', compress=True))
+        self.assertGreater(len(chunks), 2)
+        self.assertTrue(all(len(chunk) < 80 for chunk in chunks))
+        self.assertEqual(b''.join(chunks), whole)
+        self.assertEqual(gzip.decompress(b''.join(gzipped)), whole)
+
+    async def test_asgi_export_is_streamed(self):
+        response = await AsyncClient().get('/serial/export/ttyEXP/')
+        self.assertTrue(response.is_async)
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual([json.loads(line)['timestamp'] for line in body.splitlines()], [1000.0 + i for i in range(5)])
+
+
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting')
+        time.sleep(0.02)
+
+
+class CaptureTests(TransactionTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'session.cap')
+
+    def test_capture_file_round_trip(self):
+        records = [(100.0, b'boot\r\n'), (100.25, b'\0\xff'), (101.5, b'')]
+        capture = CaptureWriter(self.path, '/dev/ttyTEST')
+        for timestamp, data in records:
+            capture.write(timestamp, data)
+        capture.close()
+        header, found = open_capture(self.path)
+        self.assertEqual(header['port'], '/dev/ttyTEST')
+        self.assertEqual(list(found), records)
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 1)  # a record cut short by a crash
+        self.assertEqual(list(open_capture(self.path)[1]), records[:2])
+        with self.assertRaises(ValueError):
+            open_capture(__file__)
+
+    def test_replay_keeps_the_recorded_spacing(self):
+        records = [(50.0, b'a'), (50.2, b'b'), (50.4, b'c')]
+        written = []
+        started = time.monotonic()
+        self.assertEqual(replay(records, written.append, speed=2), (3, 3))
+        self.assertGreaterEqual(time.monotonic() - started, 0.19)
+        self.assertEqual(written, [b'a', b'b', b'c'])
+
+    def test_recorded_session_replays_through_a_virtual_device(self):
+        self.addCleanup(stop_writer)
+        self.addCleanup(readers.stop_all_readers)
+        reader = readers.ensure_reader('loop://')
+        reader.start_recording(self.path)
+        sent = [b'one\ntw', b'o\n', b'three\n']
+        LocalBackend().write('loop://', sent)
+        _wait_until(lambda: reader.last_seq >= 3)
+        self.assertEqual(reader.stop_recording()['bytes'], len(b''.join(sent)))
+        _, records = open_capture(self.path)
+        self.assertEqual(b''.join(data for _, data in records), b''.join(sent))
+
+        device = SocketDevice()
+        self.addCleanup(device.close)
+        replayed = readers.ensure_reader(device.name)
+        self.assertTrue(device.wait_opened(timeout=5))
+        replay(open_capture(self.path)[1], device.write, speed=0)
+        _wait_until(lambda: replayed.last_seq >= 3)
+        self.assertEqual([entry.line for entry in replayed.read_since(0, 10)[0]], ['one', 'two', 'three'])
+
+
+class LongPollTests(TransactionTestCase):
+    """GET /serial/data/ against a loop:// port, which reads back what is written to it."""
+
+    def setUp(self):
+        patcher = mock.patch.dict(readers.VIRTUAL_PORTS, {'looptest': 'loop://'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(stop_writer)  # flush the lines read into the test DB while it exists
+        self.addCleanup(readers.stop_all_readers)
+        self.client = AsyncClient()
+
+    async def _get(self, **params):
+        response = await self.client.get('/serial/data/looptest/', params)
+        return json.loads(response.content)
+
+    async def _write(self, text):
+        await asyncio.to_thread(LocalBackend().write, 'loop://', [text.encode() + b'\n'])
+
+    async def test_waiting_polls_hold_no_threads(self):
+        cursor = (await self._get())['next']
+        # Far more waiting requests than the default executor has threads
+        polls = [asyncio.ensure_future(self._get(since=cursor, wait=5)) for _ in range(40)]
+        await asyncio.sleep(0.3)
+        started = time.monotonic()
+        await self._get()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertFalse(any(poll.done() for poll in polls))
+        await self._write('wake up')
+        results = await asyncio.wait_for(asyncio.gather(*polls), 5)
+        self.assertEqual({tuple(result['lines']) for result in results}, {('wake up',)})
+
+    async def _command(self, **body):
+        response = await self.client.post(
+            '/serial/command/', json.dumps({'port': 'looptest', **body}), content_type='application/json'
+        )
+        return response.status_code, json.loads(response.content)
+
+    async def test_waiting_commands_hold_no_threads(self):
+        await self._get()  # open the port
+        # The port echoes each command, which doesn't start the expected reply
+        commands = [asyncio.ensure_future(self._command(command=f'ping {i}', prefix='pong', timeout=2)) for i in range(40)]
+        await asyncio.sleep(0.3)
+        started = time.monotonic()
+        await self._get()
+        self.assertLess(time.monotonic() - started, 1)
+        results = await asyncio.wait_for(asyncio.gather(*commands), 5)
+        self.assertEqual({(status, result['status']) for status, result in results}, {(504, 'timeout')})
+        self.assertEqual(await self._command(command='hello', timeout=2), (200, {
+            'port': 'loop://', 'reply': ['hello'], 'latency_ms': mock.ANY, 'status': 'ok',
+        }))
+
+    async def test_poll_times_out_empty(self):
+        cursor = (await self._get())['next']
+        started = time.monotonic()
+        result = await self._get(since=cursor, wait=0.3)
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual((result['lines'], result['next']), ([], cursor))
+
+    async def test_dashboard_polls_hold_no_threads(self):
+        response = await self.client.get('/serial/dashboard/data/', {'ports': 'looptest'})
+        cursor = json.loads(response.content)['cursor']
+        polls = [
+            asyncio.ensure_future(self.client.get('/serial/dashboard/data/', {'ports': 'looptest', 'since': cursor, 'wait': 5}))
+            for _ in range(40)
+        ]
+        await asyncio.sleep(0.3)
+        started = time.monotonic()
+        await self._get()
+        self.assertLess(time.monotonic() - started, 1)
+        await self._write('dashboard')
+        results = [json.loads(response.content) for response in await asyncio.wait_for(asyncio.gather(*polls), 5)]
+        self.assertEqual({tuple(result['ports']['looptest']['lines']) for result in results}, {('dashboard',)})
+
+    async def test_cursor_from_before_a_restart_resets(self):
+        await self._get()
+        for text in ('one', 'two', 'three'):
+            await self._write(text)
+        await asyncio.sleep(0.2)
+        started = time.monotonic()
+        result = await self._get(since=5000, wait=2)
+        self.assertLess(time.monotonic() - started, 1)  # nothing to wait for
+        self.assertTrue(result['reset'])
+        self.assertEqual(result['lines'], ['one', 'two', 'three'])
+        self.assertLess(result['next'], 5000)
+        response = await self.client.get('/serial/dashboard/data/', {'ports': 'looptest', 'since': 'looptest:5000'})
+        port = json.loads(response.content)['ports']['looptest']
+        self.assertTrue(port['reset'])
+        self.assertEqual((port['lines'], port['next']), (['one', 'two', 'three'], result['next']))
+
+    def test_stream_backlog_after_a_restart(self):
+        reader = readers.ensure_reader('loop://')
+        reader._append(['a', 'b'])
+        self.assertEqual([entry.line for entry in reader.add_subscriber(readers._Waker(), since=5000)], ['a', 'b'])
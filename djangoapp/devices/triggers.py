@@ -0,0 +1,237 @@
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count, Max
+
+from . import metrics
+from .framing import frame_to_text
+from .models import TriggerEvent, TriggerRule
+from .patterns import RuleSet
+from .persistence import get_port_id
+from .streaming import Subscription
+
+logger = logging.getLogger(__name__)
+
+# Rules are re-read from the DB this often, so rules edited in the admin (or
+# by another process) apply without a restart
+RELOAD_SECONDS = getattr(settings, 'SERIAL_TRIGGER_RELOAD_SECONDS', 5)
+# Seconds a webhook POST may take
+WEBHOOK_TIMEOUT = getattr(settings, 'SERIAL_TRIGGER_WEBHOOK_TIMEOUT', 5)
+QUEUE_SIZE = 10000  # batches of lines waiting to be matched before new ones are dropped
+WEBHOOK_QUEUE_SIZE = 1000  # webhook calls waiting to be sent before new ones are dropped
+
+_STOP = object()
+
+
+class WebhookSender(threading.Thread):
+    """POSTs fired triggers as JSON, so a slow endpoint never holds up matching."""
+
+    def __init__(self):
+        super().__init__(name='serial-trigger-webhooks', daemon=True)
+        self.queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+    def submit(self, url, payload):
+        try:
+            self.queue.put_nowait((url, payload))
+        except queue.Full:
+            metrics.trigger_webhook_failures.inc()
+            logger.warning("Webhook queue full, dropping trigger %s for %s", payload['rule'], url)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            url, payload = item
+            request = urllib.request.Request(
+                url, data=json.dumps(payload).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}, method='POST',
+            )
+            try:
+                with urllib.request.urlopen(request, timeout=WEBHOOK_TIMEOUT) as response:
+                    response.read()
+            except Exception as e:
+                metrics.trigger_webhook_failures.inc()
+                logger.warning("Trigger webhook %s failed: %s", url, e)
+
+
+class TriggerEngine(threading.Thread):
+    """Matches every line read from the ports against the trigger rules and fires their actions.
+
+    Readers hand over each batch of lines with submit(), which only queues
+    it, so matching and actions never slow down reading. Rules are compiled
+    per port into a RuleSet (see patterns.py) and recompiled when the rules
+    in the DB change. Without any enabled rule, submit() does nothing.
+    """
+
+    def __init__(self):
+        super().__init__(name='serial-triggers', daemon=True)
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.webhooks = WebhookSender()
+        self.rules = []
+        self.rulesets = {}  # full port path -> RuleSet
+        self.version = None
+        self.reload_at = 0
+        self.active = False
+        self.last_fired = {}  # (rule id, full port path) -> timestamp of the line that last fired it
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def start(self):
+        self._reload()  # so submit() knows right away whether there is anything to match
+        self.webhooks.start()
+        super().start()
+
+    def submit(self, full_port, entries):
+        if not self.active:
+            return
+        try:
+            self.queue.put_nowait((full_port, entries))
+        except queue.Full:
+            metrics.trigger_lines_dropped.inc(len(entries), full_port)
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0, self.reload_at - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            if time.monotonic() >= self.reload_at:
+                self._reload()
+            if item is not None:
+                try:
+                    self._match(*item)
+                except Exception as e:
+                    logger.exception("Error running triggers for %s: %s", item[0], e)
+        try:
+            self.webhooks.queue.put_nowait(_STOP)
+        except queue.Full:
+            pass  # daemon thread, goes away with the process
+        close_old_connections()
+
+    def _reload(self):
+        self.reload_at = time.monotonic() + RELOAD_SECONDS
+        try:
+            version = TriggerRule.objects.aggregate(count=Count('id'), updated=Max('updated_at'))
+            if version != self.version:
+                rules = list(TriggerRule.objects.filter(enabled=True).select_related('port'))
+                self.rules = rules
+                self.rulesets = {}
+                self.version = version
+                self.active = bool(rules)
+                logger.info("Loaded %d trigger rules", len(rules))
+        except Exception as e:
+            logger.error("Error loading trigger rules: %s", e)
+        finally:
+            close_old_connections()
+
+    def _ruleset(self, full_port):
+        ruleset = self.rulesets.get(full_port)
+        if ruleset is None:
+            rules = [rule for rule in self.rules if rule.port is None or rule.port.port == full_port]
+            ruleset = self.rulesets[full_port] = RuleSet(rules)
+        return ruleset
+
+    def _match(self, full_port, entries):
+        ruleset = self._ruleset(full_port)
+        if not ruleset:
+            return
+        fired = []
+        for entry in entries:
+            text = entry.line.decode('latin-1') if isinstance(entry.line, bytes) else entry.line
+            for rule in ruleset.match(text):
+                # The cooldown is per port, so a rule on all ports still fires on each of them
+                last = self.last_fired.get((rule.id, full_port))
+                if last is not None and entry.timestamp - last < rule.cooldown_seconds:
+                    continue
+                self.last_fired[rule.id, full_port] = entry.timestamp
+                fired.append((rule, entry))
+        if fired:
+            metrics.trigger_matches.inc(len(fired), full_port)
+            self._fire(full_port, fired)
+
+    def _fire(self, full_port, fired):
+        events = []
+        for rule, entry in fired:
+            payload = {
+                'rule': rule.name,
+                'rule_id': rule.id,
+                'port': full_port,
+                'seq': entry.seq,
+                'timestamp': entry.timestamp,
+                'line': frame_to_text(entry.line),
+            }
+            if isinstance(entry.line, bytes):
+                payload['encoding'] = 'base64'
+            if 'event' in rule.actions:
+                events.append(TriggerEvent(
+                    rule_id=rule.id,
+                    port_id=get_port_id(full_port),
+                    seq=entry.seq,
+                    timestamp=datetime.fromtimestamp(entry.timestamp, tz=timezone.utc),
+                    line=payload['line'],
+                ))
+            if 'webhook' in rule.actions and rule.webhook_url:
+                self.webhooks.submit(rule.webhook_url, payload)
+            if 'stream' in rule.actions:
+                with self.lock:
+                    subscribers = list(self.subscribers)
+                for subscription in subscribers:
+                    subscription.publish(('trigger', payload))
+        if events:
+            try:
+                TriggerEvent.objects.bulk_create(events)
+            except Exception as e:
+                logger.error("Database Error saving %d trigger events: %s", len(events), e)
+            finally:
+                close_old_connections()
+
+    def subscribe(self, loop):
+        subscription = Subscription(self, loop)
+        self.add_subscriber(subscription)
+        return subscription
+
+    def add_subscriber(self, subscription):
+        with self.lock:
+            self.subscribers.add(subscription)
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def stop(self, timeout=5):
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_trigger_engine():
+    """Return the process-wide trigger engine, starting it on first use."""
+    global _engine
+    if _engine is None or not _engine.is_alive():
+        with _engine_lock:
+            if _engine is None or not _engine.is_alive():
+                engine = TriggerEngine()
+                engine.start()
+                _engine = engine
+    return _engine
+
+
+def stop_trigger_engine():
+    if _engine is not None and _engine.is_alive():
+        _engine.stop()
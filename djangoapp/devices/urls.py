@@ -3,7 +3,24 @@ from devices import views
 
 urlpatterns = [
     path('serial/devices/', views.list_devices, name='list_devices'),
+    path('serial/devices/info/', views.list_devices_info, name='list_devices_info'),
+    path('serial/devices/events/', views.stream_device_events, name='stream_device_events'),
+    path('serial/ports/status/', views.get_port_status, name='get_port_status'),
+    path('serial/ports/status/<str:port>/', views.get_port_status, name='get_port_status_port'),
     path('serial/data/<str:port>/', views.get_serial_data, name='get_serial_data'),
+    path('serial/history/<str:port>/', views.get_serial_history, name='get_serial_history'),
+    path('serial/export/<str:port>/', views.export_serial_data, name='export_serial_data'),
+    path('serial/telemetry/<str:port>/', views.get_serial_telemetry, name='get_serial_telemetry'),
+    path('serial/stream/<str:port>/', views.stream_serial_data, name='stream_serial_data'),
     path('serial/data/view/<str:port>/', views.serial_data_view, name='serial_data_view'),
+    path('serial/dashboard/', views.dashboard_view, name='dashboard_view'),
+    path('serial/dashboard/data/', views.get_dashboard_data, name='get_dashboard_data'),
+    path('serial/dashboard/stream/', views.stream_dashboard, name='stream_dashboard'),
+    path('serial/triggers/events/', views.get_trigger_events, name='get_trigger_events'),
+    path('serial/triggers/stream/', views.stream_triggers, name='stream_triggers'),
     path('serial/send/', views.send_serial, name='send_serial'),
+    path('serial/send/batch/', views.send_serial_batch, name='send_serial_batch'),
+    path('serial/command/', views.send_command, name='send_command'),
+    path('serial/record/', views.record_serial, name='record_serial'),
+    path('serial/metrics/', views.metrics_view, name='serial_metrics'),
 ]
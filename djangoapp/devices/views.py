@@ -1,123 +1,376 @@
 import serial
 import json
+import re
+import logging
 from django.shortcuts import render
-from django.http import JsonResponse, HttpResponse
-import serial.tools.list_ports
-from .models import Port, SerialOutput # Assuming you still need models
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
+import asyncio
 from django.views.decorators.csrf import csrf_exempt
-import time # Optional: for potential small delay after write
 import atexit
-# Shared connection pool (keep this global or manage appropriately)
-ser_connections = {}
-last_lines = {}  # cache to avoid saving duplicates
+# Shared connection pool and background readers live in readers.py
+from .readers import ser_connections, resolve_port, stop_all_readers
+from .broker import BrokerClient, get_backend
+from .commands import DEFAULT_TIMEOUT as DEFAULT_COMMAND_TIMEOUT, MAX_TIMEOUT as MAX_COMMAND_TIMEOUT, ReplyMatcher
+from . import metrics
+from .streaming import device_event_stream, format_cursors, multiplex_stream, named_event_stream, parse_cursors
+from .framing import FRAME_ENCODINGS, frame_from_text, frame_to_text
+from .persistence import stop_writer
+from .triggers import stop_trigger_engine
+from .lifecycle import stop_port_manager
+from .discovery import get_discovery
+from .history import HISTORY_BACKEND, get_store
+from . import telemetry
+from .export import EXPORT_FORMATS, aiter_chunks, export_chunks, iter_history
+from .models import SerialOutput, TriggerEvent
+from django.utils.dateparse import parse_datetime
+from django.db.models import Q
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
 
 def list_serial_ports():
-    available_ports = []
-    ports = serial.tools.list_ports.comports()
-    for port_info in ports:
-        # Simple check, might need refinement based on your OS/device naming
-        if 'ttyACM' in port_info.device or 'ttyUSB' in port_info.device or 'COM' in port_info.device:
-             # Basic check if port is likely usable - opening it here can be slow/problematic
-             # A better approach might be just listing likely candidates
-             available_ports.append(port_info.device) # Store the full device path
-    return available_ports
-
-def get_serial_data(request, port):
-    # Construct the full port name expected by pyserial (/dev/ttyACM0 etc.)
-    # This assumes 'port' from the URL is like 'ttyACM0'. Adjust if needed.
-    full_port = f'/dev/{port}'
-    # If your URL already contains /dev/ttyACM0, just use: full_port = port
+    # Device paths of the likely serial ports, served from the discovery cache
+    # (see discovery.py) instead of walking sysfs on every request
+    return [info['device'] for info in get_discovery().list_ports()]
 
-    if full_port not in ser_connections:
-        try:
-            print(f"Attempting to open {full_port} for reading...")
-            ser_connections[full_port] = serial.Serial(full_port, 115200, timeout=0.1)
-            print(f"Successfully opened {full_port}")
-            time.sleep(0.5)
-        except serial.SerialException as e:
-            print(f"Failed to open port {full_port} for reading: {str(e)}")
-            if full_port in ser_connections:
-                del ser_connections[full_port]
-            return JsonResponse({'lines': [], 'error': f'Failed to open port {full_port}: {str(e)}'})
-        except Exception as e:
-            print(f"Unexpected error opening port {full_port}: {str(e)}")
-            if full_port in ser_connections:
-                 del ser_connections[full_port]
-            return JsonResponse({'lines': [], 'error': f'Unexpected error opening port {full_port}: {str(e)}'})
+DEFAULT_FETCH_LIMIT = 100
+MAX_FETCH_LIMIT = 1000
+MAX_WAIT_SECONDS = 30
 
-    ser = ser_connections.get(full_port)
-
-    if not ser or not ser.is_open:
-         print(f"Serial connection for {full_port} not found or closed.")
-         if full_port in ser_connections:
-             del ser_connections[full_port]
-         return JsonResponse({'lines': [], 'error': f'Serial port {full_port} is not open.'})
-
-    lines_read = []
-    port_obj = None # To store the Port model instance
 
+async def get_serial_data(request, port):
+    # Construct the full port name expected by pyserial (/dev/ttyACM0 etc.)
+    # This assumes 'port' from the URL is like 'ttyACM0'. Adjust if needed.
+    full_port = resolve_port(port)
+
+    # Query parameters:
+    #   since=<seq>  only return lines newer than this cursor (omit for the latest lines)
+    #   limit=<n>    at most this many lines
+    #   wait=<s>     long-poll: hold the request up to s seconds until something newer arrives
+    #   encoding=    base64 (default) or hex, for ports with a binary framing
+    encoding = request.GET.get('encoding', 'base64')
+    if encoding not in FRAME_ENCODINGS:
+        return JsonResponse({'lines': [], 'error': f'encoding must be one of {", ".join(FRAME_ENCODINGS)}'}, status=400)
     try:
-        new_data_saved = False # Flag to check if we need to prune
-
-        while ser.in_waiting > 0:
-            line = ser.readline().decode('utf-8', errors='ignore').strip()
-            if line: # Process only non-empty lines
-                print(f"Read from {full_port}: {line}")
-                lines_read.append(line) # Add to list for JSON response
-
-                # --- Database Interaction ---
-                try:
-                    # 1. Get or Create Port object (only once per request if needed)
-                    if port_obj is None:
-                         port_obj, created = Port.objects.get_or_create(port=full_port)
-                         if created:
-                             print(f"Created Port DB entry for {full_port}")
-
-                    # 2. Create SerialOutput entry
-                    SerialOutput.objects.create(port=port_obj, output=line)
-                    # print(f"Saved output to DB for {full_port}: {line[:30]}...") # Optional: log DB save
-                    new_data_saved = True # Mark that we saved something
-
-                except Exception as db_error:
-                    # Log DB specific errors without crashing the read loop
-                    print(f"Database Error saving output for {full_port}: {db_error}")
-                # --- End Database Interaction for this line ---
-
-        # --- Pruning Logic (Run only if new data was saved for this port) ---
-        if new_data_saved and port_obj:
-            try:
-                # Get all entries for this port, ordered by time
-                all_outputs = SerialOutput.objects.filter(port=port_obj).order_by('-timestamp')
-                count = all_outputs.count()
-
-                # If count exceeds 5, find IDs of older entries to delete
-                if count > 5:
-                    # Slicing the queryset to get items beyond the 5th one
-                    ids_to_delete = list(all_outputs.values_list('id', flat=True)[5:])
-                    if ids_to_delete:
-                         deleted_count, _ = SerialOutput.objects.filter(pk__in=ids_to_delete).delete()
-                         print(f"Pruned {deleted_count} old DB entries for {full_port}")
-
-            except Exception as prune_error:
-                 print(f"Error pruning old DB entries for {full_port}: {prune_error}")
-        # --- End Pruning Logic ---
-
+        since = request.GET.get('since')
+        since = int(since) if since is not None else None
+        limit = max(1, min(int(request.GET.get('limit', DEFAULT_FETCH_LIMIT)), MAX_FETCH_LIMIT))
+        wait = max(0, min(float(request.GET.get('wait', 0)), MAX_WAIT_SECONDS))
+    except ValueError:
+        return JsonResponse({'lines': [], 'error': 'since, limit and wait must be numbers'}, status=400)
+
+    # The port is drained by a background PortReader, in this process or in the
+    # serial broker (see broker.py); this view only hands out what it buffered.
+    try:
+        result = await get_backend().poll(full_port, since, limit, wait)
     except serial.SerialException as e:
-         print(f"SerialException reading from {full_port}: {str(e)}. Closing port.")
-         if ser: # Ensure ser exists before trying to close
-             ser.close()
-         # Remove from connections dict regardless of close success
-         if full_port in ser_connections:
-             del ser_connections[full_port]
-         # Return previously read lines + error? Or just error? Let's return lines read so far.
-         return JsonResponse({'lines': lines_read, 'error': f'Serial error on {full_port}: {str(e)}'})
+        logger.warning("Failed to read port %s: %s", full_port, e)
+        return JsonResponse({'lines': [], 'error': f'Failed to open port {full_port}: {str(e)}'})
+    except Exception as e:
+        logger.exception("Unexpected error opening port %s: %s", full_port, e)
+        return JsonResponse({'lines': [], 'error': f'Unexpected error opening port {full_port}: {str(e)}'})
+
+    # The response for a given URL only changes when a new line arrives
+    last_seq = result['last_seq']
+    etag = f'"{last_seq}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    entries = result['entries']
+    response = {
+        'lines': [frame_to_text(entry.line, encoding) for entry in entries],
+        'first_seq': entries[0].seq if entries else None,  # seq of lines[0]; later lines follow on by one
+        'next': entries[-1].seq if entries else (since if since is not None and not result['reset'] else last_seq),
+        'missed': result['missed'],
+        'dropped': result['dropped'],
+    }
+    if result['reset']:
+        response['reset'] = True  # since was ahead of the port (the server restarted); lines start over
+    if any(isinstance(entry.line, bytes) for entry in entries):
+        response['encoding'] = encoding  # the lines are binary frames
+    if result['error']:
+        response['error'] = result['error']
+    response = JsonResponse(response)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+DEFAULT_HISTORY_LIMIT = 1000
+MAX_HISTORY_LIMIT = 10000
+
+
+def _parse_time(value):
+    # Epoch seconds (e.g. 1700000000.5) or ISO 8601; naive ISO times are taken as UTC
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f'Invalid time {value!r}')
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def _query_history(full_port, start, end, limit, after):
+    if HISTORY_BACKEND == 'segments':
+        return get_store().query(full_port, start, end, limit, after)
+    rows = SerialOutput.objects.filter(port__port=full_port)
+    if start is not None:
+        start = datetime.fromtimestamp(start, tz=timezone.utc)
+        if after is not None:
+            rows = rows.filter(Q(timestamp__gt=start) | Q(timestamp=start, id__gt=after))
+        else:
+            rows = rows.filter(timestamp__gte=start)
+    if end is not None:
+        rows = rows.filter(timestamp__lte=datetime.fromtimestamp(end, tz=timezone.utc))
+    rows = list(rows.order_by('timestamp', 'id').values_list('id', 'timestamp', 'output', 'data')[:limit + 1])
+    # The DB has no per-port seq; the row id stands in for it
+    entries = [
+        (row_id, timestamp.timestamp(), bytes(data) if data is not None else output)
+        for row_id, timestamp, output, data in rows[:limit]
+    ]
+    return entries, len(rows) > limit
+
+
+async def get_serial_history(request, port):
+    # Lines stored for a port between start and end (inclusive), oldest first.
+    #   start=, end=  epoch seconds or ISO 8601; either may be left out
+    #   limit=<n>     at most this many lines; 'truncated' says whether more matched
+    #   after=<seq>   skip lines at exactly start with a seq up to this one, so
+    #                 start/after from 'next' resume a truncated result
+    #   encoding=     base64 (default) or hex, for binary frames
+    # Served from the history segments or SerialOutput, per SERIAL_HISTORY_BACKEND.
+    full_port = resolve_port(port)
+    try:
+        start = _parse_time(request.GET.get('start'))
+        end = _parse_time(request.GET.get('end'))
+        limit = max(1, min(int(request.GET.get('limit', DEFAULT_HISTORY_LIMIT)), MAX_HISTORY_LIMIT))
+        after = request.GET.get('after')
+        after = int(after) if after is not None else None
+        encoding = request.GET.get('encoding', 'base64')
+        if encoding not in FRAME_ENCODINGS:
+            raise ValueError(f'unknown encoding {encoding!r}')
+    except ValueError as e:
+        return JsonResponse({'lines': [], 'error': f'start, end, limit and after must be times/numbers: {e}'}, status=400)
+    try:
+        entries, truncated = await sync_to_async(_query_history, thread_sensitive=False)(full_port, start, end, limit, after)
+    except Exception as e:
+        logger.exception("Error querying history of %s: %s", full_port, e)
+        return JsonResponse({'lines': [], 'error': f'Error querying history of {full_port}: {str(e)}'}, status=500)
+    return JsonResponse({
+        'port': full_port,
+        'lines': [
+            {'seq': seq, 'timestamp': timestamp, 'line': frame_to_text(line, encoding),
+             **({'encoding': encoding} if isinstance(line, bytes) else {})}
+            for seq, timestamp, line in entries
+        ],
+        'truncated': truncated,
+        # Query parameters that continue a truncated result
+        'next': {'start': entries[-1][1], 'after': entries[-1][0]} if truncated else None,
+    })
+
+
+def export_serial_data(request, port):
+    # Everything stored for a port between start and end, streamed as a download.
+    #   format=ndjson|csv   one record per line (default ndjson)
+    #   start=, end=        epoch seconds or ISO 8601; either may be left out
+    #   gzip=1              gzip the output
+    # Rows are read in chunks as the response is sent, so memory use does not
+    # depend on how much is exported.
+    full_port = resolve_port(port)
+    fmt = request.GET.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return JsonResponse({'error': f'format must be one of {", ".join(EXPORT_FORMATS)}'}, status=400)
+    try:
+        start = _parse_time(request.GET.get('start'))
+        end = _parse_time(request.GET.get('end'))
+    except ValueError as e:
+        return JsonResponse({'error': f'start and end must be times: {e}'}, status=400)
+    compress = request.GET.get('gzip') in ('1', 'true', 'yes')
+
+    chunks = export_chunks(iter_history(full_port, start, end), fmt, compress)
+    if isinstance(request, ASGIRequest):
+        chunks = aiter_chunks(chunks)
+    filename = f'{port.replace("/", "_")}.{fmt}' + ('.gz' if compress else '')
+    response = StreamingHttpResponse(chunks, content_type='application/gzip' if compress else EXPORT_FORMATS[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+DEFAULT_TELEMETRY_BUCKETS = 1000
+MAX_TELEMETRY_BUCKETS = 10000
+
+
+def _aggregate_telemetry(full_port, start, end, buckets, columns):
+    blocks = telemetry.load_blocks(full_port, start, end)
+    if not blocks:
+        return None
+    # Without start/end, span whatever was recorded
+    if start is None:
+        start = min(block[3] for block in blocks)
+    if end is None:
+        end = max(block[4] for block in blocks)
+    if end <= start:
+        end = start + 1
+    bucket_starts, results = telemetry.aggregate(blocks, start, end, buckets, columns)
+    return {'start': start, 'end': end, 'bucket_seconds': (end - start) / buckets,
+            'buckets': bucket_starts, 'columns': results}
+
+
+async def get_serial_telemetry(request, port):
+    # Parsed numeric columns of a port (see SERIAL_TELEMETRY_PARSERS), downsampled
+    # to min/max/mean/last per time bucket for charting.
+    #   start=, end=    epoch seconds or ISO 8601; default to the recorded range
+    #   buckets=<n>     number of equal time buckets
+    #   columns=a,b     only these columns
+    full_port = resolve_port(port)
+    try:
+        start = _parse_time(request.GET.get('start'))
+        end = _parse_time(request.GET.get('end'))
+        buckets = max(1, min(int(request.GET.get('buckets', DEFAULT_TELEMETRY_BUCKETS)), MAX_TELEMETRY_BUCKETS))
+    except ValueError as e:
+        return JsonResponse({'error': f'start, end and buckets must be times/numbers: {e}'}, status=400)
+    columns = request.GET.get('columns')
+    columns = set(columns.split(',')) if columns else None
+    try:
+        result = await sync_to_async(_aggregate_telemetry, thread_sensitive=False)(full_port, start, end, buckets, columns)
     except Exception as e:
-         print(f"Error reading from port {full_port}: {str(e)}")
-         # Return lines read so far + error
-         return JsonResponse({'lines': lines_read, 'error': f'Error reading from {full_port}: {str(e)}'})
+        logger.exception("Error aggregating telemetry of %s: %s", full_port, e)
+        return JsonResponse({'error': f'Error aggregating telemetry of {full_port}: {str(e)}'}, status=500)
+    if result is None:
+        result = {'start': start, 'end': end, 'bucket_seconds': None, 'buckets': [], 'columns': {}}
+    return JsonResponse({'port': full_port, **result})
+
+
+async def stream_serial_data(request, port):
+    # Server-Sent Events: pushes every new line as soon as the reader sees it.
+    # Needs an ASGI server (see djangoapp/asgi.py); under WSGI the response could
+    # never finish, so we refuse and let the page fall back to polling.
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'Streaming requires the ASGI server'}, status=501)
+
+    full_port = resolve_port(port)
+    # EventSource sends Last-Event-ID when it reconnects; replay what it missed.
+    # Other clients can pass the same cursor as ?since=
+    since = request.headers.get('Last-Event-ID') or request.GET.get('since')
+    since = int(since) if since and since.isdigit() else None
+    # format=raw streams the frames themselves instead of SSE: each is sent as a
+    # 4-byte big-endian length followed by its bytes (a zero length is a keepalive)
+    raw = request.GET.get('format') == 'raw'
+    try:
+        events = await get_backend().stream(full_port, since, raw)
+    except Exception as e:
+        logger.warning("Failed to open port %s for streaming: %s", full_port, e)
+        return JsonResponse({'error': f'Failed to open port {full_port}: {str(e)}'}, status=503)
+
+    response = StreamingHttpResponse(events, content_type='application/octet-stream' if raw else 'text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # don't let nginx buffer the stream
+    return response
+
+MAX_DASHBOARD_PORTS = 100
+
+
+def _dashboard_ports(request):
+    # ?ports=ttyACM0,ttyUSB0 (URL names, as in /serial/data/<port>/); all discovered ports if left out
+    names = [name for name in request.GET.get('ports', '').split(',') if name]
+    if not names:
+        names = [device.replace('/dev/', '') for device in list_serial_ports()]
+    if len(names) > MAX_DASHBOARD_PORTS:
+        raise ValueError(f'At most {MAX_DASHBOARD_PORTS} ports per dashboard')
+    return list(dict.fromkeys(names))
+
+
+async def get_dashboard_data(request):
+    # Every port of a dashboard in one request.
+    #   ports=a,b       the ports (see _dashboard_ports)
+    #   since=a:12,b:5  per-port cursors, as returned in 'cursor'; ports left out get their latest lines
+    #   limit=<n>       at most this many lines per port
+    #   wait=<s>        long-poll until any of the ports has something newer
+    # Returns {'ports': {name: <what get_serial_data returns>}, 'cursor': ...}.
+    try:
+        names = await sync_to_async(_dashboard_ports, thread_sensitive=False)(request)
+        since = parse_cursors(request.GET.get('since'))
+        limit = max(1, min(int(request.GET.get('limit', DEFAULT_FETCH_LIMIT)), MAX_FETCH_LIMIT))
+        wait = max(0, min(float(request.GET.get('wait', 0)), MAX_WAIT_SECONDS))
+    except ValueError as e:
+        return JsonResponse({'ports': {}, 'error': f'Invalid dashboard query: {e}'}, status=400)
+    full_ports = {name: resolve_port(name) for name in names}
+    cursors = {full_ports[name]: since.get(name) for name in names}
+    try:
+        results = await get_backend().poll_many(cursors, limit, wait)
+    except serial.SerialException as e:
+        logger.warning("Failed to read dashboard ports: %s", e)
+        return JsonResponse({'ports': {}, 'error': f'Failed to read ports: {str(e)}'})
+
+    ports = {}
+    next_cursors = {}
+    for name in names:
+        result = results[full_ports[name]]
+        entries = result['entries']
+        cursor = cursors[full_ports[name]]
+        next_cursors[name] = entries[-1].seq if entries else (cursor if cursor is not None and not result['reset'] else result['last_seq'])
+        ports[name] = {
+            'port': full_ports[name],
+            'lines': [frame_to_text(entry.line) for entry in entries],
+            'first_seq': entries[0].seq if entries else None,
+            'next': next_cursors[name],
+            'missed': result['missed'],
+            'dropped': result['dropped'],
+        }
+        if result['reset']:
+            ports[name]['reset'] = True
+        if any(isinstance(entry.line, bytes) for entry in entries):
+            ports[name]['encoding'] = 'base64'
+        if result['error']:
+            ports[name]['error'] = result['error']
+    response = JsonResponse({'ports': ports, 'cursor': format_cursors(next_cursors)})
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+async def stream_dashboard(request):
+    # Server-Sent Events for every port of a dashboard over one connection.
+    # Each event's data carries its 'port'; the event id holds the cursor of
+    # every port, so Last-Event-ID (or ?since=) resumes them all.
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'Streaming requires the ASGI server'}, status=501)
+    try:
+        names = await sync_to_async(_dashboard_ports, thread_sensitive=False)(request)
+        since = parse_cursors(request.headers.get('Last-Event-ID') or request.GET.get('since'))
+    except ValueError as e:
+        return JsonResponse({'error': f'Invalid dashboard query: {e}'}, status=400)
+    backend = get_backend()
+    streams, errors = {}, {}
+    for name in names:
+        try:
+            streams[name] = await backend.stream_entries(resolve_port(name), since.get(name))
+        except Exception as e:
+            logger.warning("Failed to open port %s for the dashboard: %s", name, e)
+            errors[name] = f'Failed to open port {resolve_port(name)}: {str(e)}'
+    response = StreamingHttpResponse(multiplex_stream(streams, since, errors), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
-    # Return all non-empty lines read in this interval
-    return JsonResponse({'lines': lines_read}) # No error key if successful
+
+def dashboard_view(request):
+    # Live view of several ports on one page; ?ports=a,b picks them (default: all)
+    try:
+        names = _dashboard_ports(request)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+    return render(request, 'dashboard.html', {'ports': names, 'ports_param': ','.join(names)})
 
 # --- list_serial_ports, list_devices, serial_data_view, send_serial, close_all_serial_ports ---
 # (Make sure they are still present in your views.py)
@@ -125,16 +378,95 @@ def get_serial_data(request, port):
 
 def list_devices(request):
     try:
-        available_ports = list_serial_ports()
-        # Ensure the ports passed to the template are the base names if needed by serial_data_view URL
-        # e.g., extracting 'ttyACM0' from '/dev/ttyACM0'
-        # This depends on how your urls.py is set up for serial_data_view
-        context_ports = [p.replace('/dev/', '') for p in available_ports] # Adjust as needed
+        ports = get_discovery().list_ports()
+        # The serial_data_view URL takes the base name, e.g. 'ttyACM0' from '/dev/ttyACM0'
+        context_ports = [dict(info, port=info['device'].replace('/dev/', '')) for info in ports]
         return render(request, 'devices_list.html', {'available_ports': context_ports})
     except Exception as e:
-        print(f"Error listing devices: {str(e)}") # Log error
+        logger.exception("Error listing devices: %s", e)
         return HttpResponse(f"Error listing devices: {str(e)}", status=500)
 
+def list_devices_info(request):
+    # Same inventory as list_devices, with the USB metadata, as JSON
+    try:
+        return JsonResponse({'ports': get_discovery().list_ports()})
+    except Exception as e:
+        logger.exception("Error listing devices: %s", e)
+        return JsonResponse({'ports': [], 'error': f'Error listing devices: {str(e)}'}, status=500)
+
+def get_port_status(request, port=None):
+    # Lifecycle of the ports this app has opened: open, reconnecting (with the
+    # next attempt), failed or closed (idle, evicted, stopped), see lifecycle.py
+    full_port = resolve_port(port) if port else None
+    try:
+        ports = get_backend().port_status(full_port)
+    except serial.SerialException as e:
+        logger.warning("Error getting port status: %s", e)
+        return JsonResponse({'status': 'error', 'message': f'Error getting port status: {str(e)}'}, status=500)
+    if full_port is None:
+        return JsonResponse({'ports': ports})
+    if not ports:
+        return JsonResponse({'status': 'error', 'message': f'{full_port} has not been opened'}, status=404)
+    return JsonResponse(ports[0])
+
+async def stream_device_events(request):
+    # Server-Sent Events with an 'added' or 'removed' event per port plugged in or out
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'Streaming requires the ASGI server'}, status=501)
+    discovery = await sync_to_async(get_discovery, thread_sensitive=False)()
+    subscription = discovery.subscribe(asyncio.get_running_loop())
+    response = StreamingHttpResponse(device_event_stream(subscription), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+MAX_TRIGGER_EVENTS = 1000
+
+
+def get_trigger_events(request):
+    # Stored trigger firings, oldest first: ?port=ttyACM0, ?rule=<name>,
+    # ?since=<id> (only newer than this event id, for polling), ?limit=<n>
+    try:
+        since = int(request.GET.get('since', 0))
+        limit = max(1, min(int(request.GET.get('limit', DEFAULT_FETCH_LIMIT)), MAX_TRIGGER_EVENTS))
+    except ValueError:
+        return JsonResponse({'events': [], 'error': 'since and limit must be numbers'}, status=400)
+    events = TriggerEvent.objects.filter(id__gt=since).select_related('rule', 'port')
+    if request.GET.get('port'):
+        events = events.filter(port__port=resolve_port(request.GET['port']))
+    if request.GET.get('rule'):
+        events = events.filter(rule__name=request.GET['rule'])
+    events = list(events.order_by('id')[:limit])
+    return JsonResponse({
+        'events': [
+            {
+                'id': event.id,
+                'rule': event.rule.name,
+                'port': event.port.port,
+                'seq': event.seq,
+                'timestamp': event.timestamp.timestamp(),
+                'line': event.line,
+            }
+            for event in events
+        ],
+        'next': events[-1].id if events else since,
+    })
+
+async def stream_triggers(request):
+    # Server-Sent Events with a 'trigger' event each time a rule with the
+    # 'stream' action fires, on any port
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'Streaming requires the ASGI server'}, status=501)
+    try:
+        items = await get_backend().trigger_events()
+    except serial.SerialException as e:
+        logger.warning("Failed to stream triggers: %s", e)
+        return JsonResponse({'error': str(e)}, status=502)
+    response = StreamingHttpResponse(named_event_stream(items), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 def serial_data_view(request, port):
     # This view just renders the template. The actual data comes from get_serial_data via JS.
     # 'port' here should match the identifier used in the URL (e.g., 'ttyACM0')
@@ -152,68 +484,195 @@ def send_serial(request):
             if not port or data is None: # Check if data is None or empty string if needed
                 return JsonResponse({'status': 'error', 'message': 'Missing port or buffer data'}, status=400)
 
-            # --- Use the shared connection pool ---
-            if port not in ser_connections:
+            # Accept either a full path like /dev/ttyACM0 or a base name like ttyACM0
+            port = resolve_port(port)
+
+            encoding = payload.get('encoding')
+            if encoding is not None:
+                # Binary: buffer is hex/base64 bytes, written exactly as given
+                # (already framed for the device, e.g. COBS-encoded with its 0x00)
+                if encoding not in FRAME_ENCODINGS:
+                    return JsonResponse({'status': 'error', 'message': f'encoding must be one of {", ".join(FRAME_ENCODINGS)}'}, status=400)
                 try:
-                    print(f"Attempting to open {port} for sending...")
-                    # Ensure correct baud rate and a small timeout
-                    ser_connections[port] = serial.Serial(port, 115200, timeout=0.1)
-                    print(f"Successfully opened {port} for sending.")
-                    # Give the connection a moment to establish
-                    time.sleep(0.5)
-                except serial.SerialException as e:
-                    print(f"Failed to open port {port} for sending: {str(e)}")
-                    if port in ser_connections: # Clean up handle if creation failed partially
-                         del ser_connections[port]
-                    return JsonResponse({'status': 'error', 'message': f'Failed to open port {port}: {str(e)}'}, status=500)
-                except Exception as e: # Catch other potential errors during open
-                     print(f"Unexpected error opening port {port}: {str(e)}")
-                     if port in ser_connections:
-                         del ser_connections[port]
-                     return JsonResponse({'status': 'error', 'message': f'Unexpected error opening port {port}: {str(e)}'}, status=500)
-
-            ser = ser_connections.get(port) # Use .get for safety
-
-            if not ser or not ser.is_open:
-                # Connection died or was closed elsewhere. Try to reopen? Or report error.
-                print(f"Connection for {port} lost before sending. Removing handle.")
-                if port in ser_connections:
-                    del ser_connections[port]
-                # Optionally, try to reopen here, or just return error
-                return JsonResponse({'status': 'error', 'message': f'Serial port {port} is not open. Please refresh or check connection.'}, status=500)
-
-            # Write the data
-            # Add newline if the receiving device expects it
-            full_data = (data + '\n').encode('utf-8')
-            print(f"Sending to {port}: {full_data}") # Log what's being sent
-            ser.write(full_data)
-            # Optional: ser.flush() # Ensure data is sent immediately
+                    full_data = frame_from_text(data, encoding)
+                except ValueError as e:
+                    return JsonResponse({'status': 'error', 'message': f'Invalid {encoding} buffer: {e}'}, status=400)
+            else:
+                # Write the data
+                # Add newline if the receiving device expects it
+                full_data = (data + '\n').encode('utf-8')
+            logger.debug("Sending to %s: %r", port, full_data)
+            # Goes through the port's write queue (here or in the broker), so
+            # concurrent requests never interleave, and whatever the device answers
+            # is drained into the buffer get_serial_data serves from
+            result = get_backend().write(port, [full_data])
 
             # --- DO NOT read response here ---
             # --- DO NOT close the connection here ---
 
-            return JsonResponse({'status': 'ok', 'message': f'Data sent to {port}'})
+            return JsonResponse({'status': 'ok', 'message': f'Data sent to {port}', **result})
 
         except json.JSONDecodeError:
             return JsonResponse({'status': 'error', 'message': 'Invalid JSON payload'}, status=400)
         except serial.SerialException as e:
             # Handle write errors (e.g., port closed unexpectedly)
-            print(f"SerialException during write to {port}: {str(e)}. Closing port.")
-            if port in ser_connections:
-                ser = ser_connections[port]
-                try:
-                    ser.close()
-                except Exception: # Ignore errors during close
-                     pass
-                del ser_connections[port] # Remove potentially dead connection
+            logger.warning("SerialException during write to %s: %s", port, e)
             return JsonResponse({'status': 'error', 'message': f'Serial write error on {port}: {str(e)}'}, status=500)
         except Exception as e:
             # Catch other potential errors
-            print(f"Unexpected error in send_serial for {port}: {str(e)}") # Log the error
+            logger.exception("Unexpected error in send_serial for %s: %s", port, e)
             return JsonResponse({'status': 'error', 'message': f'An unexpected error occurred: {str(e)}'}, status=500)
     else: # Use else for clarity
         return JsonResponse({'error': 'Invalid request method'}, status=405)
 
+def metrics_view(request):
+    # Prometheus text exposition of the serial counters, plus the broker's when one is used
+    text = metrics.registry.render()
+    backend = get_backend()
+    if isinstance(backend, BrokerClient):
+        try:
+            text += backend.metrics()
+        except serial.SerialException as e:
+            logger.warning("Could not fetch metrics from the serial broker: %s", e)
+    return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+MAX_BATCH_COMMANDS = 1000
+
+
+@csrf_exempt
+def send_serial_batch(request):
+    # Body: {"port": "ttyACM0", "commands": ["a", "b", ...]}
+    # The commands are queued as one request, so they reach the device back to
+    # back with nothing from other requests in between.
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    port = None
+    try:
+        payload = json.loads(request.body.decode('utf-8'))
+        port = payload.get('port')
+        commands = payload.get('commands')
+        if not port or not isinstance(commands, list) or not commands:
+            return JsonResponse({'status': 'error', 'message': 'Missing port or commands list'}, status=400)
+        if len(commands) > MAX_BATCH_COMMANDS:
+            return JsonResponse({'status': 'error', 'message': f'At most {MAX_BATCH_COMMANDS} commands per batch'}, status=400)
+        port = resolve_port(port)
+        chunks = [(str(command) + '\n').encode('utf-8') for command in commands]
+        logger.debug("Sending %d commands to %s", len(chunks), port)
+        result = get_backend().write(port, chunks)
+        return JsonResponse({'status': 'ok', 'message': f'{len(chunks)} commands sent to {port}', 'count': len(chunks), **result})
+    except json.JSONDecodeError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON payload'}, status=400)
+    except serial.SerialException as e:
+        logger.warning("SerialException during batch write to %s: %s", port, e)
+        return JsonResponse({'status': 'error', 'message': f'Serial write error on {port}: {str(e)}'}, status=500)
+    except Exception as e:
+        logger.exception("Unexpected error in send_serial_batch for %s: %s", port, e)
+        return JsonResponse({'status': 'error', 'message': f'An unexpected error occurred: {str(e)}'}, status=500)
+
+RECORD_ACTIONS = ('start', 'stop', 'status')
+
+
+@csrf_exempt
+def record_serial(request):
+    # Body: {"port": "ttyACM0", "action": "start" | "stop" | "status"}
+    # Captures the raw bytes read from the port, with their arrival times, to
+    # a file under SERIAL_CAPTURE_DIR; play it back with manage.py serialreplay.
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    port = None
+    try:
+        payload = json.loads(request.body.decode('utf-8'))
+        port = payload.get('port')
+        action = payload.get('action', 'status')
+        if not port or action not in RECORD_ACTIONS:
+            return JsonResponse({'status': 'error', 'message': f'Missing port, or action not one of {", ".join(RECORD_ACTIONS)}'}, status=400)
+        port = resolve_port(port)
+        result = get_backend().record(port, action)
+        return JsonResponse({'status': 'ok', 'port': port, **result})
+    except json.JSONDecodeError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON payload'}, status=400)
+    except (serial.SerialException, OSError) as e:
+        logger.warning("Recording %s failed: %s", port, e)
+        return JsonResponse({'status': 'error', 'message': f'Recording {port} failed: {str(e)}'}, status=500)
+
+
+MAX_PIPELINED_COMMANDS = 100
+
+
+async def send_command(request):
+    # Write a command and wait for the device's reply, instead of send + poll.
+    # Body: {"port": "ttyACM0", "command": "AT", "terminator": "OK", "timeout": 2}
+    #   prefix / regex   the reply is the first line starting with / matching this
+    #   terminator       collect lines up to and including this one (multi-line replies)
+    #   timeout          seconds to wait, for the whole request (default 2, at most 30)
+    #   encoding         hex or base64: command is raw bytes, written without a newline
+    # or "commands": [{"command": ..., "prefix": ...}, ...] to pipeline several:
+    # they are all written at once and matched to the replies in order.
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    port = None
+    try:
+        payload = json.loads(request.body.decode('utf-8'))
+        port = payload.get('port')
+        commands = payload.get('commands')
+        pipelined = commands is not None
+        if not pipelined:
+            commands = [payload] if payload.get('command') is not None else []
+        if not port or not isinstance(commands, list) or not commands:
+            return JsonResponse({'status': 'error', 'message': 'Missing port and command or commands list'}, status=400)
+        if len(commands) > MAX_PIPELINED_COMMANDS:
+            return JsonResponse({'status': 'error', 'message': f'At most {MAX_PIPELINED_COMMANDS} commands per request'}, status=400)
+        encoding = payload.get('encoding')
+        if encoding is not None and encoding not in FRAME_ENCODINGS:
+            return JsonResponse({'status': 'error', 'message': f'encoding must be one of {", ".join(FRAME_ENCODINGS)}'}, status=400)
+        timeout = max(0, min(float(payload.get('timeout', DEFAULT_COMMAND_TIMEOUT)), MAX_COMMAND_TIMEOUT))
+        requests = []
+        for command in commands:
+            if isinstance(command, str):
+                command = {'command': command}
+            if not isinstance(command, dict) or command.get('command') is None:
+                return JsonResponse({'status': 'error', 'message': 'Every command needs a "command" field'}, status=400)
+            # A matcher field left out of a pipelined command falls back to the top level one
+            spec = {key: command.get(key, payload.get(key)) for key in ('prefix', 'regex', 'terminator')}
+            if encoding is not None:
+                chunk = frame_from_text(command['command'], encoding)
+            else:
+                chunk = (str(command['command']) + '\n').encode('utf-8')
+            requests.append(([chunk], ReplyMatcher.from_spec(spec)))
+        port = resolve_port(port)
+    except json.JSONDecodeError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON payload'}, status=400)
+    except (TypeError, ValueError, re.error) as e:
+        return JsonResponse({'status': 'error', 'message': f'Invalid command request: {e}'}, status=400)
+
+    try:
+        # Waits on the event loop for the replies, so a slow device holds no executor thread
+        results = await get_backend().acommand(port, requests, timeout)
+    except serial.SerialException as e:
+        logger.warning("SerialException during command on %s: %s", port, e)
+        return JsonResponse({'status': 'error', 'message': f'Serial error on {port}: {str(e)}'}, status=500)
+    except Exception as e:
+        logger.exception("Unexpected error in send_command for %s: %s", port, e)
+        return JsonResponse({'status': 'error', 'message': f'An unexpected error occurred: {str(e)}'}, status=500)
+
+    for result in results:
+        if 'reply' in result:
+            result['status'] = 'ok'
+            result['reply'] = [frame_to_text(line, encoding or 'base64') for line in result['reply']]
+        else:
+            result['status'] = 'timeout' if result.pop('timeout') else 'error'
+            result['message'] = result.pop('error')
+    if pipelined:
+        return JsonResponse({'status': 'ok', 'port': port, 'results': results})
+    result = results[0]
+    status = {'ok': 200, 'timeout': 504}.get(result['status'], 500)
+    return JsonResponse({'port': port, **result}, status=status)
+
+# csrf_exempt wraps views in a sync function on Django 4.2, which would tie up
+# a thread for the whole wait; marking the async view directly has the same effect
+send_command.csrf_exempt = True
+
 # --- Add cleanup logic (optional but recommended) ---
 # This is tricky in Django's stateless model. You might need:
 # 1. A separate management command to close ports.
@@ -221,16 +680,19 @@ def send_serial(request):
 # 3. Close ports on Django server shutdown (e.g., using atexit, but reliability varies).
 
 # Example using atexit (place at the end of views.py)
-import atexit
 def close_all_serial_ports():
-    print("Closing all open serial ports...")
+    logger.info("Closing all open serial ports...")
+    stop_port_manager()  # no reconnects while shutting down
+    stop_all_readers()
     for port, ser in list(ser_connections.items()): # Use list to avoid modifying dict during iteration
         try:
             if ser and ser.is_open:
-                print(f"Closing {port}")
+                logger.info("Closing %s", port)
                 ser.close()
         except Exception as e:
-            print(f"Error closing port {port}: {e}")
+            logger.error("Error closing port %s: %s", port, e)
     ser_connections.clear()
+    stop_writer()  # flush lines still waiting to be written
+    stop_trigger_engine()
 
 atexit.register(close_all_serial_ports)
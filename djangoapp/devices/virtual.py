@@ -0,0 +1,143 @@
+"""Virtual serial devices the app can open like real ones, for replaying captures and simulations.
+
+PtyDevice creates a pseudo-terminal (POSIX only): the app opens its path
+(or the symlink given as link) as a normal port. SocketDevice listens on TCP
+and is opened through pyserial's socket://host:port. Either way, what is
+written with write() is what the app reads, and whatever the app sends to
+the device is read and discarded so it never blocks.
+"""
+import errno
+import os
+import select
+import socket
+import threading
+import time
+
+
+class PtyDevice:
+    def __init__(self, link=None):
+        import pty
+        import tty
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        # Nobody has the slave open once we close ours, which is how
+        # wait_opened() notices the app opening it
+        os.close(slave)
+        self.link = link
+        if link:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.path, link)
+        self.closed = False
+        self._drain = threading.Thread(target=self._drain_input, name='virtual-pty-drain', daemon=True)
+        self._drain.start()
+
+    @property
+    def name(self):
+        return self.link or self.path
+
+    def opened(self):
+        # The master reports a hangup for as long as no process has the slave open
+        poller = select.poll()
+        poller.register(self.master, select.POLLHUP)
+        return not any(event & select.POLLHUP for _, event in poller.poll(0))
+
+    def wait_opened(self, timeout=None, stop_event=None):
+        """Block until the app opened the device; bytes written before that would be discarded by the open."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.opened():
+            if stop_event is not None and stop_event.is_set():
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        time.sleep(0.1)  # let the open finish, pyserial flushes the input right after
+        return True
+
+    def write(self, data):
+        if not self.opened():
+            raise OSError(errno.EIO, 'The port was closed')  # don't fill up a buffer nobody reads
+        view = memoryview(data)
+        while view:
+            written = os.write(self.master, view)
+            view = view[written:]
+
+    def _drain_input(self):
+        while not self.closed:
+            try:
+                readable, _, _ = select.select([self.master], [], [], 0.2)
+                if readable:
+                    os.read(self.master, 65536)
+            except OSError:
+                time.sleep(0.05)  # slave not open (EIO), or closed
+
+    def close(self):
+        self.closed = True
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+        try:
+            os.close(self.master)
+        except OSError:
+            pass
+
+
+class SocketDevice:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.host, self.port = self.server.getsockname()[:2]
+        self.conn = None
+        self.closed = False
+
+    @property
+    def name(self):
+        return f'socket://{self.host}:{self.port}'
+
+    def opened(self):
+        return self.conn is not None
+
+    def wait_opened(self, timeout=None, stop_event=None):
+        """Wait for the app to connect; a new connection replaces the previous one."""
+        self.server.settimeout(0.2)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                return False
+            try:
+                conn, _ = self.server.accept()
+                break
+            except socket.timeout:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = conn
+        threading.Thread(target=self._drain_input, args=(conn,), name='virtual-socket-drain', daemon=True).start()
+        return True
+
+    def write(self, data):
+        try:
+            self.conn.sendall(data)
+        except OSError:
+            self.conn.close()
+            self.conn = None
+            raise
+
+    def _drain_input(self, conn):
+        try:
+            while conn.recv(65536):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        self.closed = True
+        for sock in (self.conn, self.server):
+            if sock is not None:
+                try:
+                    sock.close()
+                except OSError:
+                    pass
@@ -0,0 +1,116 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import serial
+
+from . import metrics
+
+# Time a device gets after the port opens before the first write reaches it
+# (e.g. boards that reset when the port is opened)
+SETTLE_SECONDS = 0.5
+WRITE_QUEUE_SIZE = 1000  # pending write requests per port before submit() refuses more
+
+
+class PortWriter(threading.Thread):
+    """Serializes every write to one port through a single queue and thread.
+
+    Each submit() is one request holding one or more chunks; its chunks are
+    written back to back, so concurrent requests never interleave bytes. The
+    returned Future resolves to the time the request spent queued and writing.
+    """
+
+    def __init__(self, reader):
+        super().__init__(name=f'serial-writer:{reader.full_port}', daemon=True)
+        self.reader = reader
+        self.queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._stop_event = threading.Event()
+        self.stats_lock = threading.Lock()
+        self.writes = 0
+        self.bytes_written = 0
+        self.last_latency_ms = 0.0
+        self.max_latency_ms = 0.0
+        self.total_latency_ms = 0.0
+
+    def submit(self, chunks):
+        future = Future()
+        if self._stop_event.is_set():
+            future.set_exception(serial.SerialException(f'Serial port {self.reader.full_port} closed'))
+            return future
+        try:
+            self.queue.put_nowait((chunks, time.perf_counter(), future))
+        except queue.Full:
+            future.set_exception(serial.SerialException(f'Write queue for {self.reader.full_port} is full'))
+        return future
+
+    def run(self):
+        reader = self.reader
+        try:
+            reader.ready.result()
+        except Exception as e:
+            self._fail_pending(e)
+            return
+        # Let the device settle without holding up any request thread
+        delay = reader.opened_at + SETTLE_SECONDS - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        while not self._stop_event.is_set():
+            try:
+                item = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            chunks, queued_at, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                for chunk in chunks:
+                    reader.ser.write(chunk)
+            except Exception as e:
+                future.set_exception(e)
+                if isinstance(e, serial.SerialException):
+                    # Closing the handle makes the reader drop it on its next read
+                    try:
+                        reader.ser.close()
+                    except Exception:  # Ignore errors during close
+                        pass
+                    break
+                continue
+            latency = time.perf_counter() - queued_at
+            latency_ms = latency * 1000
+            size = sum(len(chunk) for chunk in chunks)
+            metrics.write_latency.observe(latency, reader.full_port)
+            metrics.bytes_written.inc(size, reader.full_port)
+            with self.stats_lock:
+                self.writes += 1
+                self.bytes_written += size
+                self.last_latency_ms = latency_ms
+                self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+                self.total_latency_ms += latency_ms
+            future.set_result(latency_ms)
+        self._fail_pending(serial.SerialException(f'Serial port {reader.full_port} closed'))
+
+    def _fail_pending(self, error):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            future = item[2]
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+    def stop(self):
+        # Requests still queued are failed once the thread notices
+        self._stop_event.set()
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'writes': self.writes,
+                'bytes_written': self.bytes_written,
+                'last_latency_ms': self.last_latency_ms,
+                'max_latency_ms': self.max_latency_ms,
+                'avg_latency_ms': self.total_latency_ms / self.writes if self.writes else 0.0,
+            }
@@ -49,6 +49,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "devices.middleware.RequestLatencyMiddleware",
 ]
 
 ROOT_URLCONF = "djangoapp.urls"
@@ -123,3 +124,171 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+
+# Serial ingest
+# Lines read from serial ports are written to the DB in batches by a
+# background writer: a batch is flushed once it holds SERIAL_DB_BATCH_SIZE
+# lines or its oldest line has waited SERIAL_DB_FLUSH_MS milliseconds.
+
+SERIAL_DB_BATCH_SIZE = 200
+
+SERIAL_DB_FLUSH_MS = 250
+
+# Retention for SerialOutput rows, applied by a periodic sweep every
+# SERIAL_RETENTION_SWEEP_SECONDS. Either limit may be None to disable it;
+# SERIAL_RETENTION_PER_PORT overrides the default for individual ports,
+# e.g. {"/dev/ttyACM0": {"max_rows": 10000, "max_age_seconds": 86400}}.
+
+SERIAL_RETENTION = {"max_rows": 5, "max_age_seconds": None}
+
+SERIAL_RETENTION_PER_PORT = {}
+
+SERIAL_RETENTION_SWEEP_SECONDS = 5
+
+# Which read lines are persisted. Modes: "all"; "change" (only lines that
+# differ from the last stored one); "deadband" (only when a number in the line
+# moves by more than "deadband"); "rate" (at most "max_per_second" lines).
+# "change" and "deadband" take "heartbeat_seconds" to store an unchanged line
+# every so often anyway. SERIAL_PERSIST_POLICY_PER_PORT overrides the default
+# per full port path, e.g. {"/dev/ttyACM0": {"mode": "deadband", "deadband": 0.5}}.
+# Suppressed lines are still served live, parsed for telemetry and counted in
+# the metrics.
+
+SERIAL_PERSIST_POLICY = {"mode": "all"}
+
+SERIAL_PERSIST_POLICY_PER_PORT = {}
+
+# Where read lines are kept. "db" writes SerialOutput rows, pruned per the
+# retention settings above. "segments" appends them instead to per-port
+# segment files under SERIAL_HISTORY_DIR (no INSERTs, no table growth), which
+# is meant for keeping days of history; GET /serial/history/<port>/ serves
+# either. Full segments are zlib-compressed when SERIAL_HISTORY_COMPRESS is
+# set, and all but the newest SERIAL_HISTORY_MAX_SEGMENTS are deleted.
+
+SERIAL_HISTORY_BACKEND = "db"
+
+SERIAL_HISTORY_DIR = BASE_DIR / "history"
+
+SERIAL_HISTORY_SEGMENT_BYTES = 16 * 1024 * 1024
+
+SERIAL_HISTORY_COMPRESS = True
+
+SERIAL_HISTORY_MAX_SEGMENTS = None
+
+# GET /serial/export/<port>/ streams history as NDJSON or CSV, reading
+# SERIAL_EXPORT_CHUNK_SIZE rows from the DB at a time.
+
+SERIAL_EXPORT_CHUNK_SIZE = 2000
+
+# Numeric telemetry. Lines of the ports listed here are also parsed into
+# numeric columns, keyed by full port path: "csv" maps comma separated fields
+# to the given column names, "kv" reads name=value pairs, e.g.
+#   {"/dev/ttyACM0": {"format": "csv", "columns": ["temp", "humidity"]},
+#    "/dev/ttyUSB0": {"format": "kv"}}
+# Samples are stored as packed float64 blocks (TelemetryBlock) of up to
+# SERIAL_TELEMETRY_BLOCK_SAMPLES samples, written at least every
+# SERIAL_TELEMETRY_FLUSH_SECONDS, and GET /serial/telemetry/<port>/ returns
+# min/max/mean/last per time bucket (vectorized when NumPy is installed).
+
+SERIAL_TELEMETRY_PARSERS = {}
+
+SERIAL_TELEMETRY_BLOCK_SAMPLES = 4096
+
+SERIAL_TELEMETRY_FLUSH_SECONDS = 5
+
+# Trigger rules (TriggerRule, edited in the admin) are matched against every
+# line read and fire their actions: store a TriggerEvent, POST to a webhook,
+# or push to GET /serial/triggers/stream/. Rules are re-read every
+# SERIAL_TRIGGER_RELOAD_SECONDS; webhook calls time out after
+# SERIAL_TRIGGER_WEBHOOK_TIMEOUT seconds.
+
+SERIAL_TRIGGER_RELOAD_SECONDS = 5
+
+SERIAL_TRIGGER_WEBHOOK_TIMEOUT = 5
+
+# POST /serial/record/ captures the raw bytes read from a port, with their
+# arrival times, to a file in SERIAL_CAPTURE_DIR. `manage.py serialreplay`
+# plays such a file back through a pty or a TCP socket.
+
+SERIAL_CAPTURE_DIR = BASE_DIR / "captures"
+
+# Port lifecycle. A port nobody has used (no request, stream or recording)
+# for SERIAL_IDLE_TIMEOUT seconds is closed; None keeps ports open, e.g. to
+# log them continuously. With SERIAL_MAX_OPEN_PORTS ports open, opening one
+# more closes the least recently used idle port. A port that fails while open
+# is reopened after SERIAL_RECONNECT_MIN_SECONDS, doubling up to
+# SERIAL_RECONNECT_MAX_SECONDS between attempts; USB adapters are found again
+# by serial number if they come back under another /dev path.
+
+SERIAL_IDLE_TIMEOUT = None
+
+SERIAL_MAX_OPEN_PORTS = None
+
+SERIAL_RECONNECT_MIN_SECONDS = 0.5
+
+SERIAL_RECONNECT_MAX_SECONDS = 30
+
+# Serial port discovery. A port is listed when its device path contains one
+# of SERIAL_PORT_PATTERNS. The inventory is cached; on Linux it is refreshed
+# as soon as /dev changes, elsewhere after SERIAL_DISCOVERY_TTL_SECONDS.
+
+SERIAL_PORT_PATTERNS = ["ttyACM", "ttyUSB", "COM"]
+
+SERIAL_DISCOVERY_TTL_SECONDS = 30
+
+# Set SERIAL_BROKER_SOCKET to a Unix socket path to run the ports in a
+# separate `manage.py serialbroker` process shared by all web workers.
+# None opens the ports inside each web process, which only works with one.
+
+SERIAL_BROKER_SOCKET = None
+
+# Framing per port, keyed by full port path. Ports not listed are read as
+# newline-delimited UTF-8 text. Binary modes keep each frame as raw bytes:
+#   {"mode": "cobs"}   COBS-encoded frames ending in 0x00
+#   {"mode": "slip"}   SLIP (RFC 1055) frames
+#   {"mode": "length", "length_bytes": 2, "crc": "crc16"}
+#                      big-endian length, payload, CRC ("crc16", "crc32" or None)
+# JSON responses carry binary frames as base64 (or hex with ?encoding=hex).
+
+SERIAL_FRAMING = {}
+
+# Port names that don't map to /dev/<name>, e.g. {"loop0": "loop://"}.
+
+SERIAL_VIRTUAL_PORTS = {}
+
+# Logging. The devices app logs at INFO; set its level to DEBUG to also log
+# every line read and every write (costly on busy ports). Repeats of the same
+# message are capped at 10 per second.
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {
+        "rate_limit": {
+            "()": "devices.log.RateLimitFilter",
+            "rate": 10,
+            "per": 1.0,
+        },
+    },
+    "formatters": {
+        "simple": {
+            "format": "{asctime} {levelname} {name}: {message}",
+            "style": "{",
+        },
+    },
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+            "filters": ["rate_limit"],
+            "formatter": "simple",
+        },
+    },
+    "loggers": {
+        "devices": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+    },
+}